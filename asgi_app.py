@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+"""
+ASGI mode cho telegram_bot (1 process, 1 event loop)
+
+    pip install uvicorn httpx
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+
+- /webhook: trả "ok" ngay, update xử lý nền; cùng user → lần lượt, khác user → song song
+- handle_update (Sheets, index RAM, ledger) vẫn là code đồng bộ → chạy trên
+  HANDLER_POOL (ASGI_HANDLER_THREADS thread), không giữ kết nối HTTP của Telegram;
+  SePay chạy trên PAYMENT_POOL riêng để không xếp sau update của user
+- Telegram: AsyncOutbox (httpx.AsyncClient) thay TG_OUTBOX; thứ tự theo chat,
+  token bucket, 429 như OutboundQueue nhưng không tốn thread cho mỗi tin đang gửi
+- Shopee: AsyncShopeeClient thay SHOPEE; combo lưu N mã song song trên event loop
+  thay vì N thread mỗi combo
+
+Update đã ack nhưng chưa xử lý nằm trong RAM: shutdown (lifespan) chờ xử lý hết,
+còn process bị kill thì mất (Telegram không gửi lại update đã nhận 200).
+"""
+
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import parse_qs
+
+import telegram_bot as tb
+
+ASGI_HANDLER_THREADS = int(os.getenv("ASGI_HANDLER_THREADS", "32"))
+ASGI_PAYMENT_THREADS = int(os.getenv("ASGI_PAYMENT_THREADS", "4"))   # SePay không xếp sau update
+ASGI_MAX_INFLIGHT    = int(os.getenv("ASGI_MAX_INFLIGHT", "2000"))  # update đã ack chưa xong; quá → 503
+ASGI_DRAIN_TIMEOUT   = float(os.getenv("ASGI_DRAIN_TIMEOUT", "30"))
+
+HANDLER_POOL = ThreadPoolExecutor(max_workers=ASGI_HANDLER_THREADS, thread_name_prefix="update")
+PAYMENT_POOL = ThreadPoolExecutor(max_workers=ASGI_PAYMENT_THREADS, thread_name_prefix="sepay")
+
+
+def _httpx():
+    try:
+        import httpx
+    except ImportError as e:
+        raise RuntimeError("ASGI mode cần package httpx (pip install httpx)") from e
+    return httpx
+
+
+class KeyedSerial:
+    """Chạy coroutine theo key: cùng key → lần lượt theo thứ tự gửi vào, khác key → song song"""
+
+    def __init__(self):
+        self._tails = {}  # key -> task cuối cùng của key
+
+    def __len__(self):
+        return len(self._tails)
+
+    def run(self, key, fn, *args):
+        prev = self._tails.get(key)
+        task = asyncio.ensure_future(self._after(prev, fn, args))
+        self._tails[key] = task
+        task.add_done_callback(partial(self._done, key))
+        return task
+
+    @staticmethod
+    async def _after(prev, fn, args):
+        if prev is not None:
+            await asyncio.wait([prev])  # task trước lỗi cũng không chặn task sau
+        return await fn(*args)
+
+    def _done(self, key, task):
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def join(self, timeout):
+        """Chờ mọi task đang chờ / đang chạy (task cuối mỗi key chờ cả chuỗi trước nó)"""
+        deadline = time.monotonic() + timeout
+        while self._tails:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.wait(list(self._tails.values()), timeout=remaining)
+        return True
+
+
+# =========================================================
+# ASYNC TELEGRAM OUTBOX
+# =========================================================
+class AsyncOutbox:
+    """
+    Cùng giao diện OutboundQueue (submit / drain / metrics) để tg_dispatch dùng được:
+    submit() gọi từ thread handler, việc gửi chạy trên event loop.
+    """
+
+    def __init__(self, global_rate, chat_rate, chat_burst):
+        self.global_bucket = tb.TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._buckets = {}
+        self._chats = KeyedSerial()
+        self._pause_until = 0.0
+        self.loop = None
+        self.client = None
+        self.stats = {"submitted": 0, "sent": 0, "retried_429": 0, "failed": 0}
+
+    def bind(self, loop):
+        httpx = _httpx()
+        self.loop = loop
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=tb.TG_POOL_SIZE, max_keepalive_connections=tb.TG_POOL_SIZE),
+            transport=httpx.AsyncHTTPTransport(retries=tb.TG_RETRIES),
+            trust_env=False,
+        )
+
+    def submit(self, chat_key, method, payload, timeout, on_result=None, rate_limited=True):
+        job = (method, payload, timeout, on_result, rate_limited)
+        self.loop.call_soon_threadsafe(self._enqueue, chat_key, job)
+
+    def _enqueue(self, chat_key, job):
+        self.stats["submitted"] += 1
+        self._chats.run(chat_key, self._deliver, chat_key, job)
+
+    def _chat_bucket(self, chat_key):
+        bucket = self._buckets.get(chat_key)
+        if bucket is None:
+            if len(self._buckets) >= 10000:
+                self._buckets = {k: b for k, b in self._buckets.items() if not b.is_full()}
+            bucket = self._buckets[chat_key] = tb.TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _post(self, method, payload, timeout):
+        with tb.METRICS.timer("telegram_request_seconds", method=method):
+            return await self.client.post(f"{tb.BASE_URL}/{method}", data=payload, timeout=timeout)
+
+    async def _deliver(self, chat_key, job):
+        method, payload, timeout, on_result, rate_limited = job
+
+        for attempt in range(tb.TG_MAX_429_RETRIES + 1):
+            pause = self._pause_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            if rate_limited:
+                await asyncio.sleep(self._chat_bucket(chat_key).reserve())
+                await asyncio.sleep(self.global_bucket.reserve())
+
+            try:
+                r = await self._post(method, payload, timeout)
+            except Exception as e:
+                self.stats["failed"] += 1
+                tb.dprint(f"{method} error:", e)
+                return
+
+            if r.status_code in (502, 503, 504) and attempt < tb.TG_MAX_429_RETRIES:
+                await asyncio.sleep(0.3 * 2 ** attempt)
+                continue
+
+            if r.status_code == 429:
+                if attempt == tb.TG_MAX_429_RETRIES:
+                    self.stats["failed"] += 1
+                    return
+                try:
+                    retry_after = float(r.json().get("parameters", {}).get("retry_after", 1))
+                except Exception:
+                    retry_after = 1.0
+                self._pause_until = max(self._pause_until, time.monotonic() + retry_after)
+                self.stats["retried_429"] += 1
+                tb.dprint(f"{method} 429, retry after {retry_after}s")
+                continue
+
+            self.stats["sent"] += 1
+            if on_result:
+                try:
+                    on_result(r)
+                except Exception as e:
+                    tb.dprint(f"{method} callback error:", e)
+            return
+
+    async def join(self, timeout):
+        return await self._chats.join(timeout)
+
+    def drain(self, timeout=10):
+        """Gọi từ thread khác event loop (atexit, poller...)"""
+        if self.loop is None or self.loop.is_closed():
+            return True
+        future = asyncio.run_coroutine_threadsafe(self.join(timeout), self.loop)
+        return future.result(timeout + 1)
+
+    def metrics(self):
+        return dict(self.stats, pending_chats=len(self._chats))
+
+
+# =========================================================
+# ASYNC SHOPEE CLIENT
+# =========================================================
+class AsyncShopeeClient(tb.ShopeeClient):
+    """
+    ShopeeClient trên httpx.AsyncClient: save() / save_many() vẫn đồng bộ
+    (gọi từ thread handler) nhưng request chạy trên event loop.
+    """
+
+    def __init__(self, url, pool_size, timeout, retries, backoff_base, budget=None):
+        super().__init__(url, pool_size, timeout, retries, backoff_base, budget)
+        self.pool_size = pool_size
+        self.loop = None
+
+    @staticmethod
+    def _build_session(pool_size):
+        return None  # tạo httpx.AsyncClient trong bind(), khi đã có event loop
+
+    def bind(self, loop):
+        httpx = _httpx()
+        self.loop = loop
+        self.session = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            transport=httpx.AsyncHTTPTransport(retries=1),  # chỉ retry lỗi kết nối
+            trust_env=False,
+        )
+
+    async def _attempt_async(self, headers, payload, timeout):
+        httpx = _httpx()
+        try:
+            r = await self.session.post(self.url, headers=headers, json=payload, timeout=timeout)
+            # Cookie của từng user đi qua header → không giữ cookie Shopee trả về
+            self.session.cookies.clear()
+
+            if r.status_code != 200:
+                return False, f"HTTP_{r.status_code}"
+
+            js = r.json()
+            if "responses" not in js or not js["responses"]:
+                return False, "INVALID_RESPONSE"
+
+            resp = js["responses"][0]
+
+            if resp.get("error") == 0:
+                return True, "OK"
+
+            return False, f"SHOPEE_{resp.get('error')}"
+
+        except httpx.TimeoutException:
+            return False, "TIMEOUT"
+        except Exception as e:
+            return False, f"EXCEPTION_{str(e)}"
+
+    async def save_async(self, cookie, voucher, end=None):
+        start = time.perf_counter()
+        if end is None:
+            end = start + self.budget
+        try:
+            payload = self.build_payload(voucher)
+        except Exception as e:
+            return False, f"EXCEPTION_{str(e)}"
+        headers = dict(self.BASE_HEADERS, Cookie=cookie)
+
+        ok, reason = False, "TIMEOUT"
+        for attempt in range(self.retries + 1):
+            timeout = min(self.timeout, end - time.perf_counter())
+            if timeout <= 0:
+                break
+            ok, reason = await self._attempt_async(headers, payload, timeout)
+            if ok:
+                break
+            delay = self._retry_delay(attempt, reason, end)
+            if delay is None:
+                break
+            self.retried += 1
+            await asyncio.sleep(delay)
+
+        self._observe(reason, time.perf_counter() - start)
+        return ok, reason
+
+    async def save_many_async(self, cookie, vouchers, deadline):
+        end = time.perf_counter() + deadline
+        tasks = [asyncio.ensure_future(self.save_async(cookie, v, end)) for v in vouchers]
+        done, _ = await asyncio.wait(tasks, timeout=deadline)
+
+        results = []
+        for t in tasks:
+            if t not in done:
+                t.cancel()
+                results.append((False, "TIMEOUT"))
+            elif t.exception() is not None:
+                results.append((False, f"EXCEPTION_{str(t.exception())}"))
+            else:
+                results.append(t.result())
+        return results
+
+    def save(self, cookie, voucher, end=None):
+        return asyncio.run_coroutine_threadsafe(self.save_async(cookie, voucher, end), self.loop).result()
+
+    def save_many(self, cookie, vouchers, deadline):
+        future = asyncio.run_coroutine_threadsafe(self.save_many_async(cookie, vouchers, deadline), self.loop)
+        return future.result()
+
+
+# =========================================================
+# ASGI APP
+# =========================================================
+OUTBOX = AsyncOutbox(tb.TG_GLOBAL_RATE, tb.TG_CHAT_RATE, tb.TG_CHAT_BURST)
+SHOPEE = AsyncShopeeClient(tb.SAVE_URL, tb.SHOPEE_POOL_SIZE, tb.SHOPEE_TIMEOUT,
+                           tb.SHOPEE_RETRIES, tb.SHOPEE_BACKOFF_BASE, tb.SHOPEE_BUDGET)
+
+
+class AsgiBot:
+    """ASGI callable: /webhook, /webhook-sepay, /metrics, / như bản Flask"""
+
+    def __init__(self):
+        self.updates = KeyedSerial()
+        self.loop = None
+        self.stats = {"accepted": 0, "rejected": 0, "processed": 0, "failed": 0}
+
+    def startup(self):
+        if self.loop is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        OUTBOX.bind(self.loop)
+        SHOPEE.bind(self.loop)
+        # tg_dispatch / process_combo1 / save_voucher_and_check đọc các biến này lúc gọi
+        tb.TG_OUTBOX = OUTBOX
+        tb.TG_ASYNC_SEND = True
+        tb.SHOPEE = SHOPEE
+        tb.METRICS.register_gauges("tg_outbox", OUTBOX.metrics)
+        tb.METRICS.register_gauges("asgi", self.metrics)
+
+    async def shutdown(self):
+        await self.updates.join(ASGI_DRAIN_TIMEOUT)
+        await OUTBOX.join(ASGI_DRAIN_TIMEOUT)
+        await OUTBOX.client.aclose()
+        await SHOPEE.session.aclose()
+
+    def metrics(self):
+        return dict(self.stats, inflight=len(self.updates))
+
+    async def _process(self, update):
+        try:
+            await self.loop.run_in_executor(HANDLER_POOL, tb.handle_update, update)
+            self.stats["processed"] += 1
+        except Exception as e:
+            self.stats["failed"] += 1
+            print("[ASGI_UPDATE_ERROR]", update.get("update_id"), e)
+
+    async def webhook(self, body):
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return 400, "bad request"
+        if len(self.updates) >= ASGI_MAX_INFLIGHT:
+            # Quá tải → Telegram gửi lại sau
+            self.stats["rejected"] += 1
+            return 503, "busy"
+        self.stats["accepted"] += 1
+        self.updates.run(tb.update_user_key(update), self._process, update)
+        return 200, "ok"
+
+    async def webhook_sepay(self, method, body):
+        if method == "GET":
+            return 200, "OK"
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            data = {}
+        return await self.loop.run_in_executor(PAYMENT_POOL, self._sepay, data)
+
+    @staticmethod
+    def _sepay(data):
+        text, status = tb.accept_sepay(data)
+        return status, text
+
+    async def route(self, method, path, query, body):
+        if path == "/webhook" and method == "POST":
+            return await self.webhook(body)
+        if path == "/webhook-sepay" and method in ("GET", "POST"):
+            return await self.webhook_sepay(method, body)
+        if path == "/metrics" and method == "GET":
+            denied = tb.metrics_denied(parse_qs(query).get("token", [""])[0])
+            if denied:
+                return denied
+            return 200, tb.METRICS.render()
+        if path == "/" and method == "GET":
+            ready = await self.loop.run_in_executor(HANDLER_POOL, tb.store_ready)
+            return (200, "Bot is running") if ready else (500, "Bot running, Sheet ERROR")
+        return 404, "not found"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    self.startup()
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await self.shutdown()
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+
+        if scope["type"] != "http":
+            return
+        self.startup()  # server không gửi lifespan
+
+        chunks = []
+        more = True
+        while more:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            more = message.get("more_body", False)
+
+        status, text = await self.route(
+            scope["method"], scope["path"], scope.get("query_string", b"").decode(), b"".join(chunks)
+        )
+        raw = text.encode("utf-8")
+        ctype = b"text/plain; version=0.0.4; charset=utf-8" if scope["path"] == "/metrics" \
+            else b"text/html; charset=utf-8"
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", ctype), (b"content-length", str(len(raw)).encode())],
+        })
+        await send({"type": "http.response.body", "body": raw})
+
+
+app = AsgiBot()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark: SPAM_TRACKER cũ (dict + list, không bao giờ xoá) vs SpamTracker
+
+Mỗi user gây 1 lỗi, N user khác nhau, thời gian giả tăng dần:
+
+    python benchmarks/bench_spam_tracker.py [số_user] [max_users]
+
+In chi phí trung bình mỗi lỗi và bộ nhớ (tracemalloc) sau từng đoạn:
+bản cũ tăng tuyến tính theo số user, SpamTracker phẳng ở trần max_users.
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("TELEGRAM_TOKEN", "bench")
+
+import telegram_bot as tb  # noqa: E402
+
+
+def legacy_tracker():
+    tracker_map = {}
+
+    def record(user_id, now):
+        if user_id not in tracker_map:
+            tracker_map[user_id] = {"errors": [], "ban_count": 0}
+        tracker = tracker_map[user_id]
+        tracker["errors"].append(now)
+        tracker["errors"] = [t for t in tracker["errors"] if now - t < tb.SPAM_WINDOW]
+        return tracker
+
+    return record, tracker_map
+
+
+def feed(record, start, stop, clock):
+    for uid in range(start, stop):
+        clock[0] += 0.001  # 1000 lỗi / giây
+        record(uid, clock[0])
+
+
+def run(name, make, n, chunks=10):
+    """2 lượt: đo thời gian (không tracemalloc), rồi đo bộ nhớ"""
+    step = n // chunks
+
+    record, size = make()
+    clock = [0.0]
+    ns = []
+    for c in range(chunks):
+        t0 = time.perf_counter()
+        feed(record, c * step, (c + 1) * step, clock)
+        ns.append((time.perf_counter() - t0) / step * 1e9)
+    del record, size
+
+    record, size = make()
+    clock = [0.0]
+    tracemalloc.start()
+    print(f"\n{name}")
+    print(f"{'users':>10}{'ns/event':>10}{'entries':>10}{'MB':>8}")
+    for c in range(chunks):
+        feed(record, c * step, (c + 1) * step, clock)
+        mem = tracemalloc.get_traced_memory()[0] / 1e6
+        print(f"{(c + 1) * step:>10}{ns[c]:>10.0f}{size():>10}{mem:>8.1f}")
+    tracemalloc.stop()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    max_users = int(sys.argv[2]) if len(sys.argv) > 2 else tb.SPAM_TRACKER_MAX
+
+    def make_legacy():
+        record, tracker_map = legacy_tracker()
+        return record, tracker_map.__len__
+
+    def make_tracker():
+        store = tb.MemoryStateStore(max_users)
+        tracker = tb.SpamTracker(tb.SPAM_THRESHOLD, tb.SPAM_WINDOW, tb.SPAM_IDLE_TTL, store)
+        return tracker.record_error, tracker.__len__
+
+    run("dict + list (cũ)", make_legacy, n)
+    run(f"SpamTracker (max_users={max_users})", make_tracker, n)
+
+
+if __name__ == "__main__":
+    main()
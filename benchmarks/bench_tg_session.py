@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark: requests.post (kết nối mới mỗi tin) vs TG_SESSION (keep-alive)
+
+Chạy với stub server local thay cho api.telegram.org:
+
+    python benchmarks/bench_tg_session.py [số_tin]
+
+Stub chạy HTTP thường nên chỉ đo phần bắt tay TCP; với HTTPS thật
+(thêm TLS handshake) chênh lệch còn lớn hơn.
+"""
+
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class StubTelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # cho phép keep-alive
+    disable_nagle_algorithm = True  # headers + body gửi riêng, tránh delayed ACK 40ms
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        body = json.dumps({"ok": True, "result": {"message_id": 1}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubTelegramHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def measure(fn, n):
+    samples = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        fn(i)
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return {
+        "mean": statistics.mean(samples),
+        "p50": samples[len(samples) // 2],
+        "p95": samples[int(len(samples) * 0.95) - 1],
+    }
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    server = start_stub()
+    os.environ["TELEGRAM_API_ROOT"] = f"http://127.0.0.1:{server.server_port}"
+    os.environ.setdefault("TELEGRAM_TOKEN", "bench")
+
+    import telegram_bot as tb
+
+    def before(i):
+        payload = {"chat_id": 1, "text": f"msg {i}", "parse_mode": "HTML"}
+        requests.post(f"{tb.BASE_URL}/sendMessage", data=payload, timeout=15)
+
+    def after(i):
+        # tg_send giờ chỉ đưa vào TG_OUTBOX → đo thẳng lệnh gửi qua TG_SESSION
+        payload = {"chat_id": 1, "text": f"msg {i}", "parse_mode": "HTML"}
+        tb.tg_post("sendMessage", payload, 15)
+
+    # Làm nóng pool trước khi đo
+    after(0)
+
+    rows = [("requests.post", measure(before, n)), ("TG_SESSION", measure(after, n))]
+
+    print(f"{n} sendMessage / mode (ms per message)")
+    print(f"{'mode':<16}{'mean':>8}{'p50':>8}{'p95':>8}")
+    for name, r in rows:
+        print(f"{name:<16}{r['mean']:>8.3f}{r['p50']:>8.3f}{r['p95']:>8.3f}")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
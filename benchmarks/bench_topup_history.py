@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark: lịch sử nạp tiền trên tab "Nap Tien" lớn
+
+    python benchmarks/bench_topup_history.py [số_dòng] [số_user]
+
+- get_all_records (cũ): mỗi lần xem lịch sử tải + parse toàn bộ tab
+- TX_INDEX.history: tải 1 lần (get_all_values), sau đó O(k) mỗi lần xem
+
+Worksheet giả trả dữ liệu trong RAM (không có độ trễ mạng),
+nên chỉ đo phần CPU; thời gian tải thật từ Google còn lớn hơn nhiều.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("TELEGRAM_TOKEN", "bench")
+
+import telegram_bot as tb  # noqa: E402
+
+
+class FakeNapTien:
+    """Giả lập gspread Worksheet: get_all_values / get_all_records / append_row"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = 0
+
+    def get_all_values(self):
+        self.calls += 1
+        return [list(r) for r in self.rows]
+
+    def get_all_records(self):
+        self.calls += 1
+        header = self.rows[0]
+        return [dict(zip(header, r)) for r in self.rows[1:]]
+
+    def append_row(self, row, **kw):
+        self.calls += 1
+        self.rows.append([str(v) for v in row])
+
+
+def make_rows(n, users):
+    rows = [list(tb.TOPUP_COLS)]
+    for i in range(n):
+        uid = str(1_000_000 + random.randrange(users))
+        rows.append(["2025-01-01 00:00:00", uid, "", str(random.choice((20000, 50000, 100000))),
+                     "SEPAY", f"tx{i}", ""])
+    return rows
+
+
+def legacy_history(ws, user_id, limit=10):
+    rows = ws.get_all_records()
+    logs = [r for r in rows if str(r.get("Tele ID", "")) == str(user_id)]
+    return logs[-limit:]
+
+
+def timed(fn, n):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) / n * 1000
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 20_000
+    random.seed(1)
+
+    ws = FakeNapTien(make_rows(n, users))
+    tb.ws_nap_tien = ws
+    user_ids = [str(1_000_000 + random.randrange(users)) for _ in range(1000)]
+    it = iter(user_ids * 1000)
+
+    legacy_ms = timed(lambda: legacy_history(ws, next(it)), 20)
+
+    index = tb.TxIndex(history_ttl=3600)
+    t0 = time.perf_counter()
+    index.load()
+    load_ms = (time.perf_counter() - t0) * 1000
+
+    ws.calls = 0
+    index_ms = timed(lambda: index.history(next(it), 10), 10000)
+    index_calls = ws.calls
+
+    add_ms = timed(lambda: index.add(["2025-01-01 00:00:00", next(it), "", "20000", "SEPAY",
+                                      f"new{random.random()}", ""]), 10000)
+
+    print(f"{n} rows, {users} users")
+    print(f"{'operation':<34}{'ms':>10}")
+    print(f"{'get_all_records + filter / req':<34}{legacy_ms:>10.3f}")
+    print(f"{'TX_INDEX.load (1 lần)':<34}{load_ms:>10.3f}")
+    print(f"{'TX_INDEX.history / req':<34}{index_ms:>10.4f}")
+    print(f"{'TX_INDEX.add / topup':<34}{add_ms:>10.4f}")
+    print(f"API calls cho 10000 lần xem lịch sử: {index_calls}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+"""
+Harness benchmark offline cho handle_update / webhook_sepay
+
+Không đụng Google Sheets hay API thật:
+- FakeWorksheet: các lệnh gspread file bot dùng, dữ liệu trong RAM,
+  độ trễ giả lập (--sheets-latency / --sheets-jitter), đếm số lệnh gọi
+- Stub HTTP local cho api.telegram.org và endpoint save của Shopee
+- Bot chạy thật trên werkzeug (threaded) hoặc uvicorn (--server asgi,
+  asgi_app.py), harness đóng vai Telegram (POST /webhook) và SePay
+  (POST /webhook-sepay)
+
+    python benchmarks/harness.py [--mix default|promo|payments] [--requests 2000]
+        [--concurrency 8] [--sheets-latency 0.05] [--backend sheets|sqlite]
+        [--server flask|asgi]
+
+In p50/p95/p99 theo từng loại request, rps tổng và số lệnh gọi
+Sheets / Telegram / Shopee trung bình mỗi update.
+
+Client, bot và stub chạy chung 1 process (chung GIL) nên số tuyệt đối
+bi quan hơn thực tế; dùng để so sánh giữa các lần chạy / cấu hình.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SHOPEE_PATH = "/api/v2/voucher_wallet/save_vouchers"
+FIRST_USER_ID = 100000000
+
+
+# =========================================================
+# FAKE GSPREAD WORKSHEET
+# =========================================================
+def _a1(a1):
+    """"C12" -> (12, 3)"""
+    letters = a1.rstrip("0123456789")
+    col = 0
+    for ch in letters:
+        col = col * 26 + ord(ch) - 64
+    return int(a1[len(letters):] or 0), col
+
+
+class FakeWorksheet:
+    """Worksheet trong RAM, mỗi lệnh gọi = 1 "API call" có độ trễ giả lập"""
+
+    def __init__(self, title, rows, latency=0.0, jitter=0.0):
+        self.title = title
+        self.rows = [list(r) for r in rows]
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _api(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _set(self, r, c, v):
+        while len(self.rows) < r:
+            self.rows.append([])
+        row = self.rows[r - 1]
+        while len(row) < c:
+            row.append("")
+        row[c - 1] = v
+
+    def _write_range(self, range_name, values):
+        r, c = _a1(range_name.split(":")[0])
+        with self._lock:
+            for i, vals in enumerate(values):
+                for j, v in enumerate(vals):
+                    self._set(r + i, c + j, v)
+
+    # ----- đọc -----
+    def col_values(self, col):
+        self._api("col_values")
+        with self._lock:
+            return [str(r[col - 1]) if len(r) >= col else "" for r in self.rows]
+
+    def row_values(self, row):
+        self._api("row_values")
+        with self._lock:
+            return [str(v) for v in self.rows[row - 1]] if row <= len(self.rows) else []
+
+    def cell(self, row, col):
+        self._api("cell")
+        with self._lock:
+            r = self.rows[row - 1] if row <= len(self.rows) else []
+            return type("Cell", (), {"value": r[col - 1] if len(r) >= col else None})()
+
+    def get_all_values(self):
+        self._api("get_all_values")
+        with self._lock:
+            return [[str(v) for v in r] for r in self.rows]
+
+    def get_all_records(self):
+        self._api("get_all_records")
+        with self._lock:
+            header, body = self.rows[0], [list(r) for r in self.rows[1:]]
+        out = []
+        for r in body:
+            r = r + [""] * (len(header) - len(r))
+            out.append({k: (int(v) if isinstance(v, str) and v.isdigit() else v) for k, v in zip(header, r)})
+        return out
+
+    def batch_get(self, ranges, **kw):
+        self._api("batch_get")
+        out = []
+        with self._lock:
+            for rng in ranges:
+                start, _, end = rng.partition(":")
+                r, c = _a1(start)
+                c2 = _a1(end or start)[1]
+                values = []
+                for row in self.rows[r - 1:]:
+                    cells = [str(v) for v in row[c - 1:c2]]
+                    while cells and cells[-1] == "":
+                        cells.pop()
+                    values.append(cells)
+                while values and not values[-1]:
+                    values.pop()
+                out.append(values)
+        return out
+
+    # ----- ghi -----
+    def update_cell(self, row, col, value):
+        self._api("update_cell")
+        with self._lock:
+            self._set(row, col, value)
+
+    def update(self, range_name=None, values=None, **kw):
+        self._api("update")
+        self._write_range(range_name, values)
+
+    def batch_update(self, data, **kw):
+        self._api("batch_update")
+        for d in data:
+            self._write_range(d["range"], d["values"])
+
+    def append_row(self, values, **kw):
+        self._api("append_row")
+        with self._lock:
+            self.rows.append(list(values))
+            n = len(self.rows)
+        return {"updates": {"updatedRange": f"'{self.title}'!A{n}:G{n}"}}
+
+    def append_rows(self, rows, **kw):
+        self._api("append_rows")
+        with self._lock:
+            self.rows.extend(list(r) for r in rows)
+        return {}
+
+
+def make_sheets(users, topups_per_user=2, latency=0.0, jitter=0.0):
+    money = [["Tele ID", "Username", "Số dư", "Trạng thái", "Nguồn", "Ghi Chú"]]
+    nap = [["time", "Tele ID", "username", "số tiền", "loại", "tx_id", "note"]]
+    for i in range(users):
+        uid = str(FIRST_USER_ID + i)
+        money.append([uid, f"u{i}", "1000000000", "active", "auto từ bot", ""])
+        for j in range(topups_per_user):
+            nap.append(["2025-01-01 00:00:00", uid, "", "50000", "SEPAY", f"seed-{i}-{j}", ""])
+    voucher = [
+        ["Tên Mã", "Giá", "Trạng Thái", "Combo", "Promotionid", "CODE", "Signature"],
+        ["voucher100k", "1000", "Còn Mã", "combo1", "1", "C1", "s1"],
+        ["voucherHoaToc", "1000", "Còn Mã", "combo1", "2", "C2", "s2"],
+        ["voucher50max200", "1000", "Còn Mã", "combo1", "3", "C3", "s3"],
+    ]
+    log = [["time", "id", "user", "action", "value", "note"]]
+    return {
+        "money": FakeWorksheet("Thanh Toan", money, latency, jitter),
+        "voucher": FakeWorksheet("VoucherStock", voucher, latency, jitter),
+        "log": FakeWorksheet("Logs", log, latency, jitter),
+        "nap_tien": FakeWorksheet("Nap Tien", nap, latency, jitter),
+    }
+
+
+def install_sheets(tb, sheets):
+    """Gắn worksheet giả vào bot (qua SHEETS_GATEWAY như khi kết nối thật)"""
+    gated = {k: tb.GatedWorksheet(ws) for k, ws in sheets.items()}
+    tb.ws_money, tb.ws_voucher = gated["money"], gated["voucher"]
+    tb.ws_log, tb.ws_nap_tien = gated["log"], gated["nap_tien"]
+    tb.SHEET_READY = True
+    tb.SHEETS.ready = True
+
+
+def sheet_calls(sheets):
+    total = Counter()
+    for ws in sheets.values():
+        total.update(ws.calls)
+    return total
+
+
+# =========================================================
+# STUB TELEGRAM + SHOPEE
+# =========================================================
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive như API thật
+    disable_nagle_algorithm = True  # tránh delayed ACK 40ms
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        server = self.server
+        if self.path.startswith(SHOPEE_PATH):
+            server.count("shopee")
+            delay, body = server.shopee_latency, {"responses": [{"error": 0}]}
+        else:
+            server.count("telegram:" + self.path.rsplit("/", 1)[-1])
+            delay, body = server.tg_latency, {"ok": True, "result": {"message_id": 1}}
+        if delay:
+            time.sleep(delay)
+        raw = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, tg_latency=0.0, shopee_latency=0.0):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.tg_latency = tg_latency
+        self.shopee_latency = shopee_latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def configure_env(stub, backend="sheets", unlimited_quota=True):
+    """Phải gọi trước khi import telegram_bot"""
+    tmp = tempfile.mkdtemp()
+    os.environ.update(
+        TELEGRAM_TOKEN="bench",
+        TELEGRAM_API_ROOT=stub.url,
+        SHOPEE_SAVE_URL=stub.url + SHOPEE_PATH,
+        GOOGLE_SHEETS_CREDS_JSON="{}",
+        STORAGE_BACKEND=backend,
+        SQLITE_PATH=os.path.join(tmp, "bench.db"),
+        SEPAY_INBOX_PATH=os.path.join(tmp, "sepay_inbox.db"),
+        # Stub không giới hạn tốc độ như Telegram thật → đo phần bot
+        TG_GLOBAL_RATE="100000",
+        TG_CHAT_RATE="100000",
+        TG_CHAT_BURST="1000",
+        METRICS_SLOW_UPDATE="1000000",  # không in trace update chậm khi cố tình giả lập độ trễ
+    )
+    if unlimited_quota:
+        os.environ.update(SHEETS_READ_PER_MIN="1000000", SHEETS_WRITE_PER_MIN="1000000",
+                          SHEETS_BURST="1000")
+
+
+def load_bot(stub, sheets, backend="sheets", unlimited_quota=True):
+    configure_env(stub, backend, unlimited_quota)
+    import telegram_bot as tb
+    tb.DEBUG = False
+    install_sheets(tb, sheets)
+    tb.store_ready()  # sqlite: seed từ Sheet giả trước khi đo
+    return tb
+
+
+# =========================================================
+# TRAFFIC
+# =========================================================
+MIXES = {
+    "default":  {"balance": 35, "history": 10, "voucher": 20, "combo": 5, "start": 10, "sepay": 20},
+    "promo":    {"balance": 20, "voucher": 55, "combo": 20, "sepay": 5},
+    "payments": {"balance": 20, "history": 10, "sepay": 70},
+}
+
+
+class Traffic:
+    """Sinh request tổng hợp: (loại, path, json body)"""
+
+    def __init__(self, users, mix, seed=1):
+        self.users = users
+        self.kinds, self.weights = zip(*MIXES[mix].items())
+        self.rng = random.Random(seed)
+        self.update_id = 0
+        self.tx = 0
+        self._lock = threading.Lock()
+
+    def _message(self, user_id, text):
+        with self._lock:
+            self.update_id += 1
+            uid = self.update_id
+        return "/webhook", {
+            "update_id": uid,
+            "message": {
+                "message_id": uid,
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "username": f"u{user_id}"},
+                "text": text,
+            },
+        }
+
+    def next(self):
+        with self._lock:
+            kind = self.rng.choices(self.kinds, self.weights)[0]
+            user_id = FIRST_USER_ID + self.rng.randrange(self.users)
+            self.tx += 1
+            tx = self.tx
+        if kind == "balance":
+            return (kind,) + self._message(user_id, "💰 Số dư")
+        if kind == "history":
+            return (kind,) + self._message(user_id, "📜 Lịch sử nạp tiền")
+        if kind == "voucher":
+            return (kind,) + self._message(user_id, "/voucher100k SPC_EC=bench")
+        if kind == "combo":
+            return (kind,) + self._message(user_id, "/combo1 SPC_EC=bench")
+        if kind == "start":
+            return (kind,) + self._message(user_id, "/start")
+        return kind, "/webhook-sepay", {
+            "id": f"bench-{tx}-{time.time_ns()}",
+            "transferAmount": 50000,
+            "content": f"SEVQR NAP {user_id}",
+        }
+
+
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return 0.0
+    k = min(len(sorted_samples) - 1, max(0, int(round(p / 100.0 * len(sorted_samples))) - 1))
+    return sorted_samples[k]
+
+
+def replay(base_url, traffic, n, concurrency):
+    """Gửi n request với concurrency luồng, return (samples theo loại, giây, lỗi HTTP)"""
+    samples = defaultdict(list)
+    errors = Counter()
+    local = threading.local()
+    lock = threading.Lock()
+
+    def one(_):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+            session.trust_env = False  # bỏ quét biến môi trường proxy (~2ms / request)
+        kind, path, body = traffic.next()
+        t0 = time.perf_counter()
+        r = session.post(base_url + path, json=body, timeout=120)
+        ms = (time.perf_counter() - t0) * 1000
+        with lock:
+            samples[kind].append(ms)
+            if r.status_code != 200:
+                errors[f"{kind}:{r.status_code}"] += 1
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(one, range(n)))
+    return samples, time.perf_counter() - t0, errors
+
+
+def report(title, samples, elapsed, n, api_calls, errors):
+    print(f"\n=== {title} ===")
+    print(f"{'request':<10}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean':>10}")
+    everything = []
+    for kind in sorted(samples):
+        s = sorted(samples[kind])
+        everything.extend(s)
+        print(f"{kind:<10}{len(s):>7}{percentile(s, 50):>10.2f}{percentile(s, 95):>10.2f}"
+              f"{percentile(s, 99):>10.2f}{statistics.mean(s):>10.2f}")
+    everything.sort()
+    print(f"{'ALL':<10}{len(everything):>7}{percentile(everything, 50):>10.2f}"
+          f"{percentile(everything, 95):>10.2f}{percentile(everything, 99):>10.2f}"
+          f"{statistics.mean(everything):>10.2f}")
+    print(f"throughput: {n / elapsed:.1f} req/s ({elapsed:.2f}s)")
+    if errors:
+        print(f"HTTP errors: {dict(errors)}")
+
+    print("API calls / update:")
+    for group, calls in api_calls.items():
+        total = sum(calls.values())
+        detail = ", ".join(f"{k}={v / n:.2f}" for k, v in calls.most_common())
+        print(f"  {group:<9}{total / n:>6.2f}   {detail}")
+
+
+def serve_app(app):
+    import logging
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class Handler(WSGIRequestHandler):
+        disable_nagle_algorithm = True  # keep-alive + Nagle → +40ms mỗi request
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def serve_asgi(asgi_app):
+    """uvicorn trong thread riêng (cần uvicorn + httpx)"""
+    import uvicorn
+
+    config = uvicorn.Config(asgi_app, host="127.0.0.1", port=0, log_level="error", lifespan="on")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, f"http://127.0.0.1:{port}"
+
+
+def wait_processed(tb, asgi_app, timeout=300):
+    """ASGI / SePay inbox ack trước khi xử lý → chờ xử lý hết những gì đã nhận"""
+    import asyncio
+
+    if asgi_app is not None:
+        asyncio.run_coroutine_threadsafe(asgi_app.updates.join(timeout), asgi_app.loop).result()
+    deadline = time.monotonic() + timeout
+    while tb.SEPAY_INBOX is not None and tb.SEPAY_INBOX.metrics()["pending"]:
+        if time.monotonic() > deadline:
+            break
+        time.sleep(0.01)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--mix", default="default", choices=sorted(MIXES))
+    ap.add_argument("--requests", type=int, default=2000)
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--users", type=int, default=1000)
+    ap.add_argument("--backend", default="sheets", choices=("sheets", "sqlite"))
+    ap.add_argument("--sheets-latency", type=float, default=0.0, help="giây / lệnh Sheets")
+    ap.add_argument("--sheets-jitter", type=float, default=0.0)
+    ap.add_argument("--tg-latency", type=float, default=0.0)
+    ap.add_argument("--shopee-latency", type=float, default=0.0)
+    ap.add_argument("--real-quota", action="store_true", help="giữ quota Sheets 60/phút như thật")
+    ap.add_argument("--server", default="flask", choices=("flask", "asgi"))
+    args = ap.parse_args()
+
+    stub = StubServer(args.tg_latency, args.shopee_latency).start()
+    sheets = make_sheets(args.users, latency=args.sheets_latency, jitter=args.sheets_jitter)
+    tb = load_bot(stub, sheets, args.backend, unlimited_quota=not args.real_quota)
+    asgi_app = None
+    if args.server == "asgi":
+        import asgi_app as asgi_module
+        asgi_app = asgi_module.app
+        server, base_url = serve_asgi(asgi_app)
+    else:
+        server, base_url = serve_app(tb.app)
+
+    traffic = Traffic(args.users, args.mix)
+    # Làm nóng: index user, VoucherStock, TX_INDEX, ban registry
+    replay(base_url, traffic, 50, 1)
+    wait_processed(tb, asgi_app)
+    tb.TG_OUTBOX.drain(60)
+    sheet_before, stub_before = sheet_calls(sheets), Counter(stub.calls)
+
+    t0 = time.perf_counter()
+    samples, elapsed, errors = replay(base_url, traffic, args.requests, args.concurrency)
+    wait_processed(tb, asgi_app)
+    processed = time.perf_counter() - t0
+    tb.TG_OUTBOX.drain(60)
+
+    sheets_used = sheet_calls(sheets) - sheet_before
+    stub_used = Counter(stub.calls) - stub_before
+    api_calls = {
+        "sheets": sheets_used,
+        "telegram": Counter({k.split(":", 1)[1]: v for k, v in stub_used.items() if k.startswith("telegram:")}),
+        "shopee": Counter({"save": stub_used["shopee"]}),
+    }
+    title = (f"server={args.server} mix={args.mix} backend={args.backend} n={args.requests} "
+             f"c={args.concurrency} sheets_latency={args.sheets_latency * 1000:.0f}ms")
+    report(title, samples, elapsed, args.requests, api_calls, errors)
+    if asgi_app is not None:
+        server.should_exit = True
+    else:
+        server.shutdown()
+    if asgi_app is not None or tb.SEPAY_INBOX is not None:
+        print(f"processed: {args.requests / processed:.1f} updates/s ({processed:.2f}s, ack xong trước khi xử lý)")
+    stub.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -11,11 +11,31 @@ NgânMiu.Store — Telegram Bot
 import os
 import json
 import re
+import sqlite3
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta, timezone
 from flask import Flask, request
 import urllib.parse
+import http.cookiejar
+import hashlib
+import hmac
+import tempfile
 import time
+import random
+import threading
+import queue
+import heapq
+import itertools
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+import atexit
+from array import array
+from dataclasses import dataclass
+from functools import wraps
+from bisect import bisect_left
+from contextlib import contextmanager
 
 # =========================================================
 # TIMEZONE VIETNAM (GMT+7)
@@ -31,12 +51,6 @@ try:
 except Exception:
     pass
 
-# =========================================================
-# GOOGLE SHEET
-# =========================================================
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-
 # =========================================================
 # APP
 # =========================================================
@@ -50,8 +64,14 @@ SHEET_ID   = os.getenv("GOOGLE_SHEET_ID", "").strip()
 CREDS_JSON = os.getenv("GOOGLE_SHEETS_CREDS_JSON", "").strip()
 ADMIN_ID   = int(os.getenv("ADMIN_TELEGRAM_ID", "0"))
 
-BASE_URL = f"https://api.telegram.org/bot{BOT_TOKEN}"
-SAVE_URL = "https://shopee.vn/api/v2/voucher_wallet/save_vouchers"
+# Vercel đóng băng process sau khi trả response → tắt các worker nền mặc định
+ON_VERCEL  = bool(os.getenv("VERCEL"))
+# Thư mục file dữ liệu của bot (inbox SePay...): không phụ thuộc thư mục đang chạy
+BOT_DATA_DIR = os.getenv("BOT_DATA_DIR", "/tmp" if ON_VERCEL else os.path.dirname(os.path.abspath(__file__)))
+
+TG_API_ROOT = os.getenv("TELEGRAM_API_ROOT", "https://api.telegram.org").rstrip("/")
+BASE_URL = f"{TG_API_ROOT}/bot{BOT_TOKEN}"
+SAVE_URL = os.getenv("SHOPEE_SAVE_URL", "https://shopee.vn/api/v2/voucher_wallet/save_vouchers")
 
 # =========================================================
 # TOPUP RULES (SEPAY)
@@ -89,6 +109,10 @@ def build_sepay_qr(user_id, amount=None):
 SPAM_THRESHOLD = 15      # 15 lỗi
 SPAM_WINDOW = 60         # trong 60 giây
 BAN_DURATION_1H = 3600   # 1 giờ
+BAN_REGISTRY_TTL = int(os.getenv("BAN_REGISTRY_TTL", "300"))  # nạp lại cột F (staff sửa tay)
+BAN_REGISTRY_RETRY = int(os.getenv("BAN_REGISTRY_RETRY", "10"))  # nạp lỗi → thử lại sau (giây)
+SPAM_IDLE_TTL    = int(os.getenv("SPAM_IDLE_TTL", "86400"))     # quên user im lặng quá lâu
+SPAM_TRACKER_MAX = int(os.getenv("SPAM_TRACKER_MAX", "100000"))  # trần số user theo dõi
 
 # =========================================================
 # DEBUG FLAG
@@ -100,7 +124,239 @@ def dprint(*args):
         print("[DEBUG]", *args)
 
 # =========================================================
-# GOOGLE SHEET CONNECT WITH RETRY
+# METRICS (Prometheus /metrics + trace từng update)
+# =========================================================
+METRICS_ENABLED     = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_TOKEN       = os.getenv("METRICS_TOKEN", "").strip()     # /metrics cần ?token=; trống → tắt /metrics
+METRICS_SLOW_UPDATE = float(os.getenv("METRICS_SLOW_UPDATE", "3"))  # update chậm hơn → in trace
+
+class LatencyHistogram:
+    """Histogram latency (giây) với bucket cố định, thread-safe"""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # phần tử cuối = +Inf
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def quantile(self, q):
+        """Ước lượng quantile theo cận trên của bucket"""
+        with self._lock:
+            if not self.count:
+                return 0.0
+            target = q * self.count
+            seen = 0
+            for i, c in enumerate(self.counts):
+                seen += c
+                if seen >= target:
+                    return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+# Bucket cho stage nội bộ (tra RAM ~µs) tới lệnh mạng (giây)
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50)   # số lệnh Sheets / update
+
+class Metrics:
+    """
+    Registry counter + histogram (LatencyHistogram) theo (tên, nhãn),
+    render dạng text Prometheus. gauges: hàm metrics() của các thành phần nền.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.counters = {}      # (name, labels) -> float
+        self.histograms = {}    # (name, labels) -> LatencyHistogram
+        self.gauges = {}        # prefix -> fn() -> dict
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        # 1 nhãn (đa số) → khỏi sort
+        return (name, tuple(labels.items()) if len(labels) < 2 else tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name, buckets=STAGE_BUCKETS, **labels):
+        key = self._key(name, labels)
+        hist = self.histograms.get(key)
+        if hist is None:
+            with self._lock:
+                hist = self.histograms.setdefault(key, LatencyHistogram(buckets))
+        return hist
+
+    def observe(self, name, value, buckets=STAGE_BUCKETS, **labels):
+        if self.enabled:
+            self.histogram(name, buckets, **labels).observe(value)
+
+    def timer(self, name, **labels):
+        """with METRICS.timer(...): đo + ghi stage vào trace của update hiện tại"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self.histogram(name, **labels), labels.get("stage") or labels.get("method") or name)
+
+    def timed(self, name, **labels):
+        """Decorator: đo thời gian hàm (histogram tra 1 lần lúc decorate)"""
+        def deco(fn):
+            hist = self.histogram(name, **labels)
+            stage = labels.get("stage") or fn.__name__
+
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with _Timer(hist, stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return deco
+
+    def register_gauges(self, prefix, fn):
+        self.gauges[prefix] = fn
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v).replace(chr(34), "")}"' for k, v in items) + "}"
+
+    def render(self):
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+
+        for (name, labels), hist in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            with hist._lock:
+                counts, total, count = list(hist.counts), hist.sum, hist.count
+            cumulative = 0
+            for bound, c in zip(list(hist.buckets) + ["+Inf"], counts):
+                cumulative += c
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+
+        for prefix, fn in sorted(self.gauges.items()):
+            try:
+                values = fn() or {}
+            except Exception as e:
+                dprint(f"metrics gauge {prefix} error:", e)
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{prefix}_{key}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+# Context manager dạng class (__slots__): rẻ hơn @contextmanager vài µs / lần
+class _Timer:
+    __slots__ = ("hist", "stage", "t0")
+
+    def __init__(self, hist, stage):
+        self.hist = hist
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.t0
+        self.hist.observe(seconds)
+        trace = getattr(_trace_local, "trace", None)
+        if trace is not None:
+            trace.stage(self.stage, seconds)
+        return False
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+METRICS = Metrics(METRICS_ENABLED)
+
+_trace_local = threading.local()
+
+def current_trace():
+    return getattr(_trace_local, "trace", None)
+
+def set_trace_branch(branch):
+    trace = current_trace()
+    if trace is not None:
+        trace.branch = branch
+
+class update_trace:
+    """
+    with update_trace(branch): bao 1 update → bot_update_seconds{branch},
+    số lệnh Sheets / update, in trace các stage nếu chậm hơn METRICS_SLOW_UPDATE.
+    """
+    __slots__ = ("branch", "started", "sheets_calls", "stages")
+
+    _hists = {}  # branch -> (bot_update_seconds, bot_update_sheets_calls), khỏi tra nhãn mỗi update
+
+    def __init__(self, branch):
+        self.branch = branch
+        self.sheets_calls = 0
+        self.stages = []
+
+    def stage(self, name, seconds):
+        if len(self.stages) < 50:
+            self.stages.append((name, seconds))
+
+    def __enter__(self):
+        if METRICS.enabled:
+            _trace_local.trace = self
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if not METRICS.enabled:
+            return False
+        _trace_local.trace = None
+        seconds = time.perf_counter() - self.started
+        hists = self._hists.get(self.branch)
+        if hists is None:
+            hists = self._hists[self.branch] = (
+                METRICS.histogram("bot_update_seconds", branch=self.branch),
+                METRICS.histogram("bot_update_sheets_calls", COUNT_BUCKETS, branch=self.branch),
+            )
+        hists[0].observe(seconds)
+        hists[1].observe(self.sheets_calls)
+        if seconds > METRICS_SLOW_UPDATE:
+            stages = ", ".join(f"{n}={t * 1000:.0f}ms" for n, t in self.stages)
+            print(f"[SLOW_UPDATE] {self.branch} {seconds * 1000:.0f}ms sheets={self.sheets_calls} | {stages}")
+        return False
+
+# =========================================================
+# GOOGLE SHEET CONNECT (lazy, thread-safe, retry nền)
 # =========================================================
 SHEET_READY = False
 ws_money    = None
@@ -113,75 +369,781 @@ scope = [
     "https://www.googleapis.com/auth/drive"
 ]
 
-MAX_RETRIES = 3
-retry_count = 0
-connected = False
+SHEETS_RETRY_BASE      = 2    # 2s, 4s, 8s, ...
+SHEETS_RETRY_MAX       = 60
+SHEETS_ERROR_THRESHOLD = 5    # ≥5 lỗi trong SHEETS_ERROR_WINDOW giây → kết nối lại
+SHEETS_ERROR_WINDOW    = 60
+
+class SheetsClient:
+    """
+    Kết nối Google Sheets khi dùng lần đầu (import không chặn).
+    - Kết nối lỗi → retry nền với backoff, trong lúc đó sheets_ready() = False
+    - Lệnh Sheets lỗi dồn dập (report_error) → kết nối lại, giữ worksheet cũ tới khi xong
+    - timings: thời gian từng bước của lần kết nối gần nhất
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.failures = 0
+        self.last_error = None
+        self.timings = {}
+        self._lock = threading.Lock()
+        self._next_retry_at = 0.0
+        self._retry_thread = None
+        self._errors = deque()
+
+    def connect(self):
+        global SHEET_READY, ws_money, ws_voucher, ws_log, ws_nap_tien
 
-while retry_count < MAX_RETRIES and not connected:
-    try:
         if not CREDS_JSON:
             raise Exception("CREDS_JSON is empty")
 
-        print(f"🔄 Connecting to Google Sheets (attempt {retry_count + 1}/{MAX_RETRIES})...")
+        print(f"🔄 Connecting to Google Sheets (attempt {self.failures + 1})...")
+        timings = {}
         start_time = time.time()
 
+        def step(name):
+            timings[name] = round(time.time() - start_time, 3)
+            return timings[name]
+
+        import gspread
+        from oauth2client.service_account import ServiceAccountCredentials
+        print(f"✅ Step 0: Libraries imported ({step('import'):.2f}s)")
+
         creds = ServiceAccountCredentials.from_json_keyfile_dict(
             json.loads(CREDS_JSON),
             scope
         )
-        print(f"✅ Step 1: Credentials loaded ({time.time()-start_time:.2f}s)")
+        print(f"✅ Step 1: Credentials loaded ({step('credentials'):.2f}s)")
 
         gc = gspread.authorize(creds)
-        print(f"✅ Step 2: Gspread authorized ({time.time()-start_time:.2f}s)")
+        print(f"✅ Step 2: Gspread authorized ({step('authorize'):.2f}s)")
 
         sh = gc.open_by_key(SHEET_ID)
-        print(f"✅ Step 3: Sheet opened ({time.time()-start_time:.2f}s)")
+        print(f"✅ Step 3: Sheet opened ({step('open'):.2f}s)")
 
-        ws_money   = sh.worksheet("Thanh Toan")
-        ws_voucher = sh.worksheet("VoucherStock")
-        ws_log     = sh.worksheet("Logs")
-        print(f"✅ Step 4: Core worksheets loaded ({time.time()-start_time:.2f}s)")
+        money   = sh.worksheet("Thanh Toan")
+        voucher = sh.worksheet("VoucherStock")
+        log     = sh.worksheet("Logs")
+        print(f"✅ Step 4: Core worksheets loaded ({step('worksheets'):.2f}s)")
 
         try:
-            ws_nap_tien = sh.worksheet("Nap Tien")
-            print(f"✅ Step 5: Nap Tien loaded ({time.time()-start_time:.2f}s)")
+            nap_tien = sh.worksheet("Nap Tien")
+            print(f"✅ Step 5: Nap Tien loaded ({step('nap_tien'):.2f}s)")
         except Exception as e:
-            ws_nap_tien = None
+            nap_tien = None
             print(f"⚠️ Nap Tien tab not found: {e}")
 
+        ws_money, ws_voucher, ws_log = GatedWorksheet(money), GatedWorksheet(voucher), GatedWorksheet(log)
+        ws_nap_tien = GatedWorksheet(nap_tien) if nap_tien is not None else None
         SHEET_READY = True
-        connected = True
+        self.ready = True
+        self.failures = 0
+        self.last_error = None
+        self.timings = timings
         print("=" * 60)
         print("✅ ✅ ✅ GOOGLE SHEETS CONNECTED SUCCESSFULLY!")
         print("=" * 60)
 
-    except Exception as e:
-        retry_count += 1
-        wait_time = 2 ** retry_count  # 2s, 4s, 8s
-        
+    def _on_failure(self, e, spawn_retry=True):
+        self.failures += 1
+        self.last_error = f"{type(e).__name__}: {e}"
+        delay = min(SHEETS_RETRY_MAX, SHEETS_RETRY_BASE ** self.failures)
+        self._next_retry_at = time.time() + delay
+
         print("=" * 60)
-        print(f"❌ Connection failed (attempt {retry_count}/{MAX_RETRIES})")
-        print(f"❌ Error: {str(e)}")
-        print(f"❌ Error type: {type(e).__name__}")
-        
-        if retry_count < MAX_RETRIES:
-            print(f"⏳ Retrying in {wait_time}s...")
-            time.sleep(wait_time)
-        else:
-            print("❌ ❌ ❌ ALL RETRIES FAILED - SHEET_READY = False")
-            import traceback
-            traceback.print_exc()
-            print("=" * 60)
-            SHEET_READY = False
+        print(f"❌ Connection failed (attempt {self.failures})")
+        print(f"❌ Error: {self.last_error}")
+        print(f"⏳ Retrying in {delay}s...")
+        print("=" * 60)
+
+        # Vercel đóng băng thread nền → request sau tự retry khi tới hạn
+        if spawn_retry and not ON_VERCEL:
+            self._retry_thread = threading.Thread(target=self._retry_loop, name="sheets-retry", daemon=True)
+            self._retry_thread.start()
+
+    def _retry_loop(self):
+        while not self.ready:
+            time.sleep(max(0.0, self._next_retry_at - time.time()))
+            with self._lock:
+                try:
+                    self.connect()
+                except Exception as e:
+                    self._on_failure(e, spawn_retry=False)
+
+    def ensure(self):
+        if self.ready:
+            return True
+        if self._retry_thread and self._retry_thread.is_alive():
+            return False
+        if time.time() < self._next_retry_at:
+            return False
+        with self._lock:
+            if self.ready:
+                return True
+            try:
+                self.connect()
+            except Exception as e:
+                self._on_failure(e)
+        return self.ready
+
+    def report_error(self, e):
+        """Một lệnh Sheets bị lỗi; lỗi dồn dập → kết nối lại (token hết hạn, ...)"""
+        if isinstance(e, SheetsUnavailable):
+            return  # hết quota, không phải lỗi kết nối
+        now = time.time()
+        self._errors.append(now)
+        while self._errors and now - self._errors[0] > SHEETS_ERROR_WINDOW:
+            self._errors.popleft()
+        if len(self._errors) < SHEETS_ERROR_THRESHOLD or not self.ready:
+            return
+        if not self._lock.acquire(blocking=False):
+            return  # thread khác đang kết nối lại
+        try:
+            self._errors.clear()
+            print(f"⚠️ {SHEETS_ERROR_THRESHOLD} Sheets errors in {SHEETS_ERROR_WINDOW}s, reconnecting: {e}")
+            try:
+                self.connect()  # worksheet cũ vẫn được dùng trong lúc chờ
+            except Exception as ce:
+                print(f"❌ Sheets reconnect failed: {ce}")
+        finally:
+            self._lock.release()
+
+SHEETS = SheetsClient()
+
+def sheets_ready():
+    """True nếu đã kết nối Sheets (kết nối lần đầu khi được gọi)"""
+    return SHEETS.ensure()
+
+def sheet_error(where, e):
+    dprint(f"{where} error:", e)
+    SHEETS.report_error(e)
+
+# =========================================================
+# STATE STORE (TTL, dùng chung giữa các instance)
+# =========================================================
+# memory: dict trong process (1 instance)
+# sqlite: 1 file cho mọi worker trên cùng máy (gunicorn -w N)
+# redis : nhiều máy / Vercel (cần package redis, REDIS_URL)
+REDIS_URL         = os.getenv("REDIS_URL", "").strip()
+STATE_BACKEND     = os.getenv("STATE_BACKEND", "redis" if REDIS_URL else "memory").strip().lower()
+STATE_SQLITE_PATH = os.getenv("STATE_SQLITE_PATH", "bot_state.db")
+STATE_MAX_KEYS    = int(os.getenv("STATE_MAX_KEYS", "100000"))  # trần key / namespace (memory)
+PENDING_TTL       = int(os.getenv("PENDING_TTL", "600"))        # chờ cookie tối đa 10 phút
+UPDATE_DEDUP_TTL  = int(os.getenv("UPDATE_DEDUP_TTL", "86400"))  # Telegram giữ / gửi lại update tối đa 24h
+UPDATE_CLAIM_TTL  = int(os.getenv("UPDATE_CLAIM_TTL", "300"))    # lease lúc đang xử lý: crash → hết hạn, chạy lại được
+UPDATE_DEDUP_MAX  = int(os.getenv("UPDATE_DEDUP_MAX", "50000"))  # trần update_id nhớ được (memory)
+
+def sqlite_connect(path):
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+def _state_encode(value):
+    # Object (vd SpamEntry) tự chuyển sang list/dict qua to_state()
+    return json.dumps(value, default=lambda o: o.to_state(), separators=(",", ":"))
+
+class MemoryStateStore:
+    """
+    key -> (expires_at, value) theo thứ tự ghi (OrderedDict).
+    Key hết hạn bị xoá khi đọc tới hoặc khi nằm đầu hàng;
+    không bao giờ quá max_keys (bỏ key ghi lâu nhất).
+    """
+
+    name = "memory"
+
+    def __init__(self, max_keys=STATE_MAX_KEYS):
+        self.max_keys = max_keys
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _live(self, key, now):
+        item = self._data.get(key)
+        if item is not None and item[0] <= now:
+            del self._data[key]
+            return None
+        return item
+
+    def _put(self, key, value, ttl, now):
+        self._data[key] = (now + ttl, value)
+        self._data.move_to_end(key)
+        data = self._data
+        while data:
+            expires_at = next(iter(data.values()))[0]
+            if expires_at > now and len(data) <= self.max_keys:
+                break
+            data.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._live(key, time.time())
+        return default if item is None else item[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._put(key, value, ttl, time.time())
+
+    def set_if_absent(self, key, value, ttl):
+        """True nếu key chưa có (hoặc đã hết hạn) và vừa được ghi"""
+        now = time.time()
+        with self._lock:
+            if self._live(key, now) is not None:
+                return False
+            self._put(key, value, ttl, now)
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._live(key, time.time())
+            if item is None:
+                return default
+            del self._data[key]
+            return item[1]
+
+    def delete(self, key):
+        self.pop(key)
+
+    def update(self, key, fn, ttl):
+        """Đọc-sửa-ghi nguyên tử: value = fn(value cũ / None), gia hạn ttl"""
+        now = time.time()
+        with self._lock:
+            item = self._live(key, now)
+            value = fn(None if item is None else item[1])
+            self._put(key, value, ttl, now)
+            return value
+
+class SQLiteStateStore:
+    """Bảng key/value/expires_at trong 1 file SQLite (WAL) dùng chung giữa các process"""
+
+    name = "sqlite"
+    PURGE_EVERY = 500   # số lần ghi giữa 2 lần xoá key hết hạn
+
+    def __init__(self, path, namespace):
+        self.path = path
+        self.table = f"state_{namespace}"
+        self._local = threading.local()
+        self._writes = 0
+        self._conn().executescript(f"""
+        CREATE TABLE IF NOT EXISTS {self.table} (
+            key        TEXT PRIMARY KEY,
+            value      TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS {self.table}_exp ON {self.table}(expires_at);
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite_connect(self.path)
+        return conn
+
+    @contextmanager
+    def _tx(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (time.time(),))
+
+    def __len__(self):
+        return self._conn().execute(
+            f"SELECT COUNT(*) FROM {self.table} WHERE expires_at > ?", (time.time(),)
+        ).fetchone()[0]
+
+    def _read(self, conn, key):
+        r = conn.execute(
+            f"SELECT value FROM {self.table} WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return None if r is None else json.loads(r["value"])
+
+    def get(self, key, default=None):
+        value = self._read(self._conn(), key)
+        return default if value is None else value
+
+    def set(self, key, value, ttl):
+        with self._tx() as conn:
+            conn.execute(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)",
+                         (key, _state_encode(value), time.time() + ttl))
+
+    def set_if_absent(self, key, value, ttl):
+        now = time.time()
+        with self._tx() as conn:
+            cur = conn.execute(
+                f"INSERT INTO {self.table} VALUES (?, ?, ?) "
+                f"ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+                f"WHERE {self.table}.expires_at <= ?",
+                (key, _state_encode(value), now + ttl, now))
+            return cur.rowcount == 1
+
+    def pop(self, key, default=None):
+        with self._tx() as conn:
+            value = self._read(conn, key)
+            conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        return default if value is None else value
+
+    def delete(self, key):
+        with self._tx() as conn:
+            conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def update(self, key, fn, ttl):
+        with self._tx() as conn:
+            value = fn(self._read(conn, key))
+            conn.execute(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)",
+                         (key, _state_encode(value), time.time() + ttl))
+        return value
+
+class RedisStateStore:
+    """Redis (hoặc server nói giao thức Redis) dùng chung giữa mọi instance"""
+
+    name = "redis"
+
+    def __init__(self, url, namespace):
+        import redis  # chỉ cần khi STATE_BACKEND=redis
+        self._redis = redis
+        self.r = redis.Redis.from_url(url)
+        self.prefix = f"bot:{namespace}:"
+
+    def __len__(self):
+        # SCAN theo prefix (không chặn server như KEYS), chỉ dùng cho thống kê
+        return sum(1 for _ in self.r.scan_iter(match=self.prefix + "*", count=1000))
+
+    def get(self, key, default=None):
+        raw = self.r.get(self.prefix + key)
+        return default if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl):
+        self.r.set(self.prefix + key, _state_encode(value), px=int(ttl * 1000))
+
+    def set_if_absent(self, key, value, ttl):
+        return bool(self.r.set(self.prefix + key, _state_encode(value), px=int(ttl * 1000), nx=True))
+
+    def pop(self, key, default=None):
+        pipe = self.r.pipeline()  # MULTI/EXEC: GET + DEL nguyên tử
+        pipe.get(self.prefix + key)
+        pipe.delete(self.prefix + key)
+        raw, _ = pipe.execute()
+        return default if raw is None else json.loads(raw)
+
+    def delete(self, key):
+        self.r.delete(self.prefix + key)
+
+    def update(self, key, fn, ttl):
+        k = self.prefix + key
+        with self.r.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(k)
+                    raw = pipe.get(k)
+                    value = fn(None if raw is None else json.loads(raw))
+                    pipe.multi()
+                    pipe.set(k, _state_encode(value), px=int(ttl * 1000))
+                    pipe.execute()
+                    return value
+                except self._redis.WatchError:
+                    continue  # key bị instance khác sửa → đọc lại
+
+def build_state_store(namespace, max_keys=STATE_MAX_KEYS):
+    if STATE_BACKEND == "sqlite":
+        return SQLiteStateStore(STATE_SQLITE_PATH, namespace)
+    if STATE_BACKEND == "redis":
+        return RedisStateStore(REDIS_URL, namespace)
+    return MemoryStateStore(max_keys)
 
 # =========================================================
 # STATE (GLOBAL)
 # =========================================================
-PENDING_VOUCHER = {}    # user_id -> cmd
+STATE = build_state_store("state")   # pending:<user_id> -> cmd
 COMBO1_KEY = "combo1"
 
-# ✅ SPAM TRACKER (in-memory, sync to sheet on ban)
-SPAM_TRACKER = {}  # user_id -> {"errors": [timestamp], "ban_count": 0}
+def set_pending(user_id, cmd):
+    """Ghi lệnh đang chờ cookie (thay lệnh cũ nếu có), tự hết hạn sau PENDING_TTL"""
+    old_cmd = STATE.get(f"pending:{user_id}")
+    if old_cmd:
+        dprint(f"Cleared old pending: {old_cmd}")
+    STATE.set(f"pending:{user_id}", cmd, PENDING_TTL)
+
+def get_pending(user_id):
+    return STATE.get(f"pending:{user_id}")
+
+def pop_pending(user_id):
+    """Lấy + xoá nguyên tử: chỉ 1 instance nhận được lệnh"""
+    return STATE.pop(f"pending:{user_id}")
+
+# ✅ UPDATE_ID DEDUP (webhook chậm → Telegram gửi lại cùng update)
+SEEN_UPDATES = build_state_store("updates", UPDATE_DEDUP_MAX)   # u:<update_id> -> 1
+
+def claim_update(update_id):
+    """
+    True nếu chưa instance nào nhận update_id này (set_if_absent nguyên tử).
+    Chỉ giữ lease UPDATE_CLAIM_TTL: process chết giữa chừng → lần Telegram
+    gửi lại sau khi hết lease vẫn được xử lý.
+    """
+    return SEEN_UPDATES.set_if_absent(f"u:{update_id}", 1, UPDATE_CLAIM_TTL)
+
+def finish_update(update_id):
+    """Xử lý xong → nhớ update_id đủ UPDATE_DEDUP_TTL để bỏ các lần gửi lại"""
+    SEEN_UPDATES.set(f"u:{update_id}", 1, UPDATE_DEDUP_TTL)
+
+def release_update(update_id):
+    """Xử lý lỗi giữa chừng → bỏ claim để lần Telegram gửi lại được chạy"""
+    SEEN_UPDATES.delete(f"u:{update_id}")
+
+# ✅ SPAM TRACKER (state store, sync to sheet on ban)
+class SpamEntry:
+    """Lỗi gần nhất của 1 user: ring buffer cố định SPAM_THRESHOLD timestamp"""
+    __slots__ = ("times", "head", "count", "ban_count")
+
+    def __init__(self, threshold):
+        self.times = array("d", bytes(8 * threshold))
+        self.head = 0        # vị trí ghi tiếp theo
+        self.count = 0       # số lỗi còn trong window
+        self.ban_count = 0
+
+    def add(self, now, window):
+        times, size = self.times, len(self.times)
+        # Bỏ lỗi cũ nhất khi đã ra khỏi window
+        while self.count and now - times[(self.head - self.count) % size] >= window:
+            self.count -= 1
+        times[self.head] = now
+        self.head = (self.head + 1) % size
+        self.count = min(self.count + 1, size)
+
+    def to_state(self):
+        """[ban_count, t_cũ_nhất, ..., t_mới_nhất] cho store dùng chung"""
+        size = len(self.times)
+        return [self.ban_count] + [
+            self.times[(self.head - self.count + i) % size] for i in range(self.count)
+        ]
+
+    @classmethod
+    def from_state(cls, state, threshold):
+        if isinstance(state, cls):
+            return state
+        entry = cls(threshold)
+        if state:
+            entry.ban_count = state[0]
+            for t in state[1:][-threshold:]:
+                entry.times[entry.head] = t
+                entry.head = (entry.head + 1) % threshold
+            entry.count = min(len(state) - 1, threshold)
+        return entry
+
+class SpamTracker:
+    """
+    user_id -> SpamEntry trong state store (TTL = idle_ttl, gia hạn mỗi lỗi).
+    - Mỗi lỗi: 1 lần update nguyên tử trên store, O(1)
+    - memory: trần max_keys, user ghi lâu nhất bị bỏ trước
+    - sqlite/redis: mọi instance đếm chung lỗi của 1 user
+    """
+
+    def __init__(self, threshold, window, idle_ttl, store):
+        self.threshold = threshold
+        self.window = window
+        self.idle_ttl = idle_ttl
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def record_error(self, user_id, now=None):
+        """Ghi 1 lỗi, return SpamEntry (count = số lỗi trong window)"""
+        now = time.time() if now is None else now
+
+        def add(state):
+            entry = SpamEntry.from_state(state, self.threshold)
+            entry.add(now, self.window)
+            return entry
+
+        return self.store.update(str(user_id), add, self.idle_ttl)
+
+    def mark_banned(self, user_id, ban_count):
+        def mark(state):
+            entry = SpamEntry.from_state(state, self.threshold)
+            entry.ban_count = ban_count
+            return entry
+
+        self.store.update(str(user_id), mark, self.idle_ttl)
+
+SPAM_TRACKER = SpamTracker(
+    SPAM_THRESHOLD, SPAM_WINDOW, SPAM_IDLE_TTL, build_state_store("spam", SPAM_TRACKER_MAX)
+)
+
+# =========================================================
+# TELEGRAM CLIENT (keep-alive session dùng chung)
+# =========================================================
+TG_POOL_SIZE = int(os.getenv("TG_POOL_SIZE", "10"))
+TG_RETRIES   = int(os.getenv("TG_RETRIES", "2"))
+
+def build_tg_session(pool_size=TG_POOL_SIZE, retries=TG_RETRIES):
+    """
+    Session giữ kết nối tới api.telegram.org (không bắt tay TCP/TLS mỗi tin).
+    Chỉ retry lỗi kết nối và 502/503/504 (request chưa tới bot API).
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=retries,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(["POST"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+TG_SESSION = build_tg_session()
+
+def tg_post(method, payload, timeout):
+    with METRICS.timer("telegram_request_seconds", method=method):
+        return TG_SESSION.post(f"{BASE_URL}/{method}", data=payload, timeout=timeout)
+
+# =========================================================
+# OUTBOUND QUEUE (gửi tin nền, giữ thứ tự từng chat)
+# =========================================================
+TG_ASYNC_SEND      = os.getenv("TG_ASYNC_SEND", "0" if ON_VERCEL else "1") == "1"
+TG_SEND_WORKERS    = int(os.getenv("TG_SEND_WORKERS", "4"))
+TG_GLOBAL_RATE     = float(os.getenv("TG_GLOBAL_RATE", "30"))  # ~30 msg/s toàn bot
+TG_CHAT_RATE       = float(os.getenv("TG_CHAT_RATE", "1"))     # ~1 msg/s mỗi chat
+TG_CHAT_BURST      = int(os.getenv("TG_CHAT_BURST", "3"))      # cho phép 2-3 tin liền nhau
+TG_MAX_429_RETRIES = 5
+
+class TokenBucket:
+    """Token bucket thread-safe; reserve() trả về số giây cần chờ"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """Còn token → lấy, trả 0.0; hết → số giây cần chờ (không trừ token)"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def is_full(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens >= self.capacity
+
+class OutboundQueue:
+    """
+    Hàng đợi gửi Telegram:
+    - mỗi chat có deque riêng, tại một thời điểm chỉ 1 worker giữ chat → đúng thứ tự
+    - token bucket toàn cục + theo chat; chat hết lượt → hẹn lại (heap),
+      worker đi gửi cho chat khác thay vì ngủ chờ
+    - 429 → dừng toàn bộ theo retry_after rồi gửi lại
+    - "sent" chỉ tính 2xx; 4xx/5xx khác đếm riêng ở "http_errors"
+    """
+
+    def __init__(self, workers, global_rate, chat_rate, chat_burst):
+        self.n_workers = workers
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._chats = {}            # chat_key -> deque[job] (đang chờ / đang xử lý)
+        self._buckets = {}          # chat_key -> TokenBucket
+        self._ready = queue.Queue() # chat_key sẵn sàng cho worker
+        self._delayed = []          # heap (due, seq, chat_key): chat chờ token
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pause_until = 0.0
+        self._threads = []
+        self.stats = {"submitted": 0, "sent": 0, "retried_429": 0, "failed": 0,
+                      "http_errors": 0, "deferred": 0}
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.n_workers):
+                t = threading.Thread(target=self._run, name=f"tg-send-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, chat_key, method, payload, timeout, on_result=None, rate_limited=True):
+        self._ensure_started()
+        job = (method, payload, timeout, on_result, rate_limited)
+        with self._lock:
+            self.stats["submitted"] += 1
+            pending = self._chats.get(chat_key)
+            if pending is not None:
+                pending.append(job)  # worker đang giữ chat sẽ lấy tiếp
+                return
+            self._chats[chat_key] = deque([job])
+        self._ready.put(chat_key)
+
+    def _chat_bucket(self, chat_key):
+        with self._lock:
+            bucket = self._buckets.get(chat_key)
+            if bucket is None:
+                bucket = self._buckets[chat_key] = TokenBucket(self.chat_rate, self.chat_burst)
+            return bucket
+
+    def _prune_buckets(self):
+        if len(self._buckets) < 10000:
+            return
+        for key in [k for k, b in self._buckets.items() if k not in self._chats and b.is_full()]:
+            del self._buckets[key]
+
+    def _deliver(self, chat_key, job):
+        method, payload, timeout, on_result, rate_limited = job
+
+        for attempt in range(TG_MAX_429_RETRIES + 1):
+            pause = self._pause_until - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+            if rate_limited:
+                if attempt:
+                    self._chat_bucket(chat_key).acquire()
+                self.global_bucket.acquire()
+
+            try:
+                r = tg_post(method, payload, timeout)
+            except Exception as e:
+                self.stats["failed"] += 1
+                dprint(f"{method} error:", e)
+                return
+
+            if r.status_code == 429:
+                if attempt == TG_MAX_429_RETRIES:
+                    self.stats["failed"] += 1
+                    return
+                try:
+                    retry_after = float(r.json().get("parameters", {}).get("retry_after", 1))
+                except Exception:
+                    retry_after = 1.0
+                self._pause_until = max(self._pause_until, time.monotonic() + retry_after)
+                self.stats["retried_429"] += 1
+                dprint(f"{method} 429, retry after {retry_after}s")
+                continue
+
+            if r.ok:
+                self.stats["sent"] += 1
+            else:
+                self.stats["http_errors"] += 1
+                dprint(f"{method} HTTP {r.status_code}:", r.text[:200])
+            if on_result:
+                try:
+                    on_result(r)
+                except Exception as e:
+                    dprint(f"{method} callback error:", e)
+            return
+
+    def _next_chat(self):
+        """chat_key kế tiếp: chat hẹn lại đã tới hạn trước, rồi tới hàng sẵn sàng"""
+        while True:
+            with self._lock:
+                wait = None
+                if self._delayed:
+                    wait = self._delayed[0][0] - time.monotonic()
+                    if wait <= 0:
+                        return heapq.heappop(self._delayed)[2]
+            try:
+                return self._ready.get(timeout=wait)
+            except queue.Empty:
+                continue
+
+    def _run(self):
+        while True:
+            chat_key = self._next_chat()
+            with self._lock:
+                job = self._chats[chat_key][0]
+
+            if job[4]:
+                wait = self._chat_bucket(chat_key).try_acquire()
+                if wait > 0:
+                    # Giữ job ở đầu deque (đúng thứ tự), hẹn lại chat này
+                    with self._lock:
+                        heapq.heappush(self._delayed, (time.monotonic() + wait, next(self._seq), chat_key))
+                        self.stats["deferred"] += 1
+                    continue
+
+            self._deliver(chat_key, job)
+
+            with self._lock:
+                self._chats[chat_key].popleft()
+                if self._chats[chat_key]:
+                    requeue = True
+                else:
+                    del self._chats[chat_key]
+                    requeue = False
+                    self._prune_buckets()
+                    if not self._chats:
+                        self._idle.notify_all()
+            if requeue:
+                self._ready.put(chat_key)  # xếp cuối hàng để chat khác không bị đói
+
+    def drain(self, timeout=10):
+        """Chờ gửi hết tin còn trong hàng đợi (dùng khi shutdown)"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self._chats:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats, pending_chats=len(self._chats))
+
+TG_OUTBOX = OutboundQueue(TG_SEND_WORKERS, TG_GLOBAL_RATE, TG_CHAT_RATE, TG_CHAT_BURST)
+atexit.register(TG_OUTBOX.drain)
+
+def tg_dispatch(chat_key, method, payload, timeout, on_result=None, rate_limited=True):
+    """Gửi qua TG_OUTBOX (mặc định) hoặc gửi thẳng khi TG_ASYNC_SEND=0"""
+    if TG_ASYNC_SEND:
+        TG_OUTBOX.submit(chat_key, method, payload, timeout, on_result, rate_limited)
+        return
+
+    try:
+        r = tg_post(method, payload, timeout)
+        if on_result:
+            on_result(r)
+    except Exception as e:
+        dprint(f"{method} error:", e)
 
 # =========================================================
 # TELEGRAM UTIL
@@ -195,10 +1157,147 @@ def tg_send(chat_id, text, reply_markup=None):
     if reply_markup:
         payload["reply_markup"] = json.dumps(reply_markup, ensure_ascii=False)
 
+    tg_dispatch(chat_id, "sendMessage", payload, timeout=15)
+
+# ✅ URL ảnh → file_id: gửi lại ảnh đã gửi không bắt Telegram tải URL lần nữa
+# Mất cache chỉ làm gửi lại bằng URL → thư mục tạm (ghi được cả trên Vercel);
+# file_id chỉ dùng được với đúng bot → tên file theo token
+TG_FILE_CACHE_PATH = os.getenv("TG_FILE_CACHE_PATH", os.path.join(
+    tempfile.gettempdir(), f"tg_file_ids_{hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:12]}.db"))
+TG_FILE_CACHE_MAX  = int(os.getenv("TG_FILE_CACHE_MAX", "50000"))
+
+class FileIdCache:
+    """
+    LRU url -> file_id trong RAM, ghi xuống SQLite để khởi động lại vẫn còn.
+    Miss trong RAM → đọc SQLite (worker khác có thể đã lưu).
+    File chỉ được mở lúc dùng lần đầu (import / bot không gửi ảnh → không tạo file).
+    Không mở / ghi được file (vd thư mục read-only) → chỉ dùng RAM.
+    """
+
+    TOUCH_EVERY = 3600   # ghi used_at xuống đĩa tối đa 1 lần / giờ / key
+    TRIM_EVERY = 500     # số lần put giữa 2 lần cắt bảng về max_entries
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # url -> [file_id, used_at đã ghi đĩa]
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._db = None
+        self._opened = False
+        self.stats = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0, "invalidated": 0}
+
+    def _open(self):
+        """Mở + nạp file lần đầu dùng (gọi trong self._lock)"""
+        if self._opened:
+            return
+        self._opened = True
+        try:
+            db = sqlite_connect(self.path)
+            db.execute("""
+            CREATE TABLE IF NOT EXISTS tg_file_ids (
+                url     TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                used_at REAL NOT NULL
+            )""")
+            rows = db.execute(
+                "SELECT url, file_id, used_at FROM tg_file_ids ORDER BY used_at DESC LIMIT ?", (self.max_entries,)
+            ).fetchall()
+            for r in reversed(rows):
+                self._data[r["url"]] = [r["file_id"], r["used_at"]]
+            self._db = db
+        except sqlite3.Error as e:
+            print("[TG_FILE_CACHE] chỉ dùng RAM:", e)
+
+    def __len__(self):
+        return len(self._data)
+
+    def _execute(self, sql, args=()):
+        if self._db is None:
+            return None
+        try:
+            return self._db.execute(sql, args)
+        except sqlite3.Error as e:
+            dprint("TG_FILE_CACHE db error:", e)
+            return None
+
+    def _insert(self, url, file_id, now):
+        self._data[url] = [file_id, now]
+        self._data.move_to_end(url)
+        while len(self._data) > self.max_entries:
+            old_url, _ = self._data.popitem(last=False)
+            self._execute("DELETE FROM tg_file_ids WHERE url=?", (old_url,))
+            self.stats["evicted"] += 1
+
+    def get(self, url):
+        now = time.time()
+        with self._lock:
+            self._open()
+            item = self._data.get(url)
+            if item is None:
+                cur = self._execute("SELECT file_id FROM tg_file_ids WHERE url=?", (url,))
+                row = cur.fetchone() if cur is not None else None
+                if row is None:
+                    self.stats["misses"] += 1
+                    return None
+                self._insert(url, row["file_id"], 0.0)
+                item = self._data[url]
+            self._data.move_to_end(url)
+            if now - item[1] > self.TOUCH_EVERY:
+                item[1] = now
+                self._execute("UPDATE tg_file_ids SET used_at=? WHERE url=?", (now, url))
+            self.stats["hits"] += 1
+            return item[0]
+
+    def put(self, url, file_id):
+        now = time.time()
+        with self._lock:
+            self._open()
+            self._insert(url, file_id, now)
+            self._execute(
+                "INSERT INTO tg_file_ids (url, file_id, used_at) VALUES (?, ?, ?)"
+                " ON CONFLICT(url) DO UPDATE SET file_id=excluded.file_id, used_at=excluded.used_at",
+                (url, file_id, now),
+            )
+            self.stats["stored"] += 1
+            self._puts += 1
+            if self._puts % self.TRIM_EVERY == 0:
+                # Worker khác cũng ghi → giữ bảng ≤ max_entries dòng mới dùng nhất
+                self._execute(
+                    "DELETE FROM tg_file_ids WHERE url IN"
+                    " (SELECT url FROM tg_file_ids ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+
+    def delete(self, url):
+        with self._lock:
+            self._open()
+            self._data.pop(url, None)
+            self._execute("DELETE FROM tg_file_ids WHERE url=?", (url,))
+            self.stats["invalidated"] += 1
+
+    def metrics(self):
+        return dict(self.stats, size=len(self._data))
+
+TG_FILE_IDS = FileIdCache(TG_FILE_CACHE_PATH, TG_FILE_CACHE_MAX)
+
+# 400 do chính file_id (hết hạn / sai bot) → mới bỏ cache; 400 khác (caption, chat...) gửi URL cũng lỗi
+_FILE_ID_ERROR = re.compile(r"file identifier|file_id|remote file|file reference", re.I)
+
+def _is_file_id_error(r):
+    if r.status_code != 400:
+        return False
     try:
-        requests.post(f"{BASE_URL}/sendMessage", data=payload, timeout=15)
-    except Exception as e:
-        dprint("tg_send error:", e)
+        description = r.json().get("description", "")
+    except Exception:
+        description = r.text
+    return bool(_FILE_ID_ERROR.search(description or ""))
+
+def _sent_photo_file_id(r):
+    try:
+        return r.json()["result"]["photo"][-1]["file_id"]  # bản lớn nhất
+    except Exception:
+        return None
 
 def tg_send_photo(chat_id, photo, caption=None, reply_markup=None):
     payload = {
@@ -211,10 +1310,29 @@ def tg_send_photo(chat_id, photo, caption=None, reply_markup=None):
     if reply_markup:
         payload["reply_markup"] = json.dumps(reply_markup, ensure_ascii=False)
 
-    try:
-        requests.post(f"{BASE_URL}/sendPhoto", data=payload, timeout=20)
-    except Exception as e:
-        dprint("tg_send_photo error:", e)
+    if not photo.startswith(("http://", "https://")):
+        tg_dispatch(chat_id, "sendPhoto", payload, timeout=20)
+        return
+
+    url = photo
+
+    def remember(r):
+        file_id = _sent_photo_file_id(r) if r.status_code == 200 else None
+        if file_id:
+            TG_FILE_IDS.put(url, file_id)
+
+    file_id = TG_FILE_IDS.get(url)
+    if not file_id:
+        tg_dispatch(chat_id, "sendPhoto", payload, timeout=20, on_result=remember)
+        return
+
+    def fallback(r):
+        if _is_file_id_error(r):
+            # file_id không còn dùng được → bỏ cache, gửi lại bằng URL
+            TG_FILE_IDS.delete(url)
+            tg_dispatch(chat_id, "sendPhoto", payload, timeout=20, on_result=remember)
+
+    tg_dispatch(chat_id, "sendPhoto", dict(payload, photo=file_id), timeout=20, on_result=fallback)
 
 def tg_answer_callback(callback_id, text=None, show_alert=False):
     payload = {
@@ -224,10 +1342,8 @@ def tg_answer_callback(callback_id, text=None, show_alert=False):
     if text:
         payload["text"] = text
 
-    try:
-        requests.post(f"{BASE_URL}/answerCallbackQuery", data=payload, timeout=10)
-    except Exception as e:
-        dprint("tg_answer_callback error:", e)
+    # Không phải tin nhắn chat → không tính rate limit
+    tg_dispatch(("cb", callback_id), "answerCallbackQuery", payload, timeout=10, rate_limited=False)
 
 # =========================================================
 # KEYBOARD
@@ -253,13 +1369,307 @@ def now_datetime():
     """Return current datetime in Vietnam timezone"""
     return datetime.now(VIETNAM_TZ)
 
+# =========================================================
+# SHEETS GATEWAY (quota đọc/ghi, 429, ưu tiên)
+# =========================================================
+# Quota Google Sheets: ~60 request đọc + 60 request ghi / phút / service account
+SHEETS_READ_PER_MIN     = int(os.getenv("SHEETS_READ_PER_MIN", "60"))
+SHEETS_WRITE_PER_MIN    = int(os.getenv("SHEETS_WRITE_PER_MIN", "60"))
+SHEETS_BURST            = int(os.getenv("SHEETS_BURST", "10"))
+SHEETS_MAX_RETRIES      = int(os.getenv("SHEETS_MAX_RETRIES", "4"))
+SHEETS_MAX_WAIT         = float(os.getenv("SHEETS_MAX_WAIT", "10"))          # chờ quota tối đa / lệnh
+SHEETS_PAYMENT_MAX_WAIT = float(os.getenv("SHEETS_PAYMENT_MAX_WAIT", "30"))
+
+# Ưu tiên (số nhỏ lấy quota trước)
+PRIO_PAYMENT = 0   # webhook nạp tiền, ghi số dư
+PRIO_USER    = 1   # mặc định: lệnh của user
+PRIO_LOW     = 2   # lịch sử, log, đồng bộ nền
+
+SHEETS_READ_METHODS = {
+    "get_all_values", "get_all_records", "col_values", "row_values",
+    "cell", "acell", "batch_get", "get", "find", "findall",
+}
+SHEETS_WRITE_METHODS = {
+    "update", "batch_update", "update_cell", "update_acell", "clear",
+    "append_row", "append_rows", "insert_row", "insert_rows", "delete_rows",
+}
+# Ghi lại cùng giá trị không đổi kết quả → retry được cả khi 5xx / mất kết nối
+SHEETS_IDEMPOTENT = SHEETS_READ_METHODS | {"update", "batch_update", "update_cell", "update_acell", "clear"}
+
+class SheetsUnavailable(Exception):
+    """Sheets hết quota / lỗi tạm thời quá thời gian chờ: không có câu trả lời đúng để trả"""
+
+_sheets_ctx = threading.local()
+
+@contextmanager
+def sheets_priority(priority):
+    """Đặt ưu tiên cho mọi lệnh Sheets trong block / hàm (dùng được làm decorator)"""
+    old = getattr(_sheets_ctx, "priority", PRIO_USER)
+    _sheets_ctx.priority = priority
+    try:
+        yield
+    finally:
+        _sheets_ctx.priority = old
+
+class PriorityGate:
+    """
+    Token bucket có hàng chờ theo ưu tiên: thiếu token thì request
+    ưu tiên cao (rồi tới trước) được cấp trước. pause() khi bị 429.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._cond = threading.Condition()
+        self._waiters = []      # heap (priority, seq)
+        self._seq = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._seq += 1
+            me = (priority, self._seq)
+            heapq.heappush(self._waiters, me)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._waiters[0] == me and self.tokens >= 1 and now >= self.paused_until:
+                        self.tokens -= 1
+                        return
+                    if now >= deadline:
+                        raise SheetsUnavailable("Sheets quota: hết thời gian chờ")
+                    if self._waiters[0] == me:
+                        wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+                    else:
+                        wait = deadline - now   # chờ tới lượt (notify)
+                    self._cond.wait(min(wait, deadline - now))
+            finally:
+                self._waiters.remove(me)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def pause(self, seconds):
+        with self._cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = min(self.tokens, 0.0)
+            self._cond.notify_all()
+
+    def queue_depth(self):
+        return len(self._waiters)
+
+def _sheets_error_info(e):
+    """(status HTTP, Retry-After giây) của lỗi gspread / requests"""
+    resp = getattr(e, "response", None)
+    status = getattr(resp, "status_code", None)
+    retry_after = None
+    try:
+        retry_after = float(resp.headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        pass
+    return status, retry_after
+
+class SheetsGateway:
+    """
+    Mọi lệnh worksheet đi qua đây (GatedWorksheet):
+    - bucket đọc / ghi riêng theo quota phút, ưu tiên PRIO_PAYMENT > PRIO_USER > PRIO_LOW
+    - 429: dừng cả bucket theo Retry-After (hoặc backoff), rồi thử lại
+    - 5xx / mất kết nối: thử lại lệnh idempotent (không append lại 2 lần)
+    - backoff mũ + full jitter; quá thời gian chờ → SheetsUnavailable
+    """
+
+    def __init__(self, read_per_min, write_per_min, burst, max_retries):
+        self.gates = {
+            "read": PriorityGate(read_per_min / 60.0, burst),
+            "write": PriorityGate(write_per_min / 60.0, burst),
+        }
+        self.max_retries = max_retries
+        self.stats = {"read": 0, "write": 0, "throttled": 0, "retries": 0, "unavailable": 0}
+
+    def call(self, kind, name, fn, args, kwargs):
+        priority = getattr(_sheets_ctx, "priority", PRIO_USER)
+        budget = SHEETS_PAYMENT_MAX_WAIT if priority == PRIO_PAYMENT else SHEETS_MAX_WAIT
+        deadline = time.monotonic() + budget
+        gate = self.gates[kind]
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                gate.acquire(priority, deadline - time.monotonic())
+            except SheetsUnavailable:
+                self.stats["unavailable"] += 1
+                raise
+            self.stats[kind] += 1
+            trace = current_trace()
+            if trace is not None:
+                trace.sheets_calls += 1
+            try:
+                with METRICS.timer("sheets_request_seconds", method=name):
+                    return fn(*args, **kwargs)
+            except Exception as e:
+                status, retry_after = _sheets_error_info(e)
+                transient = isinstance(e, (requests.ConnectionError, requests.Timeout)) or (
+                    status is not None and status >= 500)
+                if status == 429:
+                    self.stats["throttled"] += 1
+                elif not (transient and name in SHEETS_IDEMPOTENT):
+                    raise
+
+                delay = retry_after or random.uniform(0, min(30.0, 1.0 * 2 ** attempt))
+                if status == 429:
+                    gate.pause(delay)
+                if attempt == self.max_retries or time.monotonic() + delay > deadline:
+                    self.stats["unavailable"] += 1
+                    raise SheetsUnavailable(f"Sheets {name}: {status or type(e).__name__}") from e
+                self.stats["retries"] += 1
+                dprint(f"Sheets {name} {status or type(e).__name__} → retry in {delay:.1f}s")
+                time.sleep(delay)
+
+    def metrics(self):
+        return dict(
+            self.stats,
+            read_waiting=self.gates["read"].queue_depth(),
+            write_waiting=self.gates["write"].queue_depth(),
+        )
+
+SHEETS_GATEWAY = SheetsGateway(SHEETS_READ_PER_MIN, SHEETS_WRITE_PER_MIN, SHEETS_BURST, SHEETS_MAX_RETRIES)
+
+class GatedWorksheet:
+    """Bọc gspread Worksheet: lệnh gọi API đi qua SHEETS_GATEWAY, thuộc tính khác giữ nguyên"""
+
+    def __init__(self, ws):
+        self._ws = ws
+
+    def __getattr__(self, name):
+        attr = getattr(self._ws, name)
+        if name in SHEETS_READ_METHODS:
+            kind = "read"
+        elif name in SHEETS_WRITE_METHODS:
+            kind = "write"
+        else:
+            return attr
+
+        def call(*args, **kwargs):
+            return SHEETS_GATEWAY.call(kind, name, attr, args, kwargs)
+        return call
+
+# =========================================================
+# LOG PIPELINE (queue → append_rows theo batch)
+# =========================================================
+LOG_ASYNC          = os.getenv("LOG_ASYNC", "0" if ON_VERCEL else "1") == "1"
+LOG_BATCH_SIZE     = int(os.getenv("LOG_BATCH_SIZE", "50"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "2"))
+LOG_QUEUE_MAX      = int(os.getenv("LOG_QUEUE_MAX", "5000"))
+LOG_MAX_RETRIES    = 3
+
+class LogBuffer:
+    """
+    Gom log vào queue giới hạn, thread nền ghi "Logs" bằng append_rows
+    khi đủ LOG_BATCH_SIZE dòng hoặc sau LOG_FLUSH_INTERVAL giây.
+    Queue đầy → bỏ event (đếm vào stats["dropped"]).
+    """
+
+    def __init__(self, batch_size, interval, maxsize):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.q = queue.Queue(maxsize=maxsize)
+        self.stats = {"enqueued": 0, "dropped": 0, "flushed": 0, "batches": 0, "failed_batches": 0}
+        self._thread = None
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log-buffer", daemon=True)
+                self._thread.start()
+
+    def put(self, row):
+        self._ensure_started()
+        try:
+            self.q.put_nowait(row)
+            self.stats["enqueued"] += 1
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def _collect(self):
+        batch = []
+        deadline = time.time() + self.interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    @sheets_priority(PRIO_LOW)
+    def _write(self, batch):
+        for attempt in range(LOG_MAX_RETRIES):
+            try:
+                ws_log.append_rows(batch)
+                self.stats["flushed"] += len(batch)
+                self.stats["batches"] += 1
+                return True
+            except Exception as e:
+                sheet_error(f"log flush (attempt {attempt + 1})", e)
+                time.sleep(0.5 * 2 ** attempt)
+        self.stats["failed_batches"] += 1
+        self.stats["dropped"] += len(batch)
+        return False
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._collect()
+            if batch:
+                self._write(batch)
+
+    def flush(self):
+        """Ghi hết những gì đang nằm trong queue (đồng bộ)"""
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.q.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            self._write(batch)
+
+    def close(self, timeout=5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if SHEET_READY:
+            self.flush()
+
+    def metrics(self):
+        return dict(self.stats, queue_depth=self.q.qsize())
+
+LOG_BUFFER = LogBuffer(LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL, LOG_QUEUE_MAX)
+atexit.register(LOG_BUFFER.close)
+
 def log_row(user_id, username, action, value="", note=""):
-    if not SHEET_READY:
+    if not store_ready():
         return
+    row = [now_str(), str(user_id), username, action, value, note]
+
     try:
-        ws_log.append_row([now_str(), str(user_id), username, action, value, note])
+        STORE.append_log(row)
     except Exception as e:
         dprint("log_row error:", e)
+        STORE.report_error(e)
 
 # =========================================================
 # ✅ ANTI-SPAM SYSTEM
@@ -268,33 +1678,20 @@ def track_error(user_id, username=""):
     """
     Track lỗi của user, return True nếu cần ban
     """
-    now = time.time()
-    
-    if user_id not in SPAM_TRACKER:
-        SPAM_TRACKER[user_id] = {
-            "errors": [],
-            "ban_count": 0
-        }
-    
-    tracker = SPAM_TRACKER[user_id]
-    
-    # Thêm timestamp lỗi hiện tại
-    tracker["errors"].append(now)
-    
-    # Xóa lỗi cũ hơn SPAM_WINDOW
-    tracker["errors"] = [t for t in tracker["errors"] if now - t < SPAM_WINDOW]
+    # Thêm lỗi hiện tại (lỗi cũ hơn SPAM_WINDOW tự bị bỏ)
+    tracker = SPAM_TRACKER.record_error(user_id)
     
     # Check threshold
-    if len(tracker["errors"]) >= SPAM_THRESHOLD:
+    if tracker.count >= SPAM_THRESHOLD:
         # Ban user
-        ban_count = tracker["ban_count"]
-        error_count = len(tracker["errors"])
+        ban_count = tracker.ban_count
+        error_count = tracker.count
         
         if ban_count == 0:
             # Lần đầu → Ban 1H
             apply_ban(user_id, "1H")
             notify_admin_spam(user_id, username, "1H", error_count)
-            tracker["ban_count"] = 1
+            SPAM_TRACKER.mark_banned(user_id, 1)
             return True
         else:
             # Tái phạm → Ban vĩnh viễn
@@ -304,61 +1701,169 @@ def track_error(user_id, username=""):
     
     return False
 
+def parse_ban_note(note):
+    """
+    Cột F → (banned, until)
+    until: datetime hết hạn (BAN 1H) / None (vĩnh viễn)
+    """
+    note = str(note or "")
+    if "BAN VĨNH VIỄN" in note.upper():
+        return True, None
+    if "BAN 1H:" in note:
+        try:
+            ban_until_str = note.split("BAN 1H:")[1].strip()
+            ban_until = datetime.strptime(ban_until_str, "%Y-%m-%d %H:%M")
+            return True, ban_until.replace(tzinfo=VIETNAM_TZ)
+        except ValueError:
+            pass
+    return False, None
+
+_MISSING = object()  # khác None (None = ban vĩnh viễn)
+
+class BanRegistry:
+    """
+    user_id -> hạn ban (parse sẵn từ cột F), check trên hot path = 1 lần tra dict.
+    - Nạp toàn bộ cột F lần đầu dùng + mỗi ttl giây (staff sửa tay trên Sheet),
+      chỉ 1 luồng nạp; luồng khác dùng bản cũ (lần đầu: chờ)
+    - apply_ban cập nhật trực tiếp
+    - Ban 1H hết hạn: heap (until, user_id) + timer xoá ghi chú trên Sheet
+      (Vercel: không có thread nền → xử lý heap ngay lúc check)
+    """
+
+    def __init__(self, ttl, use_timer=True, retry=BAN_REGISTRY_RETRY):
+        self.ttl = ttl
+        self.retry = retry
+        self.use_timer = use_timer
+        self._bans = {}        # "user_id" -> until (datetime) / None (vĩnh viễn)
+        self._expiry = []      # heap (until_ts, "user_id", until)
+        self._loaded_at = 0.0  # 0 = chưa nạp thành công lần nào
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._timer = None
+
+    @sheets_priority(PRIO_LOW)
+    def load(self):
+        bans = {}
+        for user_id, note in STORE.load_ban_notes():
+            banned, until = parse_ban_note(note)
+            if banned:
+                bans[str(user_id).strip()] = until
+        expiry = [(until.timestamp(), uid, until) for uid, until in bans.items() if until]
+        heapq.heapify(expiry)
+        with self._lock:
+            self._bans = bans
+            self._expiry = expiry
+            self._loaded_at = time.time()
+        dprint(f"Ban registry loaded: {len(bans)} bans")
+        self._schedule()
+
+    def _is_fresh(self):
+        now = time.time()
+        return now - self._loaded_at <= self.ttl or (self._loaded_at and now < self._retry_at)
+
+    def ensure_fresh(self):
+        if self._is_fresh():
+            return
+        loaded = bool(self._loaded_at)
+        # Đã có bản cũ → luồng khác đang nạp thì dùng bản cũ, không chờ
+        if not self._refresh_lock.acquire(blocking=not loaded):
+            return
+        try:
+            if self._is_fresh():
+                return  # luồng trước vừa nạp xong
+            if not self._loaded_at and time.time() < self._retry_at:
+                raise SheetsUnavailable("ban registry: lần nạp đầu vừa lỗi")
+            try:
+                self.load()
+            except Exception as e:
+                # Lỗi → giữ bản cũ, thử lại sau retry giây (không đánh dấu mới)
+                dprint("BanRegistry.load error:", e)
+                STORE.report_error(e)
+                self._retry_at = time.time() + self.retry
+                if not self._loaded_at:
+                    # Chưa có danh sách ban nào → không đoán "không bị ban"
+                    raise SheetsUnavailable(f"ban registry: {e}") from e
+        finally:
+            self._refresh_lock.release()
+
+    def ban(self, user_id, until):
+        key = str(user_id)
+        with self._lock:
+            self._bans[key] = until
+            if until:
+                heapq.heappush(self._expiry, (until.timestamp(), key, until))
+        self._schedule()
+
+    def status(self, user_id):
+        if not self.use_timer and self._expiry and self._expiry[0][0] <= time.time():
+            self._expire_due()
+
+        # 1 lần tra dict: timer có thể xoá key giữa "in" và "[]"
+        until = self._bans.get(str(user_id), _MISSING)
+        if until is _MISSING:
+            return {"banned": False}
+        if until is None:
+            return {"banned": True, "type": "PERMANENT", "until": "Vĩnh viễn"}
+        if now_datetime() < until:
+            return {"banned": True, "type": "1H", "until": until.strftime("%Y-%m-%d %H:%M")}
+        return {"banned": False}
+
+    def _schedule(self):
+        if not self.use_timer:
+            return
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if not self._expiry:
+                return
+            delay = max(0.0, self._expiry[0][0] - time.time())
+            self._timer = threading.Timer(delay, self._expire_due)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _expire_due(self):
+        expired = []
+        now = time.time()
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                _, key, until = heapq.heappop(self._expiry)
+                # Bỏ qua entry cũ (user đã bị ban lại / ban vĩnh viễn)
+                if key in self._bans and self._bans[key] == until:
+                    del self._bans[key]
+                    expired.append((key, until))
+
+        for key, until in expired:
+            try:
+                rec = get_user_record(key)
+                # Chỉ xoá ghi chú nếu Sheet vẫn là đúng lần ban này
+                if rec is not None and parse_ban_note(rec.note) == (True, until):
+                    update_user_record(key, note="auto từ bot")
+            except Exception as e:
+                dprint("BanRegistry expire error:", e)
+                STORE.report_error(e)
+
+        self._schedule()
+
+BAN_REGISTRY = BanRegistry(BAN_REGISTRY_TTL, use_timer=not ON_VERCEL)
+
+@METRICS.timed("bot_stage_seconds", stage="ban_check")
 def check_ban_status(user_id):
     """
-    Đọc cột F (ghi Chú) để check ban
+    Tra BAN_REGISTRY (cột F đã parse sẵn)
     Return: {
         "banned": True/False,
         "type": "1H" / "PERMANENT",
         "until": "2025-12-27 10:30" / "Vĩnh viễn"
     }
     """
-    if not SHEET_READY:
-        return {"banned": False}
-    
-    row = get_user_row(user_id)
-    if not row:
-        return {"banned": False}
-    
-    try:
-        note = ws_money.cell(row, 6).value or ""  # Cột F
-        
-        # Check BAN VĨNH VIỄN
-        if "BAN VĨNH VIỄN" in note.upper():
-            return {
-                "banned": True,
-                "type": "PERMANENT",
-                "until": "Vĩnh viễn"
-            }
-        
-        # Check BAN 1H
-        if "BAN 1H:" in note:
-            try:
-                ban_until_str = note.split("BAN 1H:")[1].strip()
-                ban_until = datetime.strptime(ban_until_str, "%Y-%m-%d %H:%M")
-                # Make timezone-aware
-                ban_until = ban_until.replace(tzinfo=VIETNAM_TZ)
-                
-                # Check còn hiệu lực không
-                if now_datetime() < ban_until:
-                    return {
-                        "banned": True,
-                        "type": "1H",
-                        "until": ban_until_str
-                    }
-                else:
-                    # Hết hạn ban → xóa note
-                    ws_money.update_cell(row, 6, "auto từ bot")
-                    return {"banned": False}
-            except:
-                pass
-        
-        return {"banned": False}
-        
-    except Exception as e:
-        dprint("check_ban_status error:", e)
+    if not store_ready():
         return {"banned": False}
 
+    BAN_REGISTRY.ensure_fresh()
+    return BAN_REGISTRY.status(user_id)
+
 def notify_admin_spam(user_id, username, ban_type, error_count):
     """
     Gửi cảnh báo spam cho admin
@@ -411,11 +1916,10 @@ def apply_ban(user_id, ban_type):
     Ghi ban status vào cột F
     ban_type: "1H" hoặc "PERMANENT"
     """
-    if not SHEET_READY:
+    if not store_ready():
         return
     
-    row = get_user_row(user_id)
-    if not row:
+    if get_user_record(user_id) is None:
         return
     
     try:
@@ -425,104 +1929,1230 @@ def apply_ban(user_id, ban_type):
             ban_until = now_datetime() + timedelta(seconds=BAN_DURATION_1H)
             note = f"BAN 1H: {ban_until.strftime('%Y-%m-%d %H:%M')}"
         
-        ws_money.update_cell(row, 6, note)
+        update_user_record(user_id, note=note)
+        BAN_REGISTRY.ban(user_id, parse_ban_note(note)[1])
         log_row(user_id, "", "BAN_APPLIED", ban_type, note)
         
         dprint(f"✅ Applied ban: {user_id} → {ban_type}")
         
     except Exception as e:
         dprint("apply_ban error:", e)
+        STORE.report_error(e)
+
+# =========================================================
+# USER ROW INDEX (user_id -> row trong "Thanh Toan")
+# =========================================================
+USER_INDEX_TTL = int(os.getenv("USER_INDEX_TTL", "300"))              # rebuild định kỳ
+USER_INDEX_MISS_COOLDOWN = int(os.getenv("USER_INDEX_MISS_COOLDOWN", "5"))  # chống rebuild liên tục khi miss
+
+_user_index = {}           # "user_id" -> row (1-based)
+_user_index_built_at = 0.0
+_user_index_lock = threading.Lock()
+
+def _row_from_updated_range(resp):
+    """Lấy số dòng từ response append_row: "'Thanh Toan'!A124:E124" -> 124"""
+    try:
+        rng = resp["updates"]["updatedRange"]
+        m = re.search(r"![A-Z]+(\d+)", rng)
+        return int(m.group(1)) if m else None
+    except Exception:
+        return None
+
+def rebuild_user_index(max_age=0):
+    """
+    Tải cột A một lần và dựng lại index user_id -> row.
+    max_age: index vừa được luồng khác dựng (trong lúc chờ lock) → dùng luôn.
+    """
+    global _user_index, _user_index_built_at
+
+    with _user_index_lock:
+        if max_age and time.time() - _user_index_built_at <= max_age:
+            return _user_index
+        ids = ws_money.col_values(1)
+        index = {}
+        for i, uid in enumerate(ids):
+            uid = str(uid).strip()
+            # Giữ dòng đầu tiên giống ids.index()
+            if uid and uid not in index:
+                index[uid] = i + 1
+        _user_index = index
+        _user_index_built_at = time.time()
+        dprint(f"User index rebuilt: {len(index)} rows")
+        return index
+
+def invalidate_user_index():
+    global _user_index_built_at
+    _user_index_built_at = 0.0
+
+def _user_index_set(user_id, row):
+    with _user_index_lock:
+        _user_index[str(user_id)] = row
+
+def get_user_row(user_id):
+    if not sheets_ready():
+        return None
+    key = str(user_id)
+    try:
+        if time.time() - _user_index_built_at > USER_INDEX_TTL:
+            rebuild_user_index(USER_INDEX_TTL)
+        row = _user_index.get(key)
+        if row is None and time.time() - _user_index_built_at > USER_INDEX_MISS_COOLDOWN:
+            # Miss → có thể user mới được thêm từ nơi khác, revalidate một lần
+            row = rebuild_user_index(USER_INDEX_MISS_COOLDOWN).get(key)
+        return row
+    except Exception as e:
+        SHEETS.report_error(e)
+        # Rebuild lỗi → dùng tạm index cũ; không có trong đó thì không biết user có hay chưa
+        row = _user_index.get(key)
+        if row is None:
+            raise e if isinstance(e, SheetsUnavailable) else SheetsUnavailable(f"user index: {e}") from e
+        return row
+
+# =========================================================
+# USER RECORD CACHE (write-through)
+# =========================================================
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "30"))
+SHEET_WRITE_WINDOW   = float(os.getenv("SHEET_WRITE_WINDOW", "0" if ON_VERCEL else "0.5"))  # 0 = ghi ngay
+SHEET_WRITE_MAX_ROWS = int(os.getenv("SHEET_WRITE_MAX_ROWS", "200"))  # đủ số dòng → flush sớm
+
+# Cột "Thanh Toan": A=Tele ID, B=username, C=số dư, D=trạng thái, E=nguồn, F=ghi chú
+USER_COLS = {"username": 2, "balance": 3, "status": 4, "source": 5, "note": 6}
+USER_FIELDS = {col: name for name, col in USER_COLS.items()}
+COL_LETTERS = " ABCDEF"
+
+def _parse_balance(value):
+    value = str(value).strip()
+    return int(value) if value.isdigit() else 0
+
+@dataclass
+class UserRecord:
+    user_id: str
+    row: int
+    username: str = ""
+    balance: int = 0
+    status: str = ""
+    source: str = ""
+    note: str = ""
+    loaded_at: float = 0.0
+
+    @classmethod
+    def from_row(cls, row, data):
+        data = list(data) + [""] * (6 - len(data))
+        return cls(
+            user_id=str(data[0]).strip(),
+            row=row,
+            username=str(data[1] or ""),
+            balance=_parse_balance(data[2]),
+            status=str(data[3] or ""),
+            source=str(data[4] or ""),
+            note=str(data[5] or ""),
+            loaded_at=time.time(),
+        )
+
+    def sheet_values(self):
+        """Giá trị cột B..F để ghi lại vào "Thanh Toan" """
+        return [self.username, self.balance, self.status, self.source, self.note]
+
+_user_cache = {}  # "user_id" -> UserRecord
+_user_cache_lock = threading.Lock()
+
+def _user_cache_put(rec):
+    with _user_cache_lock:
+        _user_cache[rec.user_id] = rec
+
+def invalidate_user_record(user_id):
+    with _user_cache_lock:
+        _user_cache.pop(str(user_id), None)
+
+def sheet_get_user_record(user_id, fresh=False):
+    """
+    Trả về UserRecord (cache TTL), None nếu chưa có user / lỗi đọc.
+    Cache miss = đúng 1 lần row_values.
+    """
+    if not sheets_ready():
+        return None
+
+    key = str(user_id)
+    # Còn ghi chờ flush → Sheet chưa có, bản trong RAM mới là bản đúng
+    rec = SHEET_WRITES.pending_record(key)
+    if rec is not None:
+        return rec
+
+    rec = _user_cache.get(key)
+    if rec and not fresh and time.time() - rec.loaded_at < USER_CACHE_TTL:
+        return rec
+
+    row = get_user_row(user_id)
+    if not row:
+        invalidate_user_record(user_id)
+        return None
+
+    try:
+        data = ws_money.row_values(row)
+        if not data or str(data[0]).strip() != key:
+            # Sheet bị chèn / xóa dòng → index lệch, dựng lại
+            invalidate_user_index()
+            row = get_user_row(user_id)
+            if not row:
+                invalidate_user_record(user_id)
+                return None
+            data = ws_money.row_values(row)
+
+        rec = UserRecord.from_row(row, data)
+        _user_cache_put(rec)
+        return rec
+    except Exception as e:
+        sheet_error("get_user_record", e)
+        invalidate_user_record(user_id)
+        # Đọc lỗi ≠ chưa có user → không trả None
+        raise e if isinstance(e, SheetsUnavailable) else SheetsUnavailable(f"user record: {e}") from e
+
+def sheet_update_user_record(user_id, **fields):
+    """
+    Cập nhật cache tại chỗ rồi đưa các ô thay đổi cho SHEET_WRITES
+    (gộp nhiều lệnh ghi thành 1 batch_update, hoặc ghi ngay khi window = 0
+    / khi ghi ở PRIO_PAYMENT).
+    """
+    rec = sheet_get_user_record(user_id)
+    if rec is None:
+        raise LookupError(f"user {user_id} not found")
+
+    old = {name: getattr(rec, name) for name in fields}
+    for name, value in fields.items():
+        setattr(rec, name, value)
+
+    try:
+        SHEET_WRITES.write(rec, [USER_COLS[name] for name in fields])
+    except Exception:
+        # rec có thể đang nằm trong hàng chờ → trả lại giá trị cũ, không để lọt lên Sheet
+        for name, value in old.items():
+            setattr(rec, name, value)
+        invalidate_user_record(user_id)
+        raise
+    return rec
+
+class SheetWriteCoalescer:
+    """
+    Write-behind cho "Thanh Toan": gom ô thay đổi theo dòng trong window giây,
+    flush bằng 1 ws_money.batch_update (mỗi dòng 1 khoảng cột liền kề).
+    - Read-your-writes: dòng còn chờ → sheet_get_user_record trả bản trong RAM
+    - Flush lỗi → giữ lại, gộp với ghi mới, thử lại sau (backoff)
+    - atexit: flush hết trước khi thoát
+    window = 0 → ghi đồng bộ ngay trong request (Vercel).
+    Ghi ở PRIO_PAYMENT (cộng tiền SePay) luôn đồng bộ, kèm các ô còn chờ
+    của dòng đó: số dư phải lên Sheet trước khi ghi dòng "Nap Tien" và
+    inbox đánh dấu xong, không thì crash / flush lỗi là mất tiền của khách.
+    """
+
+    def __init__(self, window, max_rows):
+        self.window = window
+        self.max_rows = max_rows
+        self._pending = {}      # row -> (UserRecord, {col})
+        self._rows = {}         # "user_id" -> row
+        self._inflight = {}     # "user_id" -> UserRecord đang gửi (chưa chắc đã lên Sheet)
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()  # flush nền và ghi đồng bộ không gửi chéo nhau
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"writes": 0, "flushes": 0, "cells": 0, "failed_flushes": 0, "sync_writes": 0}
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sheet-writes", daemon=True)
+                self._thread.start()
+
+    def pending_record(self, user_id):
+        if not self._rows and not self._inflight:
+            return None
+        key = str(user_id)
+        with self._lock:
+            row = self._rows.get(key)
+            return self._pending[row][0] if row else self._inflight.get(key)
+
+    def _merge(self, rec, cols):
+        item = self._pending.get(rec.row)
+        if item is None:
+            self._pending[rec.row] = (rec, set(cols))
+        else:
+            item[1].update(cols)
+        self._rows[rec.user_id] = rec.row
+
+    def write(self, rec, cols):
+        self.stats["writes"] += 1
+        if self.window <= 0 or getattr(_sheets_ctx, "priority", PRIO_USER) == PRIO_PAYMENT:
+            self._write_now(rec, set(cols))
+            return
+        self._ensure_started()
+        with self._lock:
+            self._merge(rec, cols)
+            full = len(self._pending) >= self.max_rows
+        if full:
+            self._wake.set()
+
+    def _write_now(self, rec, cols):
+        """Ghi đồng bộ 1 dòng, gộp luôn ô còn chờ của dòng đó; lỗi → raise"""
+        with self._lock:
+            queued = self._pending.pop(rec.row, None)
+            if queued is not None:
+                self._rows.pop(rec.user_id, None)
+                cols |= queued[1]
+        try:
+            self._send({rec.row: (rec, cols)})
+        except Exception:
+            if queued is not None:
+                with self._lock:
+                    self._merge(rec, queued[1])
+            raise
+        self.stats["sync_writes"] += 1
+
+    @sheets_priority(PRIO_PAYMENT)
+    def _send(self, batch):
+        # Đọc giá trị trong lock: lần gửi sau luôn mang giá trị mới nhất
+        with self._send_lock:
+            data = []
+            cells = 0
+            for row, (rec, cols) in batch.items():
+                lo, hi = min(cols), max(cols)
+                values = [getattr(rec, USER_FIELDS[col]) for col in range(lo, hi + 1)]
+                rng = f"{COL_LETTERS[lo]}{row}" if lo == hi else f"{COL_LETTERS[lo]}{row}:{COL_LETTERS[hi]}{row}"
+                data.append({"range": rng, "values": [values]})
+                cells += len(values)
+            ws_money.batch_update(data)
+        self.stats["flushes"] += 1
+        self.stats["cells"] += cells
+
+    def flush(self):
+        """Ghi hết các dòng đang chờ, True nếu thành công"""
+        with self._lock:
+            batch, self._pending, self._rows = self._pending, {}, {}
+            self._inflight = {rec.user_id: rec for rec, _ in batch.values()}
+        if not batch:
+            return True
+        try:
+            self._send(batch)
+            return True
+        except Exception as e:
+            self.stats["failed_flushes"] += 1
+            sheet_error("sheet write flush", e)
+            with self._lock:
+                for rec, cols in batch.values():
+                    self._merge(rec, cols)
+            return False
+        finally:
+            with self._lock:
+                self._inflight = {}
+
+    def _run(self):
+        failures = 0
+        while not self._stop.is_set():
+            delay = self.window if not failures else min(30, self.window * 2 ** failures)
+            self._wake.wait(delay)
+            self._wake.clear()
+            failures = 0 if self.flush() else failures + 1
+
+    def close(self, timeout=5):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        for attempt in range(3):
+            if self.flush():
+                return
+            time.sleep(0.5 * 2 ** attempt)
+
+    def metrics(self):
+        return dict(self.stats, pending_rows=len(self._pending))
+
+SHEET_WRITES = SheetWriteCoalescer(SHEET_WRITE_WINDOW, SHEET_WRITE_MAX_ROWS)
+atexit.register(SHEET_WRITES.close)
+
+def sheet_ensure_user(user_id, username):
+    if not sheets_ready():
+        return None
+
+    row = get_user_row(user_id)
+    if row:
+        return row
+
+    values = [
+        str(user_id),
+        username,
+        0,
+        "active",
+        "auto từ bot"
+    ]
+    try:
+        resp = ws_money.append_row(values)
+        row = _row_from_updated_range(resp)
+        if row:
+            _user_index_set(user_id, row)
+            _user_cache_put(UserRecord.from_row(row, values))
+            return row
+    except Exception as e:
+        sheet_error("ensure_user_exists", e)
+
+    invalidate_user_index()
+    return get_user_row(user_id)
+
+# =========================================================
+# TOPUP UNIQUE (ANTI DUPLICATE)
+# =========================================================
+TX_BLOOM_BITS = int(os.getenv("TX_BLOOM_BITS", "0"))    # 0 = tắt Bloom filter
+TX_HISTORY_TTL = int(os.getenv("TX_HISTORY_TTL", "300")) # lịch sử: index cũ hơn TTL → đọc nền các dòng mới
+TX_RELOAD_TTL = int(os.getenv("TX_RELOAD_TTL", "3600"))  # tải lại cả tab (nền) để bắt dòng bị sửa / xóa tay
+
+class BloomFilter:
+    """Bloom filter nhỏ (double hashing trên blake2b) để loại nhanh tx mới"""
+
+    def __init__(self, n_bits, n_hashes=4):
+        self.size = max(8, n_bits)
+        self.k = n_hashes
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        h = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(h[:8], "little")
+        h2 = int.from_bytes(h[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.k)]
+
+    def add(self, item):
+        for p in self._positions(item):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+class TxIndex:
+    """
+    Index tab "Nap Tien":
+    - ids: tập tx_id (cột F) → tx đã nạp trả True không cần gọi API.
+      Miss (tx mới, hoặc instance khác / nhập tay vừa ghi) → đọc lại cột F
+      rồi mới trả False: Sheet là tập tx dùng chung giữa các instance / lần restart
+    - by_user: Tele ID -> [(time, số tiền, tx_id)] theo thứ tự sheet → lịch sử O(k),
+      tải cả tab lần đầu xem lịch sử; index cũ → đọc nền các dòng sau dòng đã index
+      (1 batch_get nhỏ), tải lại cả tab sau reload_ttl
+    Cập nhật bởi save_topup_to_sheet, không gọi API.
+    """
+
+    def __init__(self, bloom_bits=0, history_ttl=300, reload_ttl=3600):
+        self.history_ttl = history_ttl
+        self.reload_ttl = reload_ttl
+        self.bloom_bits = bloom_bits
+        self.ids = set()
+        self.by_user = {}
+        self.bloom = BloomFilter(bloom_bits) if bloom_bits else None
+        self.rows = 0           # số dòng sheet đã index vào by_user (kể cả header)
+        self.loaded_at = 0.0    # lần cuối by_user khớp sheet
+        self.full_at = 0.0      # lần cuối tải cả tab
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def load_ids(self):
+        """Đọc cột F (1 lệnh, 1 cột) → gộp vào ids"""
+        column = ws_nap_tien.col_values(6)[1:]
+        with self._lock:
+            for tx_id in column:
+                tx_id = str(tx_id).strip()
+                if tx_id and tx_id not in self.ids:
+                    self.ids.add(tx_id)
+                    if self.bloom is not None:
+                        self.bloom.add(tx_id)
+
+    def load(self):
+        values = ws_nap_tien.get_all_values()
+        ids, by_user = set(), {}
+        for row in values[1:]:
+            self._index_row(row, ids, by_user)
+        bloom = None
+        if self.bloom_bits:
+            bloom = BloomFilter(self.bloom_bits)
+            for t in ids:
+                bloom.add(t)
+        with self._lock:
+            self.ids, self.by_user, self.bloom = ids, by_user, bloom
+            self.rows = len(values)
+            self.loaded_at = self.full_at = time.time()
+        dprint(f"Tx index loaded: {len(ids)} tx, {len(by_user)} users")
+
+    def load_tail(self):
+        """Index các dòng thêm sau lần đọc trước (instance khác / nhập tay)"""
+        start = self.rows + 1
+        values = ws_nap_tien.batch_get([f"A{start}:G"])[0]
+        with self._lock:
+            for row in values:
+                tx_id = str(row[5]).strip() if len(row) > 5 else ""
+                # Dòng do add() ghi đã có trong by_user → bỏ qua
+                if tx_id and tx_id in self._user_tx(str(row[1]).strip()):
+                    continue
+                self._index_row(row, self.ids, self.by_user)
+                if tx_id and self.bloom is not None:
+                    self.bloom.add(tx_id)
+            self.rows = start - 1 + len(values)
+            self.loaded_at = time.time()
+        if values:
+            dprint(f"Tx index: +{len(values)} rows")
+
+    def _user_tx(self, user_id):
+        return {tx_id for _, _, tx_id in self.by_user.get(user_id, ())}
+
+    @staticmethod
+    def _index_row(row, ids, by_user):
+        if len(row) < 6:
+            row = list(row) + [""] * (6 - len(row))
+        tx_id = str(row[5]).strip()
+        if tx_id:
+            ids.add(tx_id)
+        user_id = str(row[1]).strip()
+        if user_id:
+            # Số tiền giữ nguyên chuỗi, chỉ parse k dòng khi xem lịch sử
+            by_user.setdefault(user_id, []).append((row[0], row[3], tx_id))
+
+    def add(self, row):
+        tx_id = str(row[5]).strip()
+        with self._lock:
+            self.ids.add(tx_id)
+            if self.bloom is not None:
+                self.bloom.add(tx_id)
+            if self.loaded_at:
+                self.by_user.setdefault(str(row[1]).strip(), []).append((row[0], row[3], tx_id))
+
+    def _refresh(self):
+        try:
+            with sheets_priority(PRIO_LOW):
+                if time.time() - self.full_at > self.reload_ttl:
+                    self.load()
+                else:
+                    self.load_tail()
+        except Exception as e:
+            sheet_error("tx index refresh", e)
+        finally:
+            self._refreshing = False
+
+    def _ensure_fresh(self, ttl):
+        if not self.loaded_at:
+            self.load()
+            return
+        if time.time() - self.loaded_at <= ttl or self._refreshing:
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh, name="tx-index-refresh", daemon=True).start()
+
+    def _seen(self, tx_id):
+        if self.bloom is not None and tx_id not in self.bloom:
+            return False
+        return tx_id in self.ids
+
+    def contains(self, tx_id):
+        tx_id = str(tx_id).strip()
+        if self._seen(tx_id):
+            return True
+        # Miss → xác nhận trên Sheet trước khi cộng tiền (SePay gửi lại tới
+        # instance khác / sau restart thì set trong RAM chưa có tx này)
+        self.load_ids()
+        return self._seen(tx_id)
+
+    def history(self, user_id, limit):
+        """limit giao dịch gần nhất của user: [(time, số tiền (chuỗi ô), tx_id)]"""
+        self._ensure_fresh(self.history_ttl)
+        return self.by_user.get(str(user_id), [])[-limit:]
+
+TX_INDEX = TxIndex(TX_BLOOM_BITS, TX_HISTORY_TTL, TX_RELOAD_TTL)
+
+# =========================================================
+# PER-USER LOCK (striped, số lock cố định)
+# =========================================================
+USER_LOCK_STRIPES = 256
+_user_locks = [threading.Lock() for _ in range(USER_LOCK_STRIPES)]
+
+def user_lock(user_id):
+    return _user_locks[hash(str(user_id)) % USER_LOCK_STRIPES]
+
+# =========================================================
+# STORAGE BACKEND (sheets | sqlite)
+# =========================================================
+# Interface chung (users, vouchers, topups, logs):
+#   ready() / report_error(e)
+#   get_user(user_id, fresh) -> UserRecord | None
+#   ensure_user(user_id, username) -> row | None
+#   update_user(user_id, **fields) -> UserRecord
+#   apply_delta(user_id, delta, reason, ref, fields, guard) -> (ok, balance, code)
+#   load_ban_notes() -> [(user_id, note)] (chỉ dòng có "BAN")
+#   load_vouchers() -> [record]
+#   has_topup(tx_id) / add_topup(row) / user_topups(user_id, limit)
+#   append_log(row)
+STORAGE_BACKEND    = os.getenv("STORAGE_BACKEND", "sheets").strip().lower()
+SQLITE_PATH        = os.getenv("SQLITE_PATH", "bot.db")
+REPLICATE_INTERVAL = float(os.getenv("REPLICATE_INTERVAL", "2"))
+REPLICATE_BATCH    = int(os.getenv("REPLICATE_BATCH", "200"))
+SHEET_PULL_INTERVAL = float(os.getenv("SHEET_PULL_INTERVAL", "30"))  # đọc lại số dư / ghi chú staff sửa tay
+
+# Thứ tự cột "Nap Tien": time, Tele ID, username, số tiền, loại, tx_id, note
+TOPUP_COLS = ("time", "Tele ID", "username", "số tiền", "loại", "tx_id", "note")
+
+class SheetsStorage:
+    """Google Sheets là nơi lưu chính (như trước), qua các cache ở trên"""
+
+    name = "sheets"
+
+    # ref đã áp dụng gần đây (Sheet không có cột ref; tx cũ đã có TX_INDEX)
+    APPLIED_REFS_MAX = 10000
+
+    def __init__(self):
+        self._applied_refs = OrderedDict()
+
+    def ready(self):
+        return sheets_ready()
+
+    def report_error(self, e):
+        SHEETS.report_error(e)
+
+    def get_user(self, user_id, fresh=False):
+        return sheet_get_user_record(user_id, fresh)
+
+    def ensure_user(self, user_id, username):
+        return sheet_ensure_user(user_id, username)
+
+    def update_user(self, user_id, **fields):
+        return sheet_update_user_record(user_id, **fields)
+
+    def apply_delta(self, user_id, delta, reason, ref="", fields=None, guard=None):
+        # Sheet không có transaction → khoá theo user trong process, và đọc lại
+        # dòng ngay trong khoá (1 row_values): instance khác (Vercel) có thể vừa
+        # đổi số dư, bản cache USER_CACHE_TTL giây sẽ ghi đè mất
+        with user_lock(user_id):
+            rec = sheet_get_user_record(user_id, fresh=True)
+            if rec is None:
+                return False, 0, "NO_USER"
+            if ref and ref in self._applied_refs:
+                return False, rec.balance, "DUPLICATE"
+            if guard is not None and not guard(rec):
+                return False, rec.balance, "REJECTED"
+            new_bal = rec.balance + delta
+            if new_bal < 0:
+                return False, rec.balance, "INSUFFICIENT"
+            sheet_update_user_record(user_id, balance=new_bal, **(fields or {}))
+            if ref:
+                self._applied_refs[ref] = True
+                if len(self._applied_refs) > self.APPLIED_REFS_MAX:
+                    self._applied_refs.popitem(last=False)
+            return True, new_bal, "OK"
+
+    def load_ban_notes(self):
+        ids, notes = ws_money.batch_get(["A2:A", "F2:F"])
+        for i, row in enumerate(ids):
+            note = notes[i] if i < len(notes) else []
+            if row and note and "BAN" in str(note[0]).upper():
+                yield row[0], note[0]
+
+    def load_vouchers(self):
+        return ws_voucher.get_all_records()
+
+    def has_topup(self, tx_id):
+        if ws_nap_tien is None:
+            return False
+        return TX_INDEX.contains(tx_id)
+
+    def add_topup(self, row):
+        if ws_nap_tien is None:
+            return
+        ws_nap_tien.append_row(row)
+        TX_INDEX.add(row)
+
+    @sheets_priority(PRIO_LOW)
+    def user_topups(self, user_id, limit):
+        if ws_nap_tien is None:
+            raise LookupError("Nap Tien tab not found")
+        return [
+            {"time": t, "số tiền": _parse_balance(str(amount).replace(",", "")), "tx_id": tx_id}
+            for t, amount, tx_id in TX_INDEX.history(user_id, limit)
+        ]
+
+    def append_log(self, row):
+        if LOG_ASYNC:
+            LOG_BUFFER.put(row)
+            return
+        ws_log.append_row(row)
+
+class SQLiteStorage:
+    """
+    SQLite (WAL) là nơi lưu chính: đọc/ghi số dư ~micro giây.
+    Mỗi thay đổi ghi thêm 1 dòng sheet_outbox trong cùng transaction;
+    SheetReplicator đẩy dần lên các tab cũ để staff vẫn xem trên Sheet,
+    và đọc ngược số dư / ghi chú (ban) staff sửa tay trên "Thanh Toan".
+    Lần đầu (DB trống) nạp users + topups từ Sheet.
+    """
+
+    name = "sqlite"
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id  TEXT PRIMARY KEY,
+        username TEXT NOT NULL DEFAULT '',
+        balance  INTEGER NOT NULL DEFAULT 0,
+        status   TEXT NOT NULL DEFAULT '',
+        source   TEXT NOT NULL DEFAULT '',
+        note     TEXT NOT NULL DEFAULT '',
+        sheet_balance INTEGER,   -- số dư / ghi chú trên Sheet lần cuối bot ghi / đọc
+        sheet_note    TEXT       -- (NULL = chưa biết) → khác đi là staff sửa tay
+    );
+    CREATE TABLE IF NOT EXISTS vouchers (
+        pos  INTEGER PRIMARY KEY,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS topups (
+        id       INTEGER PRIMARY KEY AUTOINCREMENT,
+        time     TEXT NOT NULL,
+        user_id  TEXT NOT NULL,
+        username TEXT NOT NULL DEFAULT '',
+        amount   INTEGER NOT NULL,
+        loai     TEXT NOT NULL DEFAULT '',
+        tx_id    TEXT UNIQUE,
+        note     TEXT NOT NULL DEFAULT ''
+    );
+    CREATE INDEX IF NOT EXISTS topups_user ON topups(user_id, id);
+    CREATE TABLE IF NOT EXISTS logs (
+        id       INTEGER PRIMARY KEY AUTOINCREMENT,
+        time     TEXT NOT NULL,
+        user_id  TEXT NOT NULL,
+        username TEXT NOT NULL DEFAULT '',
+        action   TEXT NOT NULL,
+        value    TEXT NOT NULL DEFAULT '',
+        note     TEXT NOT NULL DEFAULT ''
+    );
+    CREATE TABLE IF NOT EXISTS ledger (
+        id      INTEGER PRIMARY KEY AUTOINCREMENT,
+        time    TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        delta   INTEGER NOT NULL,
+        balance INTEGER NOT NULL,   -- số dư sau giao dịch
+        reason  TEXT NOT NULL,
+        ref     TEXT
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS ledger_ref ON ledger(ref) WHERE ref IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS ledger_user ON ledger(user_id, id);
+    CREATE TABLE IF NOT EXISTS sheet_outbox (
+        id   INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,   -- user | topup | log
+        ref  TEXT NOT NULL    -- user_id | topups.id | logs.id
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        key   TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._seeded = False
+        self._seed_lock = threading.Lock()
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+        # DB tạo trước khi có cột sheet_* → thêm cột
+        cols = {r["name"] for r in conn.execute("PRAGMA table_info(users)")}
+        for col, decl in (("sheet_balance", "INTEGER"), ("sheet_note", "TEXT")):
+            if col not in cols:
+                conn.execute(f"ALTER TABLE users ADD COLUMN {col} {decl}")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite_connect(self.path)
+        return conn
+
+    @contextmanager
+    def _tx(self):
+        """Transaction ghi (BEGIN IMMEDIATE: khoá ghi ngay, an toàn giữa nhiều process)"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    # ----- seed / ready -----
+    def ready(self):
+        if self._seeded:
+            return True
+        with self._seed_lock:
+            if self._seeded:
+                return True
+            row = self._conn().execute("SELECT value FROM meta WHERE key = 'seeded'").fetchone()
+            if row is None:
+                if CREDS_JSON:
+                    # DB mới → cần Sheet để nạp dữ liệu cũ
+                    if not sheets_ready():
+                        return False
+                    self.seed_from_sheets()
+                with self._tx() as conn:
+                    conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('seeded', ?)", (now_str(),))
+            self._seeded = True
+            return True
+
+    def seed_from_sheets(self):
+        users = []
+        for values in ws_money.get_all_values():
+            uid = str(values[0]).strip() if values else ""
+            if not uid.isdigit():
+                continue  # header / dòng trống
+            rec = UserRecord.from_row(0, values)
+            users.append((uid, rec.username, rec.balance, rec.status, rec.source, rec.note,
+                          rec.balance, rec.note))
+
+        topups = []
+        if ws_nap_tien is not None:
+            for values in ws_nap_tien.get_all_values()[1:]:
+                values = list(values) + [""] * (7 - len(values))
+                if not str(values[1]).strip():
+                    continue
+                tx_id = str(values[5]).strip() or None
+                topups.append((values[0], str(values[1]).strip(), values[2],
+                               _parse_balance(values[3]), values[4], tx_id, values[6]))
+
+        with self._tx() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO users(user_id, username, balance, status, source, note, "
+                "sheet_balance, sheet_note) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", users)
+            conn.executemany(
+                "INSERT OR IGNORE INTO topups(time, user_id, username, amount, loai, tx_id, note) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", topups)
+        print(f"✅ SQLite seeded from Sheets: {len(users)} users, {len(topups)} topups")
+
+    def report_error(self, e):
+        pass
+
+    # ----- users -----
+    def _record(self, r):
+        return UserRecord(
+            user_id=r["user_id"], row=r["rowid"], username=r["username"], balance=r["balance"],
+            status=r["status"], source=r["source"], note=r["note"], loaded_at=time.time(),
+        )
+
+    def get_user(self, user_id, fresh=False):
+        r = self._conn().execute(
+            "SELECT rowid, * FROM users WHERE user_id = ?", (str(user_id),)
+        ).fetchone()
+        return self._record(r) if r else None
+
+    def ensure_user(self, user_id, username):
+        with self._tx() as conn:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO users(user_id, username, balance, status, source) "
+                "VALUES (?, ?, 0, 'active', 'auto từ bot')", (str(user_id), username or ""))
+            if cur.rowcount:
+                conn.execute("INSERT INTO sheet_outbox(kind, ref) VALUES ('user', ?)", (str(user_id),))
+        rec = self.get_user(user_id)
+        return rec.row if rec else None
+
+    def update_user(self, user_id, **fields):
+        cols = [name for name in fields if name in USER_COLS]
+        sets = ", ".join(f"{name} = ?" for name in cols)
+        with self._tx() as conn:
+            cur = conn.execute(
+                f"UPDATE users SET {sets} WHERE user_id = ?",
+                [fields[name] for name in cols] + [str(user_id)])
+            if not cur.rowcount:
+                raise LookupError(f"user {user_id} not found")
+            conn.execute("INSERT INTO sheet_outbox(kind, ref) VALUES ('user', ?)", (str(user_id),))
+        return self.get_user(user_id)
+
+    def apply_delta(self, user_id, delta, reason, ref="", fields=None, guard=None):
+        """
+        Ledger append-only + users.balance (số dư materialised) trong 1 transaction.
+        BEGIN IMMEDIATE tuần tự hoá mọi thread / process ghi cùng DB.
+        """
+        fields = {k: v for k, v in (fields or {}).items() if k in USER_COLS and k != "balance"}
+        with self._tx() as conn:
+            r = conn.execute("SELECT rowid, * FROM users WHERE user_id = ?", (str(user_id),)).fetchone()
+            if r is None:
+                return False, 0, "NO_USER"
+            rec = self._record(r)
+
+            if ref and conn.execute("SELECT 1 FROM ledger WHERE ref = ?", (ref,)).fetchone():
+                return False, rec.balance, "DUPLICATE"
+            if guard is not None and not guard(rec):
+                return False, rec.balance, "REJECTED"
+            new_bal = rec.balance + delta
+            if new_bal < 0:
+                return False, rec.balance, "INSUFFICIENT"
+
+            sets = ", ".join(["balance = ?"] + [f"{k} = ?" for k in fields])
+            conn.execute(f"UPDATE users SET {sets} WHERE user_id = ?",
+                         [new_bal] + list(fields.values()) + [str(user_id)])
+            conn.execute(
+                "INSERT INTO ledger(time, user_id, delta, balance, reason, ref) VALUES (?, ?, ?, ?, ?, ?)",
+                (now_str(), str(user_id), delta, new_bal, reason, ref or None))
+            conn.execute("INSERT INTO sheet_outbox(kind, ref) VALUES ('user', ?)", (str(user_id),))
+        return True, new_bal, "OK"
+
+    def load_ban_notes(self):
+        return self._conn().execute(
+            "SELECT user_id, note FROM users WHERE note LIKE '%BAN%'"
+        ).fetchall()
+
+    # ----- vouchers -----
+    def load_vouchers(self):
+        """VoucherStock do staff sửa trên Sheet → lấy từ Sheet, lưu bản sao để chạy khi Sheet lỗi"""
+        if CREDS_JSON and sheets_ready():
+            try:
+                rows = ws_voucher.get_all_records()
+                with self._tx() as conn:
+                    conn.execute("DELETE FROM vouchers")
+                    conn.executemany(
+                        "INSERT INTO vouchers(pos, data) VALUES (?, ?)",
+                        [(i, json.dumps(r, ensure_ascii=False)) for i, r in enumerate(rows)])
+                return rows
+            except Exception as e:
+                sheet_error("load_vouchers", e)
+        cur = self._conn().execute("SELECT data FROM vouchers ORDER BY pos")
+        return [json.loads(r["data"]) for r in cur]
+
+    # ----- topups -----
+    def has_topup(self, tx_id):
+        r = self._conn().execute("SELECT 1 FROM topups WHERE tx_id = ?", (str(tx_id),)).fetchone()
+        return r is not None
+
+    def add_topup(self, row):
+        t, user_id, username, amount, loai, tx_id, note = row
+        with self._tx() as conn:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO topups(time, user_id, username, amount, loai, tx_id, note) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", (t, user_id, username, amount, loai, tx_id or None, note))
+            if cur.rowcount:
+                conn.execute("INSERT INTO sheet_outbox(kind, ref) VALUES ('topup', ?)", (str(cur.lastrowid),))
+
+    def user_topups(self, user_id, limit):
+        cur = self._conn().execute(
+            "SELECT time, amount, tx_id FROM topups WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+            (str(user_id), limit))
+        rows = [{"time": r["time"], "số tiền": r["amount"], "tx_id": r["tx_id"]} for r in cur]
+        return rows[::-1]
+
+    # ----- logs -----
+    def append_log(self, row):
+        with self._tx() as conn:
+            cur = conn.execute(
+                "INSERT INTO logs(time, user_id, username, action, value, note) VALUES (?, ?, ?, ?, ?, ?)",
+                [str(v) for v in row])
+            conn.execute("INSERT INTO sheet_outbox(kind, ref) VALUES ('log', ?)", (str(cur.lastrowid),))
+
+    # ----- đồng bộ 2 chiều với "Thanh Toan" (dùng bởi SheetReplicator) -----
+    def merge_sheet_edits(self, rows):
+        """
+        rows: [(user_id, số dư, ghi chú)] đọc từ Sheet. So với giá trị Sheet lần
+        cuối bot biết: số dư khác → staff cộng/trừ tay, áp phần chênh qua ledger
+        (SHEET_EDIT); ghi chú khác (ban / gỡ ban) → chép vào users.
+        User chỉ có trên Sheet (staff thêm tay) → thêm vào DB.
+        Return: số thay đổi đã áp.
+        """
+        changed = 0
+        with self._tx() as conn:
+            known = {r["user_id"]: r for r in conn.execute(
+                "SELECT user_id, balance, sheet_balance, sheet_note FROM users")}
+            for uid, balance, note in rows:
+                r = known.get(uid)
+                if r is None:
+                    conn.execute(
+                        "INSERT INTO users(user_id, balance, status, source, note, sheet_balance, sheet_note) "
+                        "VALUES (?, ?, 'active', 'sheet', ?, ?, ?)", (uid, balance, note, balance, note))
+                    changed += 1
+                    continue
+                if r["sheet_balance"] is None or r["sheet_note"] is None:
+                    # Chưa biết Sheet đang hiện gì → lấy làm mốc, không coi là sửa tay
+                    conn.execute("UPDATE users SET sheet_balance = ?, sheet_note = ? WHERE user_id = ?",
+                                 (balance, note, uid))
+                    continue
+                if balance != r["sheet_balance"]:
+                    delta = balance - r["sheet_balance"]
+                    new_bal = r["balance"] + delta
+                    conn.execute("UPDATE users SET balance = ?, sheet_balance = ? WHERE user_id = ?",
+                                 (new_bal, balance, uid))
+                    conn.execute(
+                        "INSERT INTO ledger(time, user_id, delta, balance, reason, ref) VALUES (?, ?, ?, ?, ?, NULL)",
+                        (now_str(), uid, delta, new_bal, "SHEET_EDIT"))
+                    if new_bal != balance:
+                        # Bot cũng vừa đổi số dư → đẩy lại số đã gộp
+                        conn.execute("INSERT INTO sheet_outbox(kind, ref) VALUES ('user', ?)", (uid,))
+                    changed += 1
+                if note != r["sheet_note"]:
+                    conn.execute("UPDATE users SET note = ?, sheet_note = ? WHERE user_id = ?", (note, note, uid))
+                    changed += 1
+        return changed
+
+    def mark_pushed(self, values):
+        """values: [(user_id, số dư, ghi chú)] vừa ghi lên Sheet"""
+        with self._tx() as conn:
+            conn.executemany("UPDATE users SET sheet_balance = ?, sheet_note = ? WHERE user_id = ?",
+                             [(balance, note, uid) for uid, balance, note in values])
+
+    # ----- outbox (dùng bởi SheetReplicator) -----
+    def outbox_batch(self, limit):
+        cur = self._conn().execute("SELECT id, kind, ref FROM sheet_outbox ORDER BY id LIMIT ?", (limit,))
+        return [(r["id"], r["kind"], r["ref"]) for r in cur]
+
+    def outbox_delete(self, ids):
+        with self._tx() as conn:
+            conn.executemany("DELETE FROM sheet_outbox WHERE id = ?", [(i,) for i in ids])
+
+    def outbox_size(self):
+        return self._conn().execute("SELECT COUNT(*) FROM sheet_outbox").fetchone()[0]
+
+    def topup_rows(self, ids):
+        marks = ",".join("?" * len(ids))
+        cur = self._conn().execute(
+            f"SELECT time, user_id, username, amount, loai, tx_id, note FROM topups WHERE id IN ({marks}) ORDER BY id",
+            ids)
+        return [[r["time"], r["user_id"], r["username"], r["amount"], r["loai"], r["tx_id"] or "", r["note"]] for r in cur]
+
+    def log_rows(self, ids):
+        marks = ",".join("?" * len(ids))
+        cur = self._conn().execute(
+            f"SELECT time, user_id, username, action, value, note FROM logs WHERE id IN ({marks}) ORDER BY id",
+            ids)
+        return [list(r) for r in cur]
+
+class SheetReplicator:
+    """
+    Thread nền đẩy sheet_outbox của SQLiteStorage lên Google Sheets:
+    users → batch_update B:F (user mới → append_rows), topups/logs → append_rows.
+    Mỗi loại xoá khỏi outbox ngay khi ghi xong → lỗi giữa chừng không ghi trùng.
+    Mỗi pull_interval giây, trước khi đẩy: đọc cột A/C/F (1 batch_get) để lấy
+    số dư / ghi chú staff sửa tay, không ghi đè mất.
+    """
+
+    def __init__(self, store, interval, batch, pull_interval=30):
+        self.store = store
+        self.interval = interval
+        self.batch = batch
+        self.pull_interval = pull_interval
+        self.stats = {"rounds": 0, "users": 0, "topups": 0, "logs": 0, "errors": 0, "sheet_edits": 0}
+        self._pulled_at = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sheet-replicator", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                while self.replicate_once() >= self.batch:
+                    pass
+            except Exception as e:
+                self.stats["errors"] += 1
+                sheet_error("replicator", e)
+
+    @staticmethod
+    def _sheet_int(value):
+        """Ô số dư (UNFORMATTED_VALUE: int / float / chuỗi) → int, None nếu không chắc là số"""
+        if isinstance(value, (int, float)):
+            return int(value)
+        value = str(value).strip().replace(",", "").replace(".", "").replace(" ", "")
+        return int(value) if value.lstrip("-").isdigit() else None
+
+    def pull_once(self):
+        """Số dư / ghi chú trên Sheet → SQLite (staff sửa tay)"""
+        ids, balances, notes = ws_money.batch_get(["A2:A", "C2:C", "F2:F"],
+                                                  value_render_option="UNFORMATTED_VALUE")
+        rows = []
+        for i, cell in enumerate(ids):
+            uid = str(cell[0]).strip() if cell else ""
+            bal = balances[i] if i < len(balances) else []
+            balance = self._sheet_int(bal[0]) if bal else None
+            if not uid.isdigit() or balance is None:
+                continue  # dòng trống / ô số dư trống hoặc lạ: không đoán
+            note = notes[i] if i < len(notes) else []
+            rows.append((uid, balance, str(note[0]) if note else ""))
+        changed = self.store.merge_sheet_edits(rows)
+        self._pulled_at = time.time()
+        if changed:
+            self.stats["sheet_edits"] += changed
+            dprint(f"Sheet edits merged: {changed}")
+        return changed
+
+    def _push_users(self, user_ids):
+        updates = []
+        appends = []
+        pushed = []
+        for uid in user_ids:
+            rec = self.store.get_user(uid)
+            if rec is None:
+                continue
+            row = get_user_row(uid)
+            if row:
+                updates.append({"range": f"B{row}:F{row}", "values": [rec.sheet_values()]})
+            else:
+                appends.append([uid] + rec.sheet_values())
+            pushed.append((uid, rec.balance, rec.note))
+
+        if updates:
+            ws_money.batch_update(updates)
+        if appends:
+            first = _row_from_updated_range(ws_money.append_rows(appends))
+            if first:
+                for i, values in enumerate(appends):
+                    _user_index_set(values[0], first + i)
+            else:
+                invalidate_user_index()
+        self.store.mark_pushed(pushed)
+
+    @sheets_priority(PRIO_LOW)
+    def replicate_once(self):
+        if not sheets_ready():
+            return 0
+        if time.time() - self._pulled_at >= self.pull_interval:
+            # Đọc trước khi đẩy → lần đẩy này mang luôn phần staff sửa
+            self.pull_once()
+        entries = self.store.outbox_batch(self.batch)
+        if not entries:
+            return 0
+
+        by_kind = {"user": [], "topup": [], "log": []}
+        for entry_id, kind, ref in entries:
+            by_kind.setdefault(kind, []).append((entry_id, ref))
+
+        users = by_kind["user"]
+        if users:
+            self._push_users(list(dict.fromkeys(ref for _, ref in users)))
+            self.store.outbox_delete([i for i, _ in users])
+            self.stats["users"] += len(users)
+
+        topups = by_kind["topup"]
+        if topups:
+            if ws_nap_tien is not None:
+                ws_nap_tien.append_rows(self.store.topup_rows([int(ref) for _, ref in topups]))
+            self.store.outbox_delete([i for i, _ in topups])
+            self.stats["topups"] += len(topups)
+
+        logs = by_kind["log"]
+        if logs:
+            ws_log.append_rows(self.store.log_rows([int(ref) for _, ref in logs]))
+            self.store.outbox_delete([i for i, _ in logs])
+            self.stats["logs"] += len(logs)
+
+        self.stats["rounds"] += 1
+        return len(entries)
+
+    def flush(self):
+        """Đẩy hết outbox (khi shutdown)"""
+        self._stop.set()
+        try:
+            while self.replicate_once():
+                pass
+        except Exception as e:
+            print("[REPLICATOR_FLUSH_ERROR]", e)
+
+    def metrics(self):
+        return dict(self.stats, lag=self.store.outbox_size())
+
+REPLICATOR = None
+if STORAGE_BACKEND == "sqlite":
+    STORE = SQLiteStorage(SQLITE_PATH)
+    if CREDS_JSON:
+        REPLICATOR = SheetReplicator(STORE, REPLICATE_INTERVAL, REPLICATE_BATCH, SHEET_PULL_INTERVAL)
+        REPLICATOR.start()
+        atexit.register(REPLICATOR.flush)
+else:
+    STORE = SheetsStorage()
+
+def store_ready():
+    """True nếu backend lưu trữ sẵn sàng phục vụ"""
+    return STORE.ready()
 
 # =========================================================
 # USER / MONEY UTIL
 # =========================================================
-def get_user_row(user_id):
-    if not SHEET_READY:
-        return None
-    try:
-        ids = ws_money.col_values(1)
-        return ids.index(str(user_id)) + 1 if str(user_id) in ids else None
-    except Exception:
+def get_user_record(user_id, fresh=False):
+    if not store_ready():
         return None
+    return STORE.get_user(user_id, fresh)
+
+def update_user_record(user_id, **fields):
+    return STORE.update_user(user_id, **fields)
 
 def ensure_user_exists(user_id, username):
-    if not SHEET_READY:
+    if not store_ready():
         return None
+    return STORE.ensure_user(user_id, username)
 
-    row = get_user_row(user_id)
-    if row:
-        return row
-
-    try:
-        ws_money.append_row([
-            str(user_id),
-            username,
-            0,
-            "active",
-            "auto từ bot"
-        ])
-    except Exception as e:
-        dprint("ensure_user_exists error:", e)
-
-    return get_user_row(user_id)
-
+@METRICS.timed("bot_stage_seconds", stage="user_lookup")
 def get_user_data(user_id):
-    if not SHEET_READY:
+    if not store_ready():
         return None, 0, ""
 
-    row = get_user_row(user_id)
-    if not row:
+    rec = get_user_record(user_id)
+    if rec is None:
         return None, 0, ""
+    return rec.row, rec.balance, rec.status
 
-    try:
-        data = ws_money.row_values(row)
-        balance = int(data[2]) if len(data) > 2 and str(data[2]).isdigit() else 0
-        status  = data[3] if len(data) > 3 else ""
-        return row, balance, status
-    except Exception:
-        return row, 0, ""
+def change_balance(user_id, delta, reason, ref="", fields=None, guard=None):
+    """
+    Cộng/trừ số dư nguyên tử qua ledger của STORE.
+    - guard(rec) False → không đổi gì (code "REJECTED")
+    - số dư sau < 0 → không đổi gì (code "INSUFFICIENT")
+    - ref đã áp dụng → không cộng lại (code "DUPLICATE")
+    Return: (ok, balance, code)
+    """
+    if not store_ready():
+        return False, 0, "NOT_READY"
 
-def add_balance(user_id, amount):
-    """✅ Optimized with batch update"""
-    if not SHEET_READY:
-        return 0
+    try:
+        return STORE.apply_delta(user_id, int(delta), reason, ref, fields, guard)
+    except SheetsUnavailable:
+        raise
+    except Exception as e:
+        dprint("change_balance error:", e)
+        STORE.report_error(e)
+        return False, 0, "ERROR"
 
-    row = get_user_row(user_id)
-    if not row:
-        row = ensure_user_exists(user_id, "")
+def debit_balance(user_id, amount, reason, ref=""):
+    """Trừ tiền, không cho âm. Return: (ok, balance)"""
+    ok, balance, code = change_balance(user_id, -int(amount), reason, ref)
+    return ok, balance
 
+def refund_balance(user_id, amount, reason, note=""):
+    """Hoàn tiền đã giữ trước; không hoàn được → ghi Logs REFUND_FAILED để đối soát tay"""
     try:
-        bal = int(ws_money.cell(row, 3).value or 0)
-        new_bal = bal + int(amount)
-        
-        # ✅ Single API call
-        ws_money.update_cell(row, 3, new_bal)
-        
-        return new_bal
+        ok, balance, code = change_balance(user_id, int(amount), reason)
     except Exception as e:
-        dprint("add_balance error:", e)
-        return 0
+        ok, balance, code = False, 0, f"EXCEPTION_{e}"
+    if not ok:
+        print("[REFUND_FAILED]", user_id, amount, reason, note, code)
+        log_row(user_id, "", "REFUND_FAILED", str(amount), f"{reason} {note} {code}".strip())
+    return ok, balance
 
 # =========================================================
-# TOPUP UNIQUE (ANTI DUPLICATE)
+# TOPUP
 # =========================================================
 def is_tx_exists(tx_id):
-    if not SHEET_READY or ws_nap_tien is None:
+    if not store_ready():
         return False
 
     try:
-        tx_list = ws_nap_tien.col_values(6)  # cột F = tx_id
-        return str(tx_id) in tx_list
+        return STORE.has_topup(tx_id)
     except Exception as e:
         print("[TX_CHECK_ERROR]", e)
-        return False
+        STORE.report_error(e)
+        # Không biết tx đã nạp chưa → không được coi là chưa nạp
+        raise e if isinstance(e, SheetsUnavailable) else SheetsUnavailable(f"tx check: {e}") from e
 
 def save_topup_to_sheet(user_id, username, amount, loai, tx_id, note=""):
-    if not SHEET_READY or ws_nap_tien is None:
+    if not store_ready():
         return
 
     try:
-        ws_nap_tien.append_row([
+        STORE.add_topup([
             now_str(),  # Vietnam time
             str(user_id),
             username or "",
@@ -533,26 +3163,21 @@ def save_topup_to_sheet(user_id, username, amount, loai, tx_id, note=""):
         ])
     except Exception as e:
         print("[SAVE_TOPUP_ERROR]", e)
+        STORE.report_error(e)
 
 def topup_history_text(user_id, limit=10):
-    if not SHEET_READY or ws_nap_tien is None:
+    if not store_ready():
         return "❌ Hệ thống lịch sử nạp tiền đang lỗi."
 
     try:
-        rows = ws_nap_tien.get_all_records()
-    except Exception:
+        logs = STORE.user_topups(user_id, limit)
+    except Exception as e:
+        STORE.report_error(e)
         return "❌ Không đọc được dữ liệu lịch sử nạp tiền."
 
-    logs = []
-    for r in rows:
-        if str(r.get("Tele ID", "")) == str(user_id):
-            logs.append(r)
-
     if not logs:
         return "📜 <b>Lịch sử nạp tiền</b>\nChưa có giao dịch nào."
 
-    logs = logs[-limit:]
-
     out = ["📜 <b>Lịch sử nạp tiền (SEPAY)</b>"]
     for r in logs:
         out.append(
@@ -566,116 +3191,365 @@ def topup_history_text(user_id, limit=10):
 # =========================================================
 # VOUCHER UTIL
 # =========================================================
+VOUCHER_CACHE_TTL = int(os.getenv("VOUCHER_CACHE_TTL", "60"))
+
+def voucher_key(name):
+    """Chuẩn hoá "Tên Mã": bỏ khoảng trắng, lowercase"""
+    return str(name).replace(" ", "").lower()
+
+class VoucherStock:
+    """
+    Catalog VoucherStock trong RAM:
+    - records: toàn bộ dòng (get_all_records)
+    - by_name: voucher_key -> record (dòng đầu tiên trùng tên)
+    - by_combo: combo -> [record "Còn Mã"] theo thứ tự sheet
+    Refresh theo TTL hoặc thủ công (/reload_voucher).
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.records = []
+        self.by_name = {}
+        self.by_combo = {}
+        self.loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    @METRICS.timed("bot_stage_seconds", stage="voucher_refresh")
+    def refresh(self):
+        rows = STORE.load_vouchers()
+
+        by_name = {}
+        by_combo = {}
+        for r in rows:
+            by_name.setdefault(voucher_key(r.get("Tên Mã", "")), r)
+
+            combo = str(r.get("Combo", "")).strip().lower()
+            if r.get("Trạng Thái") == "Còn Mã":
+                by_combo.setdefault(combo, []).append(r)
+
+        self.records, self.by_name, self.by_combo = rows, by_name, by_combo
+        self.loaded_at = time.time()
+        dprint(f"VoucherStock loaded: {len(rows)} rows")
+        return len(rows)
+
+    def ensure_fresh(self):
+        if time.time() - self.loaded_at <= self.ttl:
+            return
+        with self._lock:
+            if time.time() - self.loaded_at <= self.ttl:
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                STORE.report_error(e)
+                # Còn data cũ → dùng tạm, chưa có gì → báo lỗi
+                if not self.loaded_at:
+                    raise
+                dprint("VoucherStock refresh error (serving stale):", e)
+
+    def find(self, cmd):
+        self.ensure_fresh()
+        return self.by_name.get(cmd.lower())
+
+    def combo(self, combo_key):
+        self.ensure_fresh()
+        return list(self.by_combo.get(combo_key.strip().lower(), []))
+
+VOUCHER_STOCK = VoucherStock(VOUCHER_CACHE_TTL)
+
 def get_voucher(cmd):
-    if not SHEET_READY:
+    if not store_ready():
         return None, "Hệ thống Sheet đang lỗi"
 
     try:
-        rows = ws_voucher.get_all_records()
+        r = VOUCHER_STOCK.find(cmd)
     except Exception:
         return None, "Không đọc được VoucherStock"
 
-    for r in rows:
-        name = str(r.get("Tên Mã", "")).replace(" ", "").lower()
-        if name == cmd.lower():
-            if r.get("Trạng Thái") != "Còn Mã":
-                return None, "Lưu thất Bại. Vui lòng kiểm tra lại cookie - mã"
-            return r, None
+    if r is None:
+        return None, "Không tìm thấy voucher"
 
-    return None, "Không tìm thấy voucher"
+    if r.get("Trạng Thái") != "Còn Mã":
+        return None, "Lưu thất Bại. Vui lòng kiểm tra lại cookie - mã"
+    return r, None
 
-def save_voucher_and_check(cookie, voucher):
-    payload = {
-        "voucher_identifiers": [{
-            "promotion_id": int(voucher.get("Promotionid")),
-            "voucher_code": voucher.get("CODE"),
-            "signature": voucher.get("Signature"),
-            "signature_source": 0
-        }],
-        "need_user_voucher_status": True
-    }
+SHOPEE_POOL_SIZE    = int(os.getenv("SHOPEE_POOL_SIZE", "10"))   # số kết nối tối đa tới shopee.vn
+SHOPEE_TIMEOUT      = float(os.getenv("SHOPEE_TIMEOUT", "15"))
+SHOPEE_RETRIES      = int(os.getenv("SHOPEE_RETRIES", "2"))
+SHOPEE_BUDGET       = float(os.getenv("SHOPEE_BUDGET", str(SHOPEE_TIMEOUT)))  # tổng giây cho 1 mã, kể cả retry
+SHOPEE_BACKOFF_BASE = float(os.getenv("SHOPEE_BACKOFF_BASE", "0.3"))
+
+class ShopeeClient:
+    """
+    Client lưu voucher Shopee:
+    - keep-alive session, giữ lại tối đa SHOPEE_POOL_SIZE kết nối tới host
+    - retry có jitter, CHỈ cho lỗi tạm thời (TIMEOUT, HTTP_5xx), trong ngân sách
+      thời gian chung của mã: timeout mỗi lần = min(timeout, thời gian còn lại),
+      còn dưới MIN_ATTEMPT giây thì thôi retry
+    - histogram latency theo mã kết quả ("OK", "SHOPEE_<n>", "TIMEOUT", ...)
+    """
 
-    headers = {
+    BASE_HEADERS = {
         "Accept": "application/json",
         "Content-Type": "application/json;charset=UTF-8",
         "User-Agent": "Mozilla/5.0",
         "Origin": "https://shopee.vn",
         "Referer": "https://shopee.vn/",
-        "Cookie": cookie
     }
 
-    try:
-        r = requests.post(SAVE_URL, headers=headers, json=payload, timeout=15)
+    MIN_ATTEMPT = 1.0  # giây tối thiểu cho 1 lần thử
+
+    def __init__(self, url, pool_size, timeout, retries, backoff_base, budget=None):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.budget = budget or timeout
+        self.session = self._build_session(pool_size)
+        self.latency = {}  # outcome -> LatencyHistogram (chung với METRICS)
+        self.retried = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _build_session(pool_size):
+        session = requests.Session()
+        # Cookie của từng user đi qua header → không cho session giữ cookie giữa các user
+        session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        # Vượt pool_size → mở kết nối tạm (không giữ lại) thay vì chờ: thời gian chờ
+        # pool không có timeout, sẽ ăn vào deadline của combo mà chưa gửi request nào
+        # connect retry an toàn (request chưa gửi đi), read/status retry do save() tự xử lý
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            pool_block=False,
+            max_retries=Retry(total=1, connect=1, read=0, status=0, other=0),
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @staticmethod
+    def build_payload(voucher):
+        return {
+            "voucher_identifiers": [{
+                "promotion_id": int(voucher.get("Promotionid")),
+                "voucher_code": voucher.get("CODE"),
+                "signature": voucher.get("Signature"),
+                "signature_source": 0
+            }],
+            "need_user_voucher_status": True
+        }
+
+    @staticmethod
+    def is_transient(reason):
+        return reason == "TIMEOUT" or reason.startswith("HTTP_5")
+
+    @staticmethod
+    def outcome_label(reason):
+        # EXCEPTION_<message> → gộp về "EXCEPTION" để không nổ số nhãn
+        return "EXCEPTION" if reason.startswith("EXCEPTION_") else reason
+
+    def _observe(self, reason, seconds):
+        label = self.outcome_label(reason)
+        hist = self.latency.get(label)
+        if hist is None:
+            with self._lock:
+                hist = self.latency.setdefault(label, METRICS.histogram(
+                    "shopee_request_seconds", LatencyHistogram.BUCKETS, outcome=label))
+        hist.observe(seconds)
+        trace = current_trace()
+        if trace is not None:
+            trace.stage("shopee", seconds)
+
+    def _retry_delay(self, attempt, reason, end):
+        """Giây chờ trước lần thử kế tiếp, None = không retry nữa"""
+        if not self.is_transient(reason) or attempt == self.retries:
+            return None
+        # Full jitter: 0 → base * 2^attempt
+        delay = random.uniform(0, self.backoff_base * 2 ** attempt)
+        if end - time.perf_counter() - delay < self.MIN_ATTEMPT:
+            return None
+        return delay
+
+    def _attempt(self, headers, payload, timeout):
+        try:
+            r = self.session.post(self.url, headers=headers, json=payload, timeout=timeout)
 
-        if r.status_code != 200:
-            return False, f"HTTP_{r.status_code}"
+            if r.status_code != 200:
+                return False, f"HTTP_{r.status_code}"
 
-        js = r.json()
-        if "responses" not in js or not js["responses"]:
-            return False, "INVALID_RESPONSE"
+            js = r.json()
+            if "responses" not in js or not js["responses"]:
+                return False, "INVALID_RESPONSE"
 
-        resp = js["responses"][0]
+            resp = js["responses"][0]
 
-        if resp.get("error") == 0:
-            return True, "OK"
+            if resp.get("error") == 0:
+                return True, "OK"
 
-        return False, f"SHOPEE_{resp.get('error')}"
+            return False, f"SHOPEE_{resp.get('error')}"
 
-    except requests.exceptions.Timeout:
-        return False, "TIMEOUT"
-    except Exception as e:
-        return False, f"EXCEPTION_{str(e)}"
+        except requests.exceptions.Timeout:
+            return False, "TIMEOUT"
+        except Exception as e:
+            return False, f"EXCEPTION_{str(e)}"
+
+    def save(self, cookie, voucher, end=None):
+        """end: mốc perf_counter phải xong (mặc định bây giờ + budget)"""
+        start = time.perf_counter()
+        if end is None:
+            end = start + self.budget
+        try:
+            payload = self.build_payload(voucher)
+        except Exception as e:
+            return False, f"EXCEPTION_{str(e)}"
+        headers = dict(self.BASE_HEADERS, Cookie=cookie)
+
+        ok, reason = False, "TIMEOUT"
+        for attempt in range(self.retries + 1):
+            timeout = min(self.timeout, end - time.perf_counter())
+            if timeout <= 0:
+                break
+            ok, reason = self._attempt(headers, payload, timeout)
+            if ok:
+                break
+            delay = self._retry_delay(attempt, reason, end)
+            if delay is None:
+                break
+            self.retried += 1
+            time.sleep(delay)
+
+        self._observe(reason, time.perf_counter() - start)
+        return ok, reason
+
+    def save_many(self, cookie, vouchers, deadline):
+        """
+        Lưu nhiều voucher song song, trả về [(ok, reason)] đúng thứ tự `vouchers`.
+        Mỗi combo có pool riêng (tối đa COMBO_MAX_WORKERS luồng) → deadline tính từ
+        lúc gửi, không tốn vào thời gian xếp hàng sau combo khác; mọi mã dùng chung
+        mốc hết hạn. Hết deadline → các mã chưa xong tính TIMEOUT.
+        """
+        end = time.perf_counter() + deadline
+        pool = ThreadPoolExecutor(max_workers=min(len(vouchers), COMBO_MAX_WORKERS),
+                                  thread_name_prefix="shopee")
+        try:
+            futures = [pool.submit(self.save, cookie, v, end) for v in vouchers]
+            done, _ = wait(futures, timeout=deadline)
+        finally:
+            # Mã đang gửi tự dừng ở mốc end, không chờ ở đây
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        results = []
+        for f in futures:
+            if f not in done:
+                results.append((False, "TIMEOUT"))
+                continue
+            try:
+                results.append(f.result())
+            except Exception as e:
+                results.append((False, f"EXCEPTION_{str(e)}"))
+        return results
+
+    def stats_text(self):
+        lines = ["📊 <b>Shopee latency</b>"]
+        for label, h in sorted(self.latency.items()):
+            avg = h.sum / h.count if h.count else 0
+            lines.append(
+                f"• {label}: {h.count} lần | avg {avg * 1000:.0f}ms"
+                f" | p50≤{h.quantile(0.5) * 1000:.0f}ms | p95≤{h.quantile(0.95) * 1000:.0f}ms"
+            )
+        lines.append(f"🔁 Retry: {self.retried}")
+        return "\n".join(lines)
+
+SHOPEE = ShopeeClient(SAVE_URL, SHOPEE_POOL_SIZE, SHOPEE_TIMEOUT, SHOPEE_RETRIES, SHOPEE_BACKOFF_BASE, SHOPEE_BUDGET)
+
+def save_voucher_and_check(cookie, voucher):
+    return SHOPEE.save(cookie, voucher)
 
 # =========================================================
 # COMBO UTIL
 # =========================================================
 def get_vouchers_by_combo(combo_key):
-    if not SHEET_READY:
+    if not store_ready():
         return [], "Hệ thống Sheet đang lỗi"
 
     try:
-        rows = ws_voucher.get_all_records()
+        items = VOUCHER_STOCK.combo(combo_key)
     except Exception:
         return [], "Không đọc được VoucherStock"
 
-    items = []
-    for r in rows:
-        c = str(r.get("Combo", "")).strip().lower()
-        if c == combo_key.strip().lower():
-            if r.get("Trạng Thái") == "Còn Mã":
-                items.append(r)
-
     if not items:
         return [], "Combo hiện không có mã"
 
     return items, None
 
-def process_combo1(cookie):
+COMBO_MAX_WORKERS = int(os.getenv("COMBO_MAX_WORKERS", "8"))     # luồng song song / combo
+COMBO_DEADLINE    = float(os.getenv("COMBO_DEADLINE", "20"))  # giây cho cả combo
+
+def save_vouchers_parallel(cookie, vouchers, deadline=COMBO_DEADLINE):
+    """Lưu nhiều voucher song song, trả về [(ok, reason)] đúng thứ tự `vouchers`"""
+    if len(vouchers) <= 1:
+        return [save_voucher_and_check(cookie, v) for v in vouchers]
+    return SHOPEE.save_many(cookie, vouchers, deadline)
+
+def _voucher_price(v):
+    try:
+        return int(v.get("Giá", 0))
+    except Exception:
+        return 0
+
+def process_combo1(cookie, user_id):
+    """
+    Giữ tiền cả combo trước (nguyên tử), lưu song song, hoàn lại giá các mã lỗi
+    → không có mã nào lưu ở Shopee mà chưa trừ tiền.
+    Return: (ok, total_price | lỗi, n_saved, n_total, failed, new_bal)
+    """
     vouchers, err = get_vouchers_by_combo(COMBO1_KEY)
     if err:
-        return False, err, 0, 0, []
+        return False, err, 0, 0, [], 0
+
+    full_price = sum(_voucher_price(v) for v in vouchers)
+    debited, new_bal = debit_balance(user_id, full_price, "COMBO1")
+    if not debited:
+        return False, "Không đủ số dư", 0, len(vouchers), [], new_bal
 
     saved = []
     failed = []
 
-    for v in vouchers:
-        ok, reason = save_voucher_and_check(cookie, v)
+    for v, (ok, reason) in zip(vouchers, save_vouchers_parallel(cookie, vouchers)):
         if ok:
             saved.append(v)
         else:
             failed.append((v.get("Tên Mã", "UNKNOWN"), reason))
 
+    total_price = sum(_voucher_price(v) for v in saved)
+    if total_price < full_price:
+        refunded, balance = refund_balance(user_id, full_price - total_price, "COMBO1_REFUND",
+                                           f"{len(saved)}/{len(vouchers)}")
+        if refunded:
+            new_bal = balance
+
     if not saved:
-        return False, "Không lưu được voucher nào", 0, len(vouchers), failed
+        return False, "Không lưu được voucher nào", 0, len(vouchers), failed, new_bal
 
-    total_price = 0
-    for v in saved:
-        try:
-            total_price += int(v.get("Giá", 0))
-        except Exception:
-            pass
+    return True, total_price, len(saved), len(vouchers), failed, new_bal
+
+def buy_voucher(user_id, cookie, v):
+    """
+    Giữ tiền trước (nguyên tử), lưu mã, lỗi → hoàn lại.
+    Return: (ok, lỗi cho user | None, new_bal)
+    """
+    price = _voucher_price(v)
+    debited, new_bal = debit_balance(user_id, price, "VOUCHER")
+    if not debited:
+        return False, "❌ Không đủ số dư", new_bal
+
+    ok, reason = save_voucher_and_check(cookie, v)
+    if not ok:
+        refund_balance(user_id, price, "VOUCHER_REFUND", v.get("Tên Mã", ""))
+        return False, "❌ Lưu mã thất bại\n💸 Không trừ tiền", new_bal
 
-    return True, total_price, len(saved), len(vouchers), failed
+    return True, None, new_bal
 
 # =========================================================
 # VOUCHER KEYBOARD
@@ -730,35 +3604,28 @@ def build_quick_buy_keyboard(cmd):
 # KÍCH HOẠT + TẶNG 5K
 # =========================================================
 def handle_active_gift_5k(user_id, username):
-    if not SHEET_READY:
+    if not store_ready():
         return False, "❌ Hệ thống đang lỗi."
 
-    row = get_user_row(user_id)
-
-    if not row:
-        row = ensure_user_exists(user_id, username)
+    if get_user_record(user_id) is None:
+        ensure_user_exists(user_id, username)
 
-    data = ws_money.row_values(row)
-    status = data[3] if len(data) > 3 else ""
+    # ✅ Check status + cộng 5k + đổi status trong cùng 1 bước nguyên tử
+    ok, new_balance, code = change_balance(
+        user_id, 5000, "ACTIVE_GIFT_5K",
+        fields={"status": "active"},
+        guard=lambda rec: rec.status not in ("active", "trial_used"),
+    )
 
-    if status in ("active", "trial_used"):
+    if code == "REJECTED":
         return False, "⚠️ ACC đã kích hoạt và nhận khuyến mãi rồi."
-
-    # ✅ Batch update: status + balance cùng lúc
-    try:
-        current_balance = int(data[2]) if len(data) > 2 else 0
-        new_balance = current_balance + 5000
-        
-        # Single API call
-        ws_money.update(f'C{row}:D{row}', [[new_balance, "active"]])
-        
-        log_row(user_id, username, "ACTIVE_GIFT_5K", "5000", "Kích hoạt + tặng 5k")
-        
-        return True, new_balance
-    except Exception as e:
-        dprint("handle_active_gift_5k error:", e)
+    if not ok:
         return False, "❌ Lỗi khi cập nhật"
 
+    log_row(user_id, username, "ACTIVE_GIFT_5K", "5000", "Kích hoạt + tặng 5k")
+
+    return True, new_balance
+
 # =========================================================
 # CALLBACK QUERY HANDLER
 # =========================================================
@@ -781,12 +3648,8 @@ def handle_callback_query(cb):
             tg_answer_callback(cb_id, "❌ Tài khoản chưa được kích hoạt", True)
             return
 
-        # ✅ Xóa lệnh cũ nếu có
-        if user_id in PENDING_VOUCHER:
-            old_cmd = PENDING_VOUCHER[user_id]
-            dprint(f"Cleared old pending: {old_cmd}")
-
-        PENDING_VOUCHER[user_id] = cmd
+        # ✅ Thay lệnh cũ nếu có
+        set_pending(user_id, cmd)
 
         tg_answer_callback(cb_id)
         tg_send(user_id, f"👉 Gửi <b>cookie</b> vào đây để lưu <b>{cmd}</b>")
@@ -797,11 +3660,72 @@ def handle_callback_query(cb):
 # =========================================================
 # CORE UPDATE HANDLER
 # =========================================================
+# Nhãn "branch" cho bot_update_seconds: giới hạn theo lệnh / nút đã biết
+UPDATE_BRANCHES = {
+    "/start": "start",
+    "🎁 Kích Hoạt Tặng 5k": "gift",
+    "💳 Nạp tiền": "topup",
+    "💰 Số dư": "balance",
+    "/balance": "balance",
+    "📜 Lịch sử nạp tiền": "topup_history",
+    "/topup_history": "topup_history",
+    "🎟️Lưu Voucher": "voucher_menu",
+    "Voucher": "voucher_menu",
+    "🎟️ Voucher": "voucher_menu",
+}
+
+def update_branch(update):
+    if "callback_query" in update:
+        return "callback"
+    text = ((update.get("message") or {}).get("text") or "").strip()
+    if text in UPDATE_BRANCHES:
+        return UPDATE_BRANCHES[text]
+    if text.startswith("/voucher"):
+        return "voucher"
+    if text.startswith("/combo"):
+        return "combo"
+    if text.startswith("/"):
+        return "admin" if ADMIN_ID and (update.get("message") or {}).get("from", {}).get("id") == ADMIN_ID else "command"
+    return "text"
+
 def handle_update(update):
+    update_id = update.get("update_id")
+    if update_id is not None and not claim_update(update_id):
+        # Đang / đã xử lý ở request trước (hoặc instance khác) → bỏ qua
+        dprint("Duplicate update:", update_id)
+        METRICS.inc("bot_duplicate_updates_total")
+        return
+    try:
+        with update_trace(update_branch(update)):
+            _handle_update_safe(update)
+    except Exception:
+        if update_id is not None:
+            release_update(update_id)
+        raise
+    if update_id is not None:
+        finish_update(update_id)
+
+def _handle_update_safe(update):
+    try:
+        _handle_update(update)
+    except SheetsUnavailable as e:
+        # Sheets hết quota / lỗi → báo bận thay vì trả lời sai ("Bạn chưa có ID", ...)
+        print("[SHEETS_BUSY]", e)
+        METRICS.inc("bot_sheets_busy_total", source="update")
+        msg = update.get("message") or update.get("callback_query", {}).get("message", {})
+        chat_id = msg.get("chat", {}).get("id")
+        if chat_id:
+            tg_send(
+                chat_id,
+                "⚠️ <b>Hệ thống đang quá tải</b>\n"
+                "Vui lòng thử lại sau ít phút."
+            )
+
+def _handle_update(update):
     dprint("UPDATE:", update)
 
     # ✅ CHECK SHEET_READY
-    if not SHEET_READY:
+    if not store_ready():
         msg = update.get("message", {})
         chat_id = msg.get("chat", {}).get("id")
         if chat_id:
@@ -862,11 +3786,40 @@ def handle_update(update):
     username = msg["from"].get("username", "")
     text = (msg.get("text") or "").strip()
     
+    pending = get_pending(user_id)
+    if pending and not text.startswith("/"):
+        set_trace_branch("cookie")
+
     # ✅ Skip messages không có text (ảnh, sticker, voice...)
     # Chỉ xử lý các message quan trọng không cần text
     if not text:
         # Cho phép qua nếu đang chờ cookie (user có thể gửi nhầm ảnh)
-        if user_id not in PENDING_VOUCHER:
+        if not pending:
+            return
+
+    # ===== ADMIN: RELOAD VOUCHERSTOCK =====
+    if text == "/reload_voucher" and ADMIN_ID and user_id == ADMIN_ID:
+        try:
+            n = VOUCHER_STOCK.refresh()
+            tg_send(chat_id, f"✅ Đã tải lại VoucherStock: <b>{n}</b> dòng")
+        except Exception as e:
+            tg_send(chat_id, f"❌ Không đọc được VoucherStock: {e}")
+        return
+
+    # ===== ADMIN: SHOPEE LATENCY =====
+    if text == "/shopee_stats" and ADMIN_ID and user_id == ADMIN_ID:
+        tg_send(chat_id, SHOPEE.stats_text())
+        return
+
+    # ===== ADMIN: SEPAY INBOX =====
+    if text.startswith("/sepay_") and ADMIN_ID and user_id == ADMIN_ID and SEPAY_INBOX is not None:
+        if text == "/sepay_inbox":
+            tg_send(chat_id, SEPAY_INBOX.stats_text())
+            return
+        parts = text.split()
+        if parts[0] == "/sepay_replay" and len(parts) == 2:
+            n = SEPAY_INBOX.replay(parts[1])
+            tg_send(chat_id, f"🔁 Đưa lại hàng đợi: <b>{n}</b> giao dịch")
             return
 
     # ===== /start =====
@@ -877,8 +3830,17 @@ def handle_update(update):
         if status != "active" or balance == 0:
             # ✅ Batch update
             try:
-                new_bal = balance + 5000
-                ws_money.update(f'C{row}:D{row}', [[new_bal, "active"]])
+                ok, new_bal, code = change_balance(
+                    user_id, 5000, "AUTO_ACTIVE",
+                    fields={"status": "active"},
+                    guard=lambda rec: rec.status != "active" or rec.balance == 0,
+                )
+                if code == "REJECTED":
+                    # Request song song đã kích hoạt trước
+                    tg_send(chat_id, "👋 <b>Chào mừng quay lại!</b>", build_main_keyboard())
+                    return
+                if not ok:
+                    raise RuntimeError(f"change_balance {code}")
                 
                 log_row(user_id, username, "AUTO_ACTIVE", "5000", "Auto kích hoạt khi /start")
 
@@ -979,7 +3941,7 @@ def handle_update(update):
     if status != "active" and (
         text.startswith("/voucher")
         or text.startswith("/combo")
-        or user_id in PENDING_VOUCHER
+        or pending
     ):
         tg_send(chat_id, "❌ Tài khoản chưa được kích hoạt.")
         # ✅ Track lỗi
@@ -988,13 +3950,16 @@ def handle_update(update):
         return
 
     # ===== ĐANG CHỜ COOKIE =====
-    if user_id in PENDING_VOUCHER and not text.startswith("/"):
-        cmd = PENDING_VOUCHER.pop(user_id)
+    if pending and not text.startswith("/"):
+        cmd = pop_pending(user_id)
+        if not cmd:
+            return  # instance khác đã nhận cookie này
         cookie = text.strip()
 
         # ----- COMBO1 -----
         if cmd == COMBO1_KEY:
-            ok, total_price, n_saved, n_total, failed = process_combo1(cookie)
+            # ✅ Giữ tiền trước, hoàn lại phần mã lỗi
+            ok, total_price, n_saved, n_total, failed, new_bal = process_combo1(cookie, user_id)
 
             if not ok:
                 tg_send(chat_id, f"❌ <b>COMBO1 THẤT BẠI</b>\n{total_price}")
@@ -1003,16 +3968,6 @@ def handle_update(update):
                     tg_send(chat_id, "⛔ Tài khoản bị khóa do spam. Liên hệ @BonBonxHPx")
                 return
 
-            if balance < total_price:
-                tg_send(chat_id, "❌ Không đủ số dư")
-                # ✅ Track lỗi
-                if track_error(user_id):
-                    tg_send(chat_id, "⛔ Tài khoản bị khóa do spam. Liên hệ @BonBonxHPx")
-                return
-
-            new_bal = balance - total_price
-            ws_money.update_cell(row, 3, new_bal)
-
             log_row(user_id, username, "COMBO1", str(total_price), f"{n_saved}/{n_total}")
 
             msg_text = (
@@ -1048,17 +4003,15 @@ def handle_update(update):
                 tg_send(chat_id, "⛔ Tài khoản bị khóa do spam. Liên hệ @BonBonxHPx")
             return
 
-        ok, reason = save_voucher_and_check(cookie, v)
+        # ✅ Giữ tiền trước (nguyên tử), lưu mã lỗi → hoàn lại
+        ok, err, new_bal = buy_voucher(user_id, cookie, v)
         if not ok:
-            tg_send(chat_id, "❌ Lưu mã thất bại\n💸 Không trừ tiền")
+            tg_send(chat_id, err)
             # ✅ Track lỗi
             if track_error(user_id):
                 tg_send(chat_id, "⛔ Tài khoản bị khóa do spam. Liên hệ @BonBonxHPx")
             return
 
-        new_bal = balance - price
-        ws_money.update_cell(row, 3, new_bal)
-
         log_row(user_id, username, "VOUCHER", str(price), cmd)
 
         tg_send(
@@ -1085,15 +4038,13 @@ def handle_update(update):
     # ----- COMBO1 -----
     if cmd == COMBO1_KEY:
         if not cookie:
-            # ✅ Xóa lệnh cũ
-            if user_id in PENDING_VOUCHER:
-                dprint(f"Cleared old pending: {PENDING_VOUCHER[user_id]}")
-            
-            PENDING_VOUCHER[user_id] = COMBO1_KEY
+            # ✅ Thay lệnh cũ
+            set_pending(user_id, COMBO1_KEY)
             tg_send(chat_id, "👉 Gửi <b>cookie</b> để lưu combo1")
             return
 
-        ok, total_price, n_saved, n_total, failed = process_combo1(cookie)
+        # ✅ Giữ tiền trước, hoàn lại phần mã lỗi
+        ok, total_price, n_saved, n_total, failed, new_bal = process_combo1(cookie, user_id)
 
         if not ok:
             tg_send(chat_id, f"❌ COMBO1 THẤT BẠI\n{total_price}")
@@ -1102,16 +4053,6 @@ def handle_update(update):
                 tg_send(chat_id, "⛔ Tài khoản bị khóa do spam. Liên hệ @BonBonxHPx")
             return
 
-        if balance < total_price:
-            tg_send(chat_id, "❌ Không đủ số dư")
-            # ✅ Track lỗi
-            if track_error(user_id):
-                tg_send(chat_id, "⛔ Tài khoản bị khóa do spam. Liên hệ @BonBonxHPx")
-            return
-
-        new_bal = balance - total_price
-        ws_money.update_cell(row, 3, new_bal)
-
         log_row(user_id, username, "COMBO1", str(total_price), f"{n_saved}/{n_total}")
 
         tg_send(
@@ -1127,11 +4068,8 @@ def handle_update(update):
     # ----- VOUCHER ĐƠN -----
     if cmd.startswith("voucher"):
         if not cookie:
-            # ✅ Xóa lệnh cũ
-            if user_id in PENDING_VOUCHER:
-                dprint(f"Cleared old pending: {PENDING_VOUCHER[user_id]}")
-            
-            PENDING_VOUCHER[user_id] = cmd
+            # ✅ Thay lệnh cũ
+            set_pending(user_id, cmd)
             tg_send(chat_id, f"👉 Gửi <b>cookie</b> để lưu {cmd}")
             return
 
@@ -1151,17 +4089,15 @@ def handle_update(update):
                 tg_send(chat_id, "⛔ Tài khoản bị khóa do spam. Liên hệ @BonBonxHPx")
             return
 
-        ok, reason = save_voucher_and_check(cookie, v)
+        # ✅ Giữ tiền trước (nguyên tử), lưu mã lỗi → hoàn lại
+        ok, err, new_bal = buy_voucher(user_id, cookie, v)
         if not ok:
-            tg_send(chat_id, "❌ Lưu mã thất bại\n💸 Không trừ tiền")
+            tg_send(chat_id, err)
             # ✅ Track lỗi
             if track_error(user_id):
                 tg_send(chat_id, "⛔ Tài khoản bị khóa do spam. Liên hệ @BonBonxHPx")
             return
 
-        new_bal = balance - price
-        ws_money.update_cell(row, 3, new_bal)
-
         log_row(user_id, username, "VOUCHER", str(price), cmd)
 
         tg_send(
@@ -1180,6 +4116,290 @@ def handle_update(update):
         build_main_keyboard()
     )
 
+# =========================================================
+# SEPAY INBOX (ghi đĩa → ack ngay → cộng tiền nền)
+# =========================================================
+SEPAY_INBOX_ENABLED   = os.getenv("SEPAY_INBOX", "0" if ON_VERCEL else "1") == "1"
+SEPAY_INBOX_PATH      = os.getenv("SEPAY_INBOX_PATH", os.path.join(BOT_DATA_DIR, "sepay_inbox.db"))
+SEPAY_INBOX_WORKERS   = int(os.getenv("SEPAY_INBOX_WORKERS", "4"))       # giao dịch cộng tiền song song
+SEPAY_INBOX_MAX_TRIES = int(os.getenv("SEPAY_INBOX_MAX_TRIES", "20"))    # quá → failed, chờ replay
+SEPAY_INBOX_LEASE     = int(os.getenv("SEPAY_INBOX_LEASE", "300"))       # processing quá lâu → coi như chết
+SEPAY_INBOX_RETENTION = int(os.getenv("SEPAY_INBOX_RETENTION_DAYS", "90"))
+
+def sepay_tx_id(data):
+    return str(
+        data.get("id")
+        or data.get("transaction_id")
+        or data.get("tx_id")
+        or data.get("referenceCode")
+        or ""
+    ).strip()
+
+class PaymentInbox:
+    """
+    Hộp thư SePay append-only trên SQLite (synchronous=FULL → fsync mỗi lần ghi):
+    - webhook: append() rồi trả OK ngay, không đụng Sheets
+    - thread nền claim theo thứ tự nhận, process_sepay trên pool `workers` thread;
+      5xx / lỗi → thử lại với backoff,
+      quá max_tries → failed (giữ nguyên payload, replay được)
+    - tx_id UNIQUE → SePay gửi lại cùng giao dịch chỉ ghi 1 dòng
+    - pending / processing quá lease (process chết giữa chừng) được xử lý lại;
+      process_sepay idempotent theo tx_id (is_tx_exists + ledger ref SEPAY:<tx_id>
+      + bảng sepay_credits: ghi 'started' trước khi cộng số dư, 'credited' sau khi cộng).
+      Chạy lại gặp 'started' (chết giữa lúc ghi số dư) → không tự cộng lại, failed để đối soát tay
+    - nhiều process chung 1 file: dòng được claim (pending → processing) trong BEGIN IMMEDIATE
+    """
+
+    def __init__(self, path, workers, max_tries, lease, retention_days):
+        self.path = path
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sepay-credit")
+        self.max_tries = max_tries
+        self.lease = lease
+        self.retention = retention_days * 86400
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._thread = None
+        self._purged_at = 0.0
+        self.stats = {"accepted": 0, "duplicates": 0, "done": 0, "retried": 0, "failed": 0}
+        self._conn().executescript("""
+        CREATE TABLE IF NOT EXISTS sepay_inbox (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            tx_id       TEXT UNIQUE,
+            payload     TEXT NOT NULL,
+            received_at REAL NOT NULL,
+            status      TEXT NOT NULL DEFAULT 'pending',   -- pending | processing | done | failed
+            attempts    INTEGER NOT NULL DEFAULT 0,
+            next_at     REAL NOT NULL DEFAULT 0,
+            claimed_at  REAL,
+            result      TEXT
+        );
+        CREATE INDEX IF NOT EXISTS sepay_inbox_todo ON sepay_inbox(status, next_at);
+        CREATE TABLE IF NOT EXISTS sepay_credits (
+            tx_id TEXT PRIMARY KEY,
+            state TEXT NOT NULL,                           -- started | credited
+            at    REAL NOT NULL
+        );
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite_connect(self.path)
+            conn.execute("PRAGMA synchronous=FULL")  # tiền: commit xong là đã nằm trên đĩa
+        return conn
+
+    @contextmanager
+    def _tx(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def append(self, data):
+        """Ghi payload; False nếu tx_id đã có trong inbox (SePay gửi lại)"""
+        tx_id = sepay_tx_id(data) or None
+        cur = self._conn().execute(
+            "INSERT OR IGNORE INTO sepay_inbox (tx_id, payload, received_at) VALUES (?, ?, ?)",
+            (tx_id, json.dumps(data, ensure_ascii=False), time.time()),
+        )
+        if cur.rowcount == 0:
+            self.stats["duplicates"] += 1
+            return False
+        self.stats["accepted"] += 1
+        self.start()
+        self._wake.set()
+        return True
+
+    def _claim_due(self, limit):
+        now = time.time()
+        with self._tx() as conn:
+            conn.execute(
+                "UPDATE sepay_inbox SET status='pending' WHERE status='processing' AND claimed_at < ?",
+                (now - self.lease,),
+            )
+            rows = conn.execute(
+                "SELECT id, tx_id, payload, attempts FROM sepay_inbox"
+                " WHERE status='pending' AND next_at <= ? ORDER BY id LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE sepay_inbox SET status='processing', claimed_at=? WHERE id=?",
+                [(now, r["id"]) for r in rows],
+            )
+        return rows
+
+    def credit_state(self, tx_id):
+        row = self._conn().execute("SELECT state FROM sepay_credits WHERE tx_id=?", (tx_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def mark_credit(self, tx_id, state):
+        """state=None → xoá (chắc chắn chưa cộng tiền)"""
+        if state is None:
+            self._conn().execute("DELETE FROM sepay_credits WHERE tx_id=?", (tx_id,))
+        else:
+            self._conn().execute("INSERT OR REPLACE INTO sepay_credits VALUES (?, ?, ?)",
+                                 (tx_id, state, time.time()))
+
+    def _finish(self, row, body, status):
+        conn = self._conn()
+        if status < 500:
+            conn.execute("UPDATE sepay_inbox SET status='done', result=? WHERE id=?", (body, row["id"]))
+            self.stats["done"] += 1
+            return
+
+        attempts = row["attempts"] + 1
+        if attempts >= self.max_tries or body == "UNCERTAIN":
+            print("[SEPAY_INBOX] GIVE UP:", row["tx_id"], body)
+            conn.execute(
+                "UPDATE sepay_inbox SET status='failed', attempts=?, result=? WHERE id=?",
+                (attempts, body, row["id"]),
+            )
+            self.stats["failed"] += 1
+            return
+
+        delay = random.uniform(0, min(600.0, 2.0 ** attempts))
+        conn.execute(
+            "UPDATE sepay_inbox SET status='pending', attempts=?, next_at=?, result=? WHERE id=?",
+            (attempts, time.time() + delay, body, row["id"]),
+        )
+        self.stats["retried"] += 1
+
+    def _process(self, row):
+        try:
+            body, status = process_sepay(json.loads(row["payload"]), credits=self)
+        except Exception as e:
+            body, status = f"EXCEPTION_{e}", 500
+        self._finish(row, body, status)
+
+    def process_due(self):
+        """Xử lý các dòng tới hạn, trả về số dòng đã chạy"""
+        processed = 0
+        while True:
+            rows = self._claim_due(self.workers * 4)
+            if not rows:
+                return processed
+            list(self.pool.map(self._process, rows))
+            processed += len(rows)
+
+    def _next_due_in(self):
+        """Giây tới lần cần chạy: dòng pending tới hạn, hoặc lease của dòng processing hết hạn"""
+        row = self._conn().execute(
+            "SELECT (SELECT MIN(next_at) FROM sepay_inbox WHERE status='pending'),"
+            " (SELECT MIN(claimed_at) FROM sepay_inbox WHERE status='processing')"
+        ).fetchone()
+        due = []
+        if row[0] is not None:
+            due.append(row[0])
+        if row[1] is not None:
+            due.append(row[1] + self.lease)
+        if not due:
+            return 60.0
+        return min(60.0, max(0.05, min(due) - time.time()))
+
+    def _purge(self):
+        now = time.time()
+        if now - self._purged_at < 3600:
+            return
+        self._purged_at = now
+        self._conn().execute(
+            "DELETE FROM sepay_inbox WHERE status='done' AND received_at < ?", (now - self.retention,)
+        )
+        self._conn().execute(
+            "DELETE FROM sepay_credits WHERE state='credited' AND at < ?", (now - self.retention,)
+        )
+
+    def _run(self):
+        while True:
+            try:
+                self.process_due()
+                self._purge()
+                timeout = self._next_due_in()
+            except Exception as e:
+                print("[SEPAY_INBOX_ERROR]", e)
+                timeout = 5.0
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sepay-inbox", daemon=True)
+            self._thread.start()
+
+    def replay(self, target):
+        """target = tx_id hoặc "failed" (mọi dòng bỏ cuộc) → pending, trả về số dòng"""
+        if target == "failed":
+            cur = self._conn().execute(
+                "UPDATE sepay_inbox SET status='pending', attempts=0, next_at=0 WHERE status='failed'"
+            )
+        else:
+            cur = self._conn().execute(
+                "UPDATE sepay_inbox SET status='pending', attempts=0, next_at=0 WHERE tx_id=?", (target,)
+            )
+        if cur.rowcount:
+            self.start()
+            self._wake.set()
+        return cur.rowcount
+
+    def counts(self):
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM sepay_inbox GROUP BY status").fetchall()
+        counts = {r[0]: r[1] for r in rows}
+        oldest = self._conn().execute(
+            "SELECT MIN(received_at) FROM sepay_inbox WHERE status IN ('pending', 'processing')"
+        ).fetchone()[0]
+        counts["oldest_pending_age"] = round(time.time() - oldest, 1) if oldest else 0
+        return counts
+
+    def stats_text(self):
+        c = self.counts()
+        return (
+            "📥 <b>SePay inbox</b>\n"
+            f"• pending: {c.get('pending', 0)} | processing: {c.get('processing', 0)}\n"
+            f"• done: {c.get('done', 0)} | failed: {c.get('failed', 0)}\n"
+            f"• chờ lâu nhất: {c['oldest_pending_age']}s"
+        )
+
+    def metrics(self):
+        c = self.counts()
+        return dict(
+            self.stats,
+            pending=c.get("pending", 0) + c.get("processing", 0),
+            failed_rows=c.get("failed", 0),
+            oldest_pending_age=c["oldest_pending_age"],
+        )
+
+def build_sepay_inbox():
+    """PaymentInbox, hoặc None nếu tắt / không mở được file (→ accept_sepay cộng tiền trực tiếp)"""
+    if not SEPAY_INBOX_ENABLED:
+        return None
+    try:
+        inbox = PaymentInbox(SEPAY_INBOX_PATH, SEPAY_INBOX_WORKERS, SEPAY_INBOX_MAX_TRIES,
+                             SEPAY_INBOX_LEASE, SEPAY_INBOX_RETENTION)
+    except (sqlite3.Error, OSError) as e:
+        print("[SEPAY_INBOX] DISABLED, xử lý trực tiếp:", SEPAY_INBOX_PATH, e)
+        return None
+    inbox.start()  # xử lý tiếp các dòng còn pending từ lần chạy trước
+    return inbox
+
+SEPAY_INBOX = build_sepay_inbox()
+
+def accept_sepay(data):
+    """Callback SePay → (body, status): ghi inbox rồi ack; không có inbox → xử lý luôn"""
+    if SEPAY_INBOX is None or not data:
+        return process_sepay(data)
+    try:
+        if not SEPAY_INBOX.append(data):
+            return "DUPLICATE", 200
+    except sqlite3.Error as e:
+        # Đĩa lỗi → vẫn cộng tiền trực tiếp như trước
+        print("[SEPAY_INBOX] APPEND FAILED:", e)
+        return process_sepay(data)
+    return "OK", 200
+
 # =========================================================
 # SEPAY WEBHOOK
 # =========================================================
@@ -1187,18 +4407,27 @@ def handle_update(update):
 def webhook_sepay():
     if request.method == "GET":
         return "OK", 200
+    return accept_sepay(request.get_json(force=True, silent=True) or {})
 
-    data = request.get_json(force=True, silent=True) or {}
+def process_sepay(data, credits=None):
+    """
+    Xử lý 1 callback SePay (dict JSON) → (body, status) trả lại SePay.
+    credits: PaymentInbox (credit_state / mark_credit) → chạy lại sau crash không cộng 2 lần
+    """
+    try:
+        with update_trace("sepay"), sheets_priority(PRIO_PAYMENT):
+            return _process_sepay(data, credits)
+    except SheetsUnavailable as e:
+        # Chưa cộng tiền → 503 để SePay gửi lại sau
+        print("[SEPAY] SHEETS BUSY:", e)
+        METRICS.inc("bot_sheets_busy_total", source="sepay")
+        return "BUSY", 503
+
+def _process_sepay(data, credits=None):
     if not data:
         return "EMPTY", 200
 
-    tx_id = str(
-        data.get("id")
-        or data.get("transaction_id")
-        or data.get("tx_id")
-        or data.get("referenceCode")
-        or ""
-    ).strip()
+    tx_id = sepay_tx_id(data)
 
     try:
         amount = int(
@@ -1243,7 +4472,41 @@ def webhook_sepay():
     total_add = amount + bonus
 
     ensure_user_exists(user_id, "")
-    new_balance = add_balance(user_id, total_add)
+
+    state = credits.credit_state(tx_id) if credits is not None else None
+    if state == "started":
+        # Lần trước chết giữa lúc ghi số dư: không biết đã cộng chưa → không tự cộng lại
+        print("[SEPAY] UNCERTAIN CREDIT, cần đối soát tay:", tx_id)
+        log_row(user_id, "", "TOPUP_UNCERTAIN", str(total_add), tx_id)
+        return "UNCERTAIN", 500
+
+    if state == "credited":
+        # Đã cộng, chết trước khi ghi "Nạp tiền" → chỉ làm nốt phần sau
+        print("[SEPAY] ALREADY CREDITED, ghi nốt:", tx_id)
+        new_balance = get_user_record(user_id, fresh=True).balance
+    else:
+        if credits is not None:
+            credits.mark_credit(tx_id, "started")
+        try:
+            # ✅ ref = tx_id → SePay gửi lại cùng giao dịch cũng không cộng 2 lần
+            ok, new_balance, code = change_balance(user_id, total_add, "TOPUP_SEPAY", ref=f"SEPAY:{tx_id}")
+        except SheetsUnavailable:
+            if credits is not None:
+                credits.mark_credit(tx_id, None)  # gateway từ chối → chưa ghi gì
+            raise
+        if code == "DUPLICATE":
+            print("[SEPAY] DUPLICATE TX (ledger):", tx_id)
+            if credits is not None:
+                credits.mark_credit(tx_id, "credited")
+            return "DUPLICATE", 200
+        if not ok:
+            # Chưa cộng tiền → trả 500 để SePay gửi lại
+            print("[SEPAY] CREDIT FAILED:", tx_id, code)
+            if credits is not None:
+                credits.mark_credit(tx_id, None)
+            return "ERROR", 500
+        if credits is not None:
+            credits.mark_credit(tx_id, "credited")
 
     note = f"+{int(percent * 100)}%={bonus}" if bonus > 0 else ""
 
@@ -1281,12 +4544,248 @@ def webhook():
     handle_update(update)
     return "ok"
 
+# =========================================================
+# METRICS ENDPOINT
+# =========================================================
+for _prefix, _component in (
+    ("tg_outbox", TG_OUTBOX),
+    ("log_buffer", LOG_BUFFER),
+    ("sheet_writes", SHEET_WRITES),
+    ("sheets_gateway", SHEETS_GATEWAY),
+    ("replicator", REPLICATOR),
+    ("sepay_inbox", SEPAY_INBOX),
+    ("tg_file_cache", TG_FILE_IDS),
+):
+    if _component is not None:
+        METRICS.register_gauges(_prefix, _component.metrics)
+
+def metrics_denied(token):
+    """
+    None nếu token được xem /metrics, ngược lại (status, text).
+    Chưa đặt METRICS_TOKEN → tắt route (không lộ user_id / số liệu ra ngoài)
+    """
+    if not METRICS.enabled or not METRICS_TOKEN:
+        return 404, "metrics disabled"
+    if not hmac.compare_digest((token or "").encode(), METRICS_TOKEN.encode()):
+        return 403, "forbidden"
+    return None
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    denied = metrics_denied(request.args.get("token"))
+    if denied:
+        status, text = denied
+        return text, status
+    return METRICS.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 @app.route("/", methods=["GET"])
 def home():
-    if not SHEET_READY:
+    if not store_ready():
         return "Bot running, Sheet ERROR", 500
     return "Bot is running", 200
 
+# =========================================================
+# LONG POLLING (getUpdates, thay webhook khi tự host)
+# =========================================================
+BOT_MODE          = os.getenv("BOT_MODE", "webhook").strip().lower()  # webhook | polling
+POLL_TIMEOUT      = int(os.getenv("POLL_TIMEOUT", "30"))       # long poll tối đa (giây)
+POLL_LIMIT        = int(os.getenv("POLL_LIMIT", "100"))        # update / lần getUpdates (≤100)
+POLL_WORKERS      = int(os.getenv("POLL_WORKERS", "8"))
+POLL_MAX_INFLIGHT = int(os.getenv("POLL_MAX_INFLIGHT", "500")) # update đã nhận chưa xử lý xong
+POLL_MAX_RETRIES  = int(os.getenv("POLL_MAX_RETRIES", "5"))     # update lỗi: chạy lại tối đa N lần rồi bỏ (có log)
+POLL_RETRY_DELAY  = float(os.getenv("POLL_RETRY_DELAY", "1"))   # chờ trước lần chạy lại (x2 mỗi lần, ≤30s)
+
+def update_user_key(update):
+    """User gửi update (thứ tự xử lý giữ theo user), không có → update_id"""
+    body = update.get("message") or update.get("callback_query") or {}
+    return (body.get("from") or {}).get("id") or f"u{update.get('update_id')}"
+
+class UpdatePoller:
+    """
+    getUpdates theo batch → worker pool chạy handle_update:
+    - mỗi user có deque riêng, tại một thời điểm chỉ 1 worker giữ user → đúng thứ tự
+    - offset gửi Telegram = update_id nhỏ nhất chưa xử lý xong
+      (chết giữa chừng → Telegram gửi lại, finish_update đã nhớ các update xong)
+    - quá POLL_MAX_INFLIGHT update chưa xong → ngừng kéo thêm
+    - handle_update lỗi → update vẫn đứng đầu deque của user (offset không qua),
+      chạy lại sau retry_delay; quá max_retries lần → log [POLL_GIVE_UP] rồi bỏ
+    """
+
+    def __init__(self, workers, limit, timeout, max_inflight,
+                 max_retries=POLL_MAX_RETRIES, retry_delay=POLL_RETRY_DELAY):
+        self.n_workers = workers
+        self.limit = limit
+        self.timeout = timeout
+        self.max_inflight = max_inflight
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._attempts = {}          # update_id -> số lần đã lỗi
+        self._users = {}             # user_key -> deque[update] (đang chờ / đang xử lý)
+        self._ready = queue.Queue()  # user_key sẵn sàng cho worker
+        self._inflight = set()       # update_id đã nhận, chưa xử lý xong
+        self._last_id = -1           # update_id lớn nhất đã nhận
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        self._stopping = threading.Event()
+        self._threads = []
+        self.stats = {"polls": 0, "received": 0, "processed": 0, "retried": 0, "failed": 0, "poll_errors": 0}
+
+    def start_workers(self):
+        for i in range(self.n_workers):
+            t = threading.Thread(target=self._run, name=f"tg-poll-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def _offset_locked(self):
+        return min(self._inflight) if self._inflight else self._last_id + 1
+
+    def offset(self):
+        with self._lock:
+            return self._offset_locked()
+
+    def dispatch(self, updates):
+        """Giao batch cho worker; bỏ update đã nhận (Telegram gửi lại vì offset chưa qua)"""
+        for update in updates:
+            update_id = update.get("update_id")
+            if update_id is None:
+                continue
+            key = update_user_key(update)
+            with self._lock:
+                if update_id <= self._last_id:
+                    continue
+                self._last_id = update_id
+                self._inflight.add(update_id)
+                self.stats["received"] += 1
+                pending = self._users.get(key)
+                if pending is not None:
+                    pending.append(update)  # worker đang giữ user sẽ lấy tiếp
+                    continue
+                self._users[key] = deque([update])
+            self._ready.put(key)
+
+    def _run(self):
+        while True:
+            key = self._ready.get()
+            with self._lock:
+                update = self._users[key][0]  # chỉ bỏ khỏi deque khi xong / bỏ hẳn
+            update_id = update.get("update_id")
+
+            try:
+                handle_update(update)
+                self.stats["processed"] += 1
+            except Exception as e:
+                print("[POLL_UPDATE_ERROR]", update_id, e)
+                STORE.report_error(e)
+                with self._lock:
+                    attempts = self._attempts.get(update_id, 0) + 1
+                    self._attempts[update_id] = attempts
+                if attempts <= self.max_retries:
+                    # Giữ user (deque còn update) → update sau của user không chạy trước
+                    self.stats["retried"] += 1
+                    delay = min(30.0, self.retry_delay * 2 ** (attempts - 1))
+                    timer = threading.Timer(delay, self._ready.put, (key,))
+                    timer.daemon = True
+                    timer.start()
+                    continue
+                self.stats["failed"] += 1
+                print(f"[POLL_GIVE_UP] update {update_id} lỗi {attempts} lần → bỏ qua:", e)
+
+            with self._lock:
+                self._users[key].popleft()
+                self._attempts.pop(update_id, None)
+                self._inflight.discard(update_id)
+                self._done.notify_all()
+                if self._users[key]:
+                    requeue = True
+                else:
+                    del self._users[key]
+                    requeue = False
+            if requeue:
+                self._ready.put(key)  # xếp cuối hàng để user khác không bị đói
+
+    def fetch(self, offset, timeout):
+        """Response JSON của getUpdates (offset = xác nhận mọi update_id < offset)"""
+        payload = {
+            "offset": offset,
+            "limit": self.limit,
+            "timeout": timeout,
+            "allowed_updates": json.dumps(["message", "callback_query"]),
+        }
+        return tg_post("getUpdates", payload, timeout + 15).json()
+
+    def _wait_capacity(self):
+        with self._lock:
+            while len(self._inflight) >= self.max_inflight and not self._stopping.is_set():
+                self._done.wait(1)
+
+    def run(self):
+        # Bot còn webhook → getUpdates trả 409
+        try:
+            tg_post("deleteWebhook", {"drop_pending_updates": "false"}, 15)
+        except Exception as e:
+            print("[POLL] deleteWebhook error:", e)
+
+        self.start_workers()
+        failures = 0
+        while not self._stopping.is_set():
+            self._wait_capacity()
+            try:
+                data = self.fetch(self.offset(), self.timeout)
+            except Exception as e:
+                data = {"ok": False, "description": str(e)}
+            if not data.get("ok"):
+                # 409 (webhook khác đang chạy), 429, mất mạng... → chờ rồi thử lại
+                self.stats["poll_errors"] += 1
+                failures += 1
+                retry_after = data.get("parameters", {}).get("retry_after")
+                delay = retry_after or min(30.0, 1.0 * 2 ** failures)
+                print(f"[POLL] getUpdates error: {data.get('description')} → retry in {delay}s")
+                self._stopping.wait(delay)
+                continue
+
+            failures = 0
+            updates = data.get("result", [])
+            self.stats["polls"] += 1
+            with self._lock:
+                fresh = any(u.get("update_id", -1) > self._last_id for u in updates)
+            self.dispatch(updates)
+            if updates and not fresh:
+                # Chỉ nhận lại update đang xử lý → chờ offset tiến lên rồi mới kéo tiếp
+                with self._lock:
+                    offset = self._offset_locked()
+                    while self._offset_locked() == offset and not self._stopping.is_set():
+                        self._done.wait(1)
+
+    def stop(self, timeout=30):
+        """Ngừng kéo, chờ xử lý hết rồi báo offset cuối cho Telegram"""
+        self._stopping.set()
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self._inflight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._done.wait(remaining)
+        try:
+            self.fetch(self.offset(), 0)
+        except Exception as e:
+            print("[POLL] commit offset error:", e)
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats, inflight=len(self._inflight), offset=self._last_id + 1)
+
+def run_polling():
+    poller = UpdatePoller(POLL_WORKERS, POLL_LIMIT, POLL_TIMEOUT, POLL_MAX_INFLIGHT)
+    METRICS.register_gauges("poller", poller.metrics)
+    try:
+        poller.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        poller.stop()
+        TG_OUTBOX.drain()
+
 # =========================================================
 # LOCAL RUNNER
 # =========================================================
@@ -1295,7 +4794,12 @@ if __name__ == "__main__":
     print(" NgânMiu.Store Telegram Bot - OPTIMIZED VERSION")
     print("=" * 60)
     print("ADMIN_ID:", ADMIN_ID)
-    print("SHEET_READY:", SHEET_READY)
+    print("STORAGE:", STORE.name)
+    print("SHEET_READY:", store_ready())
+    print("MODE:", BOT_MODE)
     print("=" * 60)
 
-    app.run(host="127.0.0.1", port=5000, debug=False)
+    if BOT_MODE == "polling":
+        run_polling()
+    else:
+        app.run(host="127.0.0.1", port=5000, debug=False)
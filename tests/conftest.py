@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Fixture chung: bot chạy thật trên worksheet giả + stub Telegram / Shopee
+của benchmarks/harness.py (không gọi Google Sheets hay API thật)
+
+    python -m pytest -q
+"""
+
+import itertools
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import harness  # noqa: E402
+
+STUB = harness.StubServer().start()
+harness.configure_env(STUB)
+# Ghi "Thanh Toan" đồng bộ → test đọc Sheet giả ngay sau khi gọi
+os.environ["SHEET_WRITE_WINDOW"] = "0"
+
+FIRST_USER_ID = harness.FIRST_USER_ID
+
+
+@pytest.fixture(scope="session")
+def tb():
+    import telegram_bot
+    telegram_bot.DEBUG = False
+    return telegram_bot
+
+
+@pytest.fixture
+def sheets(tb):
+    """Sheet giả mới cho mỗi test (5 user, số dư 1.000.000.000) + xoá cache trong RAM"""
+    ws = harness.make_sheets(5)
+    tb.invalidate_user_index()
+    with tb._user_cache_lock:
+        tb._user_cache.clear()
+    tb.TX_INDEX = tb.TxIndex(tb.TX_BLOOM_BITS, tb.TX_HISTORY_TTL, tb.TX_RELOAD_TTL)
+    tb.STORE._applied_refs.clear()
+    tb.BAN_REGISTRY = tb.BanRegistry(tb.BAN_REGISTRY_TTL, use_timer=False)
+    tb.VOUCHER_STOCK = tb.VoucherStock(tb.VOUCHER_CACHE_TTL)
+    harness.install_sheets(tb, ws)
+    return ws
+
+
+@pytest.fixture
+def stub():
+    STUB.calls.clear()
+    return STUB
+
+
+_update_ids = itertools.count(1)
+
+
+def message(user_id, text):
+    update_id = next(_update_ids)
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "username": f"u{user_id}"},
+            "text": text,
+        },
+    }
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+from conftest import FIRST_USER_ID
+
+UID = str(FIRST_USER_ID)
+
+
+def ban_in_sheet(sheets, user_id, note="BAN VĨNH VIỄN"):
+    next(r for r in sheets["money"].rows if r[0] == str(user_id))[5] = note
+
+
+def count_loads(monkeypatch, tb, fail=lambda: False, delay=0.0):
+    calls = []
+    real = tb.STORE.load_ban_notes
+
+    def load_ban_notes():
+        calls.append(1)
+        time.sleep(delay)
+        if fail():
+            raise RuntimeError("sheets down")
+        return real()
+
+    monkeypatch.setattr(tb.STORE, "load_ban_notes", load_ban_notes)
+    return calls
+
+
+def test_concurrent_stale_checks_reload_once(tb, sheets, monkeypatch):
+    registry = tb.BanRegistry(0, use_timer=False)
+    registry.load()
+    time.sleep(0.01)
+    calls = count_loads(monkeypatch, tb, delay=0.05)
+
+    threads = [threading.Thread(target=registry.ensure_fresh) for _ in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+
+
+def test_failed_reload_keeps_snapshot_and_retries_soon(tb, sheets, monkeypatch):
+    ban_in_sheet(sheets, UID)
+    registry = tb.BanRegistry(0, use_timer=False, retry=0.05)
+    registry.load()
+    down = [True]
+    calls = count_loads(monkeypatch, tb, fail=lambda: down[0])
+
+    time.sleep(0.01)
+    registry.ensure_fresh()
+    assert registry.status(UID)["banned"]        # giữ bản cũ
+    registry.ensure_fresh()
+    assert len(calls) == 1                       # chờ retry, không gọi dồn
+
+    down[0] = False
+    ban_in_sheet(sheets, UID, "auto từ bot")
+    time.sleep(0.06)
+    registry.ensure_fresh()
+    assert len(calls) == 2
+    assert not registry.status(UID)["banned"]
+
+
+def test_failed_first_load_does_not_fail_open(tb, sheets, monkeypatch):
+    ban_in_sheet(sheets, UID)
+    registry = tb.BanRegistry(300, use_timer=False, retry=60)
+    count_loads(monkeypatch, tb, fail=lambda: True)
+
+    with pytest.raises(tb.SheetsUnavailable):
+        registry.ensure_fresh()
+    with pytest.raises(tb.SheetsUnavailable):
+        registry.ensure_fresh()
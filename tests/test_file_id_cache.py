@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from test_outbound_queue import FakeResponse
+
+URL = "https://example.com/a.jpg"
+
+
+def test_cache_file_is_opened_on_first_use(tb, tmp_path):
+    path = str(tmp_path / "ids.db")
+    cache = tb.FileIdCache(path, 10)
+    assert not os.path.exists(path)
+
+    cache.put(URL, "FILE1")
+    assert os.path.exists(path)
+    assert tb.FileIdCache(path, 10).get(URL) == "FILE1"   # process khác / khởi động lại
+
+
+def test_default_path_is_not_the_state_db(tb):
+    assert tb.TG_FILE_CACHE_PATH != tb.STATE_SQLITE_PATH
+    assert os.path.isabs(tb.TG_FILE_CACHE_PATH)
+
+
+@pytest.fixture
+def sends(tb, tmp_path, monkeypatch):
+    monkeypatch.setattr(tb, "TG_FILE_IDS", tb.FileIdCache(str(tmp_path / "ids.db"), 10))
+    tb.TG_FILE_IDS.put(URL, "FILE1")
+    sent = SimpleNamespace(photos=[], response=None)
+
+    def dispatch(chat_id, method, payload, timeout, on_result=None):
+        sent.photos.append(payload["photo"])
+        if on_result is not None and payload["photo"] == "FILE1":
+            on_result(sent.response)
+
+    monkeypatch.setattr(tb, "tg_dispatch", dispatch)
+    return sent
+
+
+def test_bad_file_id_falls_back_to_url(tb, sends):
+    sends.response = FakeResponse(400, {"ok": False, "description": "Bad Request: wrong file identifier/HTTP URL specified"})
+    tb.tg_send_photo(1, URL)
+    assert sends.photos == ["FILE1", URL]
+    assert tb.TG_FILE_IDS.get(URL) is None
+
+
+def test_other_bad_request_keeps_the_cached_file_id(tb, sends):
+    sends.response = FakeResponse(400, {"ok": False, "description": "Bad Request: chat not found"})
+    tb.tg_send_photo(1, URL)
+    assert sends.photos == ["FILE1"]
+    assert tb.TG_FILE_IDS.get(URL) == "FILE1"
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+
+def flask_get(tb, path):
+    r = tb.app.test_client().get(path)
+    return r.status_code
+
+
+def asgi_get(tb, query):
+    import asgi_app
+    return asyncio.run(asgi_app.app.route("GET", "/metrics", query, b""))[0]
+
+
+def test_metrics_disabled_without_token(tb, monkeypatch):
+    monkeypatch.setattr(tb, "METRICS_TOKEN", "")
+    assert flask_get(tb, "/metrics") == 404
+    assert flask_get(tb, "/metrics?token=") == 404
+    assert asgi_get(tb, "") == 404
+
+
+def test_metrics_require_token(tb, monkeypatch):
+    monkeypatch.setattr(tb, "METRICS_TOKEN", "s3cret")
+    assert flask_get(tb, "/metrics") == 403
+    assert flask_get(tb, "/metrics?token=wrong") == 403
+    assert flask_get(tb, "/metrics?token=s3cret") == 200
+    assert asgi_get(tb, "token=wrong") == 403
+    assert asgi_get(tb, "a=1&token=s3cret") == 200
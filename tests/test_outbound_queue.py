@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, body=None):
+        self.status_code = status_code
+        self.ok = 200 <= status_code < 300
+        self._body = body or {"ok": self.ok}
+        self.text = str(self._body)
+
+    def json(self):
+        return self._body
+
+
+def record_posts(monkeypatch, tb, status_for=lambda payload: 200):
+    sent = []
+    lock = threading.Lock()
+
+    def fake_post(method, payload, timeout):
+        with lock:
+            sent.append((payload["chat_id"], time.monotonic()))
+        return FakeResponse(status_for(payload))
+
+    monkeypatch.setattr(tb, "tg_post", fake_post)
+    return sent
+
+
+def test_rate_limited_chat_does_not_hold_the_worker(tb, monkeypatch):
+    sent = record_posts(monkeypatch, tb)
+    outbox = tb.OutboundQueue(1, 1000, chat_rate=2, chat_burst=1)
+
+    t0 = time.monotonic()
+    for i in range(3):
+        outbox.submit("busy", "sendMessage", {"chat_id": "busy", "text": str(i)}, 5)
+    outbox.submit("other", "sendMessage", {"chat_id": "other", "text": "x"}, 5)
+    assert outbox.drain(10)
+
+    other_at = next(at for chat, at in sent if chat == "other")
+    assert other_at - t0 < 0.3   # không chờ "busy" gửi hết (~1s)
+    assert [chat for chat, _ in sent].count("busy") == 3
+    assert outbox.stats["deferred"] >= 1
+
+
+def test_per_chat_order_is_kept(tb, monkeypatch):
+    texts = []
+    monkeypatch.setattr(tb, "tg_post", lambda m, p, t: texts.append(p["text"]) or FakeResponse())
+    outbox = tb.OutboundQueue(4, 1000, chat_rate=50, chat_burst=2)
+    for i in range(20):
+        outbox.submit(1, "sendMessage", {"chat_id": 1, "text": i}, 5)
+    assert outbox.drain(10)
+    assert texts == list(range(20))
+
+
+def test_http_errors_are_not_counted_as_sent(tb, monkeypatch):
+    record_posts(monkeypatch, tb, status_for=lambda p: 400 if p["text"] == "bad" else 200)
+    outbox = tb.OutboundQueue(2, 1000, 1000, 1000)
+    results = []
+    outbox.submit(1, "sendMessage", {"chat_id": 1, "text": "bad"}, 5, on_result=lambda r: results.append(r.status_code))
+    outbox.submit(2, "sendMessage", {"chat_id": 2, "text": "good"}, 5)
+    assert outbox.drain(10)
+    assert outbox.stats["sent"] == 1
+    assert outbox.stats["http_errors"] == 1
+    assert results == [400]   # callback vẫn thấy lỗi (vd FileIdCache)
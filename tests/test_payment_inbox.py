@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+
+from conftest import FIRST_USER_ID
+
+UID = FIRST_USER_ID + 2
+
+
+def sepay(tx_id, amount=50000, user_id=UID):
+    return {"id": tx_id, "transferAmount": amount, "content": f"SEVQR NAP {user_id}"}
+
+
+def balance(tb, user_id=UID):
+    return tb.get_user_record(user_id, fresh=True).balance
+
+
+def test_unopenable_inbox_falls_back_to_direct_processing(tb, sheets, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(tb, "SEPAY_INBOX_ENABLED", True)
+    monkeypatch.setattr(tb, "SEPAY_INBOX_PATH", str(tmp_path / "missing" / "inbox.db"))
+    inbox = tb.build_sepay_inbox()
+    assert inbox is None
+    assert "[SEPAY_INBOX] DISABLED" in capsys.readouterr().out
+
+    monkeypatch.setattr(tb, "SEPAY_INBOX", inbox)
+    start = balance(tb)
+    assert tb.accept_sepay(sepay("tx-direct")) == ("OK", 200)
+    assert balance(tb) > start
+
+
+def claimed_row(inbox, tx_id, claimed_at):
+    """Dòng đang được worker khác xử lý (không qua append → không khởi động thread nền)"""
+    inbox._conn().execute(
+        "INSERT INTO sepay_inbox (tx_id, payload, received_at, status, claimed_at) VALUES (?, ?, ?, 'processing', ?)",
+        (tx_id, json.dumps(sepay(tx_id)), claimed_at, claimed_at))
+
+
+def test_rows_leased_elsewhere_do_not_cause_busy_polling(tb, tmp_path):
+    inbox = tb.PaymentInbox(str(tmp_path / "inbox.db"), 1, 5, 300, 90)
+    now = time.time()
+    claimed_row(inbox, "tx-leased", now)
+    assert inbox._next_due_in() > 50          # lease còn 300s → không quét mỗi 50ms
+
+    claimed_row(inbox, "tx-expiring", now - 295)
+    assert 3 < inbox._next_due_in() <= 5      # dậy đúng lúc lease hết hạn
+
+
+def quiet_inbox(tb, tmp_path):
+    """Inbox không có thread nền: test gọi process_due() trực tiếp"""
+    inbox = tb.PaymentInbox(str(tmp_path / "inbox.db"), 1, 5, 300, 90)
+    inbox.start = lambda: None
+    return inbox
+
+
+def restart(tb):
+    """Process mới: index + ref trong RAM trống"""
+    tb.TX_INDEX = tb.TxIndex()
+    tb.STORE._applied_refs.clear()
+
+
+def test_replay_after_crash_before_topup_row_credits_once(tb, sheets, tmp_path, monkeypatch):
+    inbox = quiet_inbox(tb, tmp_path)
+    start = balance(tb)
+    inbox.append(sepay("tx-crash"))
+
+    real_save = tb.save_topup_to_sheet
+
+    def crash(**kw):
+        raise RuntimeError("process chết sau khi cộng số dư")
+
+    monkeypatch.setattr(tb, "save_topup_to_sheet", crash)
+    inbox.process_due()
+    credited = balance(tb)
+    assert credited > start
+
+    restart(tb)
+    monkeypatch.setattr(tb, "save_topup_to_sheet", real_save)
+    inbox._conn().execute("UPDATE sepay_inbox SET next_at=0")
+    inbox.process_due()
+
+    assert balance(tb) == credited
+    assert [r[5] for r in sheets["nap_tien"].rows].count("tx-crash") == 1
+    assert inbox.counts().get("done") == 1
+
+
+def test_crash_during_balance_write_is_not_credited_again(tb, sheets, tmp_path, monkeypatch):
+    logged = []
+    monkeypatch.setattr(tb, "log_row", lambda uid, name, action, value="", note="": logged.append(action))
+    inbox = quiet_inbox(tb, tmp_path)
+    start = balance(tb)
+    inbox.append(sepay("tx-unknown"))
+    inbox.mark_credit("tx-unknown", "started")   # chết giữa lúc ghi số dư
+
+    inbox.process_due()
+    assert balance(tb) == start
+    assert inbox.counts().get("failed") == 1
+    assert logged == ["TOPUP_UNCERTAIN"]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from conftest import FIRST_USER_ID, message
+
+PRICE = 1000
+
+
+def balance(tb, user_id):
+    return tb.get_user_record(user_id, fresh=True).balance
+
+
+def buy(tb, user_id, text):
+    before = balance(tb, user_id)
+    tb.handle_update(message(user_id, text))
+    return before - balance(tb, user_id)
+
+
+def test_repeat_purchases_are_charged_each_time(tb, sheets, stub):
+    # 2 user khác nhau rồi user đầu mua lại: ref ledger không được trùng
+    for user_id in (FIRST_USER_ID, FIRST_USER_ID + 1, FIRST_USER_ID):
+        assert buy(tb, user_id, "/voucher100k SPC_EC=test") == PRICE
+    assert stub.calls["shopee"] == 3
+
+
+def test_failed_save_is_refunded(tb, sheets, monkeypatch):
+    monkeypatch.setattr(tb, "save_voucher_and_check", lambda cookie, v: (False, "error"))
+    assert buy(tb, FIRST_USER_ID, "/voucher100k SPC_EC=test") == 0
+
+
+def test_save_happens_after_debit(tb, sheets, monkeypatch):
+    seen = []
+
+    def save(cookie, v):
+        seen.append(balance(tb, FIRST_USER_ID))
+        return True, "OK"
+
+    start = balance(tb, FIRST_USER_ID)
+    monkeypatch.setattr(tb, "save_voucher_and_check", save)
+    tb.handle_update(message(FIRST_USER_ID, "/voucher100k SPC_EC=test"))
+    assert seen == [start - PRICE]   # lúc gọi Shopee tiền đã bị giữ
+
+
+def test_insufficient_balance_skips_shopee(tb, sheets, stub):
+    tb.STORE.apply_delta(str(FIRST_USER_ID), -(balance(tb, FIRST_USER_ID) - PRICE + 1), "RESET")
+    assert buy(tb, FIRST_USER_ID, "/voucher100k SPC_EC=test") == 0
+    assert stub.calls["shopee"] == 0
+
+
+def test_combo_charges_only_saved_vouchers(tb, sheets, monkeypatch):
+    def save_all(cookie, vouchers, deadline=None):
+        return [(v["Tên Mã"] != "voucherHoaToc", "OK") for v in vouchers]
+
+    monkeypatch.setattr(tb, "save_vouchers_parallel", save_all)
+    assert buy(tb, FIRST_USER_ID, "/combo1 SPC_EC=test") == 2 * PRICE
+
+
+def test_combo_with_no_saved_voucher_is_free(tb, sheets, monkeypatch):
+    monkeypatch.setattr(tb, "save_vouchers_parallel", lambda c, vs, deadline=None: [(False, "x")] * len(vs))
+    assert buy(tb, FIRST_USER_ID, "/combo1 SPC_EC=test") == 0
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from conftest import FIRST_USER_ID
+
+UID = FIRST_USER_ID
+
+
+def money_cell(sheets, user_id):
+    return next(r for r in sheets["money"].rows if r[0] == str(user_id))
+
+
+def test_debit_reads_balance_written_by_another_instance(tb, sheets):
+    start = tb.get_user_record(UID).balance          # cache USER_CACHE_TTL giây
+    money_cell(sheets, UID)[2] = str(start + 50000)  # instance khác vừa cộng 50k
+
+    ok, balance = tb.debit_balance(UID, 1000, "VOUCHER")
+    assert ok and balance == start + 49000
+    assert int(money_cell(sheets, UID)[2]) == start + 49000
+
+
+def test_overdraft_checked_against_sheet_balance(tb, sheets):
+    tb.get_user_record(UID)
+    money_cell(sheets, UID)[2] = "500"                # instance khác vừa trừ gần hết
+    assert tb.debit_balance(UID, 1000, "VOUCHER") == (False, 500)
+    assert money_cell(sheets, UID)[2] == "500"
+
+
+def test_sepay_ref_applied_once_in_process(tb, sheets):
+    ok, balance, code = tb.change_balance(UID, 1000, "TOPUP_SEPAY", ref="SEPAY:x")
+    assert (ok, code) == (True, "OK")
+    assert tb.change_balance(UID, 1000, "TOPUP_SEPAY", ref="SEPAY:x") == (False, balance, "DUPLICATE")
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+import harness
+
+VOUCHER = {"Promotionid": "1", "CODE": "C1", "Signature": "s1"}
+
+
+@pytest.fixture
+def slow_shopee():
+    stub = harness.StubServer(shopee_latency=0.5).start()
+    yield stub.url + harness.SHOPEE_PATH
+    stub.shutdown()
+
+
+def client(tb, url, timeout, retries, budget):
+    c = tb.ShopeeClient(url, 4, timeout, retries, 0.01, budget)
+    c.MIN_ATTEMPT = 0.1
+    return c
+
+
+def test_retries_stay_within_budget(tb, slow_shopee):
+    c = client(tb, slow_shopee, timeout=0.3, retries=10, budget=1.0)
+    t0 = time.perf_counter()
+    ok, reason = c.save("SPC_EC=x", VOUCHER)
+    elapsed = time.perf_counter() - t0
+    assert (ok, reason) == (False, "TIMEOUT")
+    assert c.retried >= 1
+    assert elapsed < 1.3
+
+
+def test_attempt_timeout_is_capped_by_budget(tb, slow_shopee):
+    # timeout 2s nhưng budget 0.4s → lần thử bị cắt còn 0.4s, không retry tiếp
+    c = client(tb, slow_shopee, timeout=2, retries=3, budget=0.4)
+    t0 = time.perf_counter()
+    assert c.save("SPC_EC=x", VOUCHER)[1] == "TIMEOUT"
+    assert time.perf_counter() - t0 < 0.7
+
+
+def test_success_within_budget(tb, slow_shopee):
+    c = client(tb, slow_shopee, timeout=2, retries=2, budget=3)
+    assert c.save("SPC_EC=x", VOUCHER) == (True, "OK")
+
+
+def test_concurrent_combos_do_not_queue_behind_each_other(tb):
+    stub = harness.StubServer(shopee_latency=0.3).start()
+    try:
+        c = client(tb, stub.url + harness.SHOPEE_PATH, timeout=2, retries=0, budget=2)
+        results = []
+
+        def combo():
+            results.append(c.save_many("SPC_EC=x", [VOUCHER] * 3, deadline=0.8))
+
+        # 6 combo x 3 mã > COMBO_MAX_WORKERS: không combo nào chờ combo khác
+        threads = [threading.Thread(target=combo) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(results) == 6
+        assert all(r == [(True, "OK")] * 3 for r in results)
+    finally:
+        stub.shutdown()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import threading
+
+import pytest
+
+from conftest import FIRST_USER_ID
+
+UID = str(FIRST_USER_ID)
+
+
+@pytest.fixture
+def store(tb, sheets, tmp_path):
+    s = tb.SQLiteStorage(str(tmp_path / "bot.db"))
+    assert s.ready()  # seed từ Sheet giả
+    return s
+
+
+@pytest.fixture
+def replicator(tb, store):
+    return tb.SheetReplicator(store, interval=3600, batch=200, pull_interval=0)
+
+
+def ledger(store, user_id):
+    return [tuple(r) for r in store._conn().execute(
+        "SELECT delta, balance, reason, ref FROM ledger WHERE user_id = ? ORDER BY id", (str(user_id),))]
+
+
+def sheet_row(sheets, user_id):
+    return next(r for r in sheets["money"].rows if r[0] == str(user_id))
+
+
+# ----- apply_delta -----
+def test_apply_delta_credit_and_debit(store):
+    start = store.get_user(UID).balance
+    assert store.apply_delta(UID, 5000, "TOPUP") == (True, start + 5000, "OK")
+    assert store.apply_delta(UID, -2000, "VOUCHER") == (True, start + 3000, "OK")
+    assert store.get_user(UID).balance == start + 3000
+    assert ledger(store, UID) == [(5000, start + 5000, "TOPUP", None), (-2000, start + 3000, "VOUCHER", None)]
+
+
+def test_apply_delta_rejects_overdraft(store):
+    start = store.get_user(UID).balance
+    assert store.apply_delta(UID, -(start + 1), "VOUCHER") == (False, start, "INSUFFICIENT")
+    assert ledger(store, UID) == []
+
+
+def test_apply_delta_ref_is_applied_once(store):
+    ok, bal, code = store.apply_delta(UID, 1000, "TOPUP_SEPAY", ref="SEPAY:1")
+    assert (ok, code) == (True, "OK")
+    assert store.apply_delta(UID, 1000, "TOPUP_SEPAY", ref="SEPAY:1") == (False, bal, "DUPLICATE")
+
+
+def test_apply_delta_without_ref_repeats(store):
+    start = store.get_user(UID).balance
+    for _ in range(3):
+        assert store.apply_delta(UID, -1000, "VOUCHER")[0]
+    assert store.get_user(UID).balance == start - 3000
+
+
+def test_apply_delta_guard_and_fields(store):
+    store.update_user(UID, status="new")
+    guard = lambda rec: rec.status != "active"
+    assert store.apply_delta(UID, 5000, "ACTIVE_GIFT_5K", fields={"status": "active"}, guard=guard)[2] == "OK"
+    assert store.get_user(UID).status == "active"
+    assert store.apply_delta(UID, 5000, "ACTIVE_GIFT_5K", fields={"status": "active"}, guard=guard)[2] == "REJECTED"
+
+
+def test_apply_delta_unknown_user(store):
+    assert store.apply_delta("42", 1000, "X") == (False, 0, "NO_USER")
+
+
+def test_concurrent_debits_never_overdraw(store):
+    store.apply_delta(UID, -store.get_user(UID).balance + 10000, "RESET")
+    results = []
+
+    def buy():
+        results.append(store.apply_delta(UID, -1000, "VOUCHER")[0])
+
+    threads = [threading.Thread(target=buy) for _ in range(30)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results.count(True) == 10
+    assert store.get_user(UID).balance == 0
+
+
+# ----- đồng bộ với "Thanh Toan" -----
+def test_staff_balance_edit_is_merged_not_overwritten(tb, sheets, store, replicator):
+    start = store.get_user(UID).balance
+    replicator.replicate_once()
+
+    sheet_row(sheets, UID)[2] = str(start + 50000)      # staff cộng tay 50k
+    store.apply_delta(UID, -1000, "VOUCHER")            # bot trừ 1k cùng lúc
+    replicator.replicate_once()
+
+    assert store.get_user(UID).balance == start + 49000
+    assert int(sheet_row(sheets, UID)[2]) == start + 49000
+    assert (50000, start + 49000, "SHEET_EDIT", None) in ledger(store, UID)
+
+
+def test_staff_ban_note_reaches_ban_registry(tb, sheets, store, replicator, monkeypatch):
+    replicator.replicate_once()
+    sheet_row(sheets, UID)[5] = "BAN VĨNH VIỄN"
+    replicator.replicate_once()
+
+    assert store.get_user(UID).note == "BAN VĨNH VIỄN"
+    monkeypatch.setattr(tb, "STORE", store)
+    registry = tb.BanRegistry(300, use_timer=False)
+    registry.load()
+    assert registry.status(UID)["banned"]
+
+    # Lần đẩy sau (bot đổi số dư) không xoá ghi chú
+    store.apply_delta(UID, 1000, "X")
+    replicator.replicate_once()
+    assert sheet_row(sheets, UID)[5] == "BAN VĨNH VIỄN"
+
+
+def test_unchanged_sheet_is_not_treated_as_edit(sheets, store, replicator):
+    for _ in range(3):
+        store.apply_delta(UID, -1000, "VOUCHER")
+        replicator.replicate_once()
+    assert [r[2] for r in ledger(store, UID)] == ["VOUCHER"] * 3
+
+
+def test_old_database_gets_sheet_columns(tb, tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (user_id TEXT PRIMARY KEY, username TEXT NOT NULL DEFAULT '', "
+                 "balance INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL DEFAULT '', "
+                 "source TEXT NOT NULL DEFAULT '', note TEXT NOT NULL DEFAULT '')")
+    conn.commit()
+    conn.close()
+    store = tb.SQLiteStorage(path)
+    cols = {r["name"] for r in store._conn().execute("PRAGMA table_info(users)")}
+    assert {"sheet_balance", "sheet_note"} <= cols
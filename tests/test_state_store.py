@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tb, tmp_path):
+    if request.param == "sqlite":
+        return tb.SQLiteStateStore(str(tmp_path / "state.db"), "test")
+    return tb.MemoryStateStore(100)
+
+
+def test_get_set_pop_delete(store):
+    assert store.get("a", "none") == "none"
+    store.set("a", {"x": 1}, 60)
+    assert store.get("a") == {"x": 1}
+    assert store.pop("a") == {"x": 1}
+    assert store.pop("a", "none") == "none"
+    store.set("b", 1, 60)
+    store.delete("b")
+    assert store.get("b") is None
+
+
+def test_set_if_absent(store):
+    assert store.set_if_absent("k", 1, 60)
+    assert not store.set_if_absent("k", 2, 60)
+    assert store.get("k") == 1
+
+
+def test_expired_key_is_gone_and_can_be_claimed_again(store):
+    store.set("k", 1, 0.05)
+    assert store.get("k") == 1
+    time.sleep(0.06)
+    assert store.get("k") is None
+    assert store.set_if_absent("k", 2, 60)
+    assert store.get("k") == 2
+
+
+def test_update_is_read_modify_write(store):
+    assert store.update("n", lambda v: (v or 0) + 1, 60) == 1
+    assert store.update("n", lambda v: (v or 0) + 1, 60) == 2
+    assert store.get("n") == 2
+
+
+def test_len_counts_live_keys(store):
+    store.set("a", 1, 60)
+    store.set("b", 1, 60)
+    store.set("old", 1, 0.01)
+    time.sleep(0.02)
+    store.get("old")
+    assert len(store) == 2
+
+
+def test_spam_tracker_len_uses_store(tb, store):
+    tracker = tb.SpamTracker(3, 60, 60, store)
+    tracker.record_error(1)
+    tracker.record_error(2)
+    tracker.record_error(1)
+    assert len(tracker) == 2
+
+
+def test_memory_store_is_bounded(tb):
+    store = tb.MemoryStateStore(3)
+    for i in range(10):
+        store.set(str(i), i, 60)
+    assert len(store) == 3
+    assert store.get("0") is None and store.get("9") == 9
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import time
+
+from conftest import FIRST_USER_ID
+
+
+def topup_row(user_id, tx_id, amount="50000"):
+    return ["2025-01-02 00:00:00", str(user_id), "", amount, "SEPAY", tx_id, ""]
+
+
+def sepay(user_id, tx_id, amount=50000):
+    return {"id": tx_id, "transferAmount": amount, "content": f"SEVQR NAP {user_id}"}
+
+
+def balance(sheets, row):
+    return int(sheets["money"].rows[row - 1][2])
+
+
+def test_cold_start_reads_only_tx_column(tb, sheets):
+    assert tb.TX_INDEX.contains("seed-1-0")
+    assert sheets["nap_tien"].calls["col_values"] == 1
+    assert sheets["nap_tien"].calls["get_all_values"] == 0
+
+
+def test_known_tx_needs_no_api_call(tb, sheets):
+    tb.TX_INDEX.contains("seed-0-0")
+    before = sum(sheets["nap_tien"].calls.values())
+    assert tb.TX_INDEX.contains("seed-3-1")
+    assert sum(sheets["nap_tien"].calls.values()) == before
+
+
+def test_miss_is_confirmed_against_sheet(tb, sheets):
+    assert not tb.TX_INDEX.contains("brand-new")
+    # Instance khác ghi tx sau khi index đã nạp
+    sheets["nap_tien"].rows.append(topup_row(FIRST_USER_ID, "other-instance"))
+    assert tb.TX_INDEX.contains("other-instance")
+
+
+def test_added_tx_is_seen_without_reading(tb, sheets):
+    tb.TX_INDEX.contains("seed-0-0")
+    tb.TX_INDEX.add(topup_row(FIRST_USER_ID, "own-1"))
+    before = sheets["nap_tien"].calls["col_values"]
+    assert tb.TX_INDEX.contains("own-1")
+    assert sheets["nap_tien"].calls["col_values"] == before
+
+
+def test_history_picks_up_tail_without_duplicates(tb, sheets):
+    index = tb.TxIndex(history_ttl=0)
+    assert [tx for _, _, tx in index.history(FIRST_USER_ID, 10)] == ["seed-0-0", "seed-0-1"]
+
+    own = topup_row(FIRST_USER_ID, "own-1")
+    sheets["nap_tien"].rows.append(own)
+    index.add(own)
+    sheets["nap_tien"].rows.append(topup_row(FIRST_USER_ID, "other-1", "70000"))
+
+    time.sleep(0.01)
+    index.history(FIRST_USER_ID, 10)  # hẹn đọc nền
+    deadline = time.time() + 5
+    while index._refreshing or index.rows < len(sheets["nap_tien"].rows):
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+    assert [tx for _, _, tx in index.history(FIRST_USER_ID, 10)] == ["seed-0-0", "seed-0-1", "own-1", "other-1"]
+    assert sheets["nap_tien"].calls["get_all_values"] == 1
+
+
+def test_sepay_retry_after_restart_credits_once(tb, sheets):
+    row = tb.get_user_row(FIRST_USER_ID + 1)
+    start = balance(sheets, row)
+
+    assert tb.process_sepay(sepay(FIRST_USER_ID + 1, "tx-restart"))[1] == 200
+    credited = balance(sheets, row)
+    assert credited > start
+
+    # Restart / instance khác: index + ref trong RAM trống
+    tb.TX_INDEX = tb.TxIndex()
+    tb.STORE._applied_refs.clear()
+    assert tb.process_sepay(sepay(FIRST_USER_ID + 1, "tx-restart")) == ("DUPLICATE", 200)
+    assert balance(sheets, row) == credited
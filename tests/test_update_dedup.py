@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from conftest import FIRST_USER_ID, message
+
+
+@pytest.fixture
+def seen(tb, tmp_path, monkeypatch):
+    store = tb.SQLiteStateStore(str(tmp_path / "state.db"), "updates")
+    monkeypatch.setattr(tb, "SEEN_UPDATES", store)
+    return store
+
+
+def test_claim_is_exclusive_until_released(tb, seen):
+    assert tb.claim_update(1)
+    assert not tb.claim_update(1)
+    tb.release_update(1)
+    assert tb.claim_update(1)
+
+
+def test_claim_lease_expires_after_crash(tb, seen, monkeypatch):
+    monkeypatch.setattr(tb, "UPDATE_CLAIM_TTL", 0.05)
+    assert tb.claim_update(2)
+    time.sleep(0.06)             # process chết, không finish / release
+    assert tb.claim_update(2)
+
+
+def test_finished_update_is_remembered_past_the_lease(tb, seen, monkeypatch):
+    monkeypatch.setattr(tb, "UPDATE_CLAIM_TTL", 0.05)
+    assert tb.claim_update(3)
+    tb.finish_update(3)
+    time.sleep(0.06)
+    assert not tb.claim_update(3)
+
+
+def test_redelivered_update_is_handled_once(tb, sheets, stub, seen):
+    update = message(FIRST_USER_ID, "/start")
+    tb.handle_update(update)
+    tb.TG_OUTBOX.drain(10)
+    sent = stub.calls["telegram:sendMessage"]
+    assert sent
+    tb.handle_update(update)
+    tb.TG_OUTBOX.drain(10)
+    assert stub.calls["telegram:sendMessage"] == sent
+
+
+def test_failed_update_releases_its_claim(tb, sheets, seen, monkeypatch):
+    update = message(FIRST_USER_ID, "/start")
+    monkeypatch.setattr(tb, "_handle_update_safe", lambda u: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        tb.handle_update(update)
+    assert tb.claim_update(update["update_id"])
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import time
+
+from conftest import message
+
+
+def make_poller(tb, monkeypatch, handle, max_retries=2):
+    monkeypatch.setattr(tb, "handle_update", handle)
+    poller = tb.UpdatePoller(1, 100, 0, 100, max_retries=max_retries, retry_delay=0.01)
+    poller.start_workers()
+    return poller
+
+
+def run(poller, updates):
+    poller.dispatch(updates)
+    deadline = time.time() + 5
+    while poller._inflight:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    return poller
+
+
+def test_failed_update_is_retried_before_offset_moves(tb, monkeypatch):
+    first, second = message(1, "/start"), message(1, "/help")
+    order, offsets = [], []
+
+    def handle(update):
+        order.append(update["update_id"])
+        offsets.append(poller.offset())
+        if order.count(first["update_id"]) < 3:
+            raise RuntimeError("sheets down")
+
+    poller = make_poller(tb, monkeypatch, handle)
+    run(poller, [first, second])
+    # update đầu chạy lại tới khi xong, update sau của cùng user chờ
+    assert order == [first["update_id"]] * 3 + [second["update_id"]]
+    assert offsets == [first["update_id"]] * 3 + [second["update_id"]]
+    assert poller.offset() == second["update_id"] + 1
+    assert poller.stats["retried"] == 2 and poller.stats["processed"] == 2
+
+
+def test_update_is_dropped_after_max_retries(tb, monkeypatch, capsys):
+    bad, good = message(1, "/start"), message(2, "/start")
+    handled = []
+
+    def handle(update):
+        if update is bad:
+            raise RuntimeError("always")
+        handled.append(update["update_id"])
+
+    poller = run(make_poller(tb, monkeypatch, handle, max_retries=2), [bad, good])
+    assert handled == [good["update_id"]]
+    assert poller.stats == dict(poller.stats, retried=2, failed=1, processed=1)
+    assert poller.offset() == good["update_id"] + 1
+    assert "[POLL_GIVE_UP]" in capsys.readouterr().out
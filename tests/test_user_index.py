@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from conftest import FIRST_USER_ID
+
+
+def test_expired_index_is_rebuilt_once_by_concurrent_requests(tb, sheets):
+    tb.get_user_row(FIRST_USER_ID)
+    tb.invalidate_user_index()
+    sheets["money"].latency = 0.02  # các luồng cùng chờ lock trong lúc tải cột A
+    before = sheets["money"].calls["col_values"]
+
+    threads = [threading.Thread(target=tb.get_user_row, args=(FIRST_USER_ID + i % 5,)) for i in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sheets["money"].calls["col_values"] - before == 1
+
+
+def test_row_lookup(tb, sheets):
+    assert tb.get_user_row(FIRST_USER_ID) == 2
+    assert tb.get_user_row(FIRST_USER_ID + 4) == 6